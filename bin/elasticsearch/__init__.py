@@ -16,10 +16,11 @@ if (2, 7) <= sys.version_info < (3, 2):
 
 from .client import Elasticsearch
 from .transport import Transport
+from .async_transport import AsyncTransport
 from .connection_pool import ConnectionPool, ConnectionSelector, \
-    RoundRobinSelector
+    RoundRobinSelector, EWMASelector
 from .serializer import JSONSerializer
 from .connection import Connection, RequestsHttpConnection, \
-    Urllib3HttpConnection
+    Urllib3HttpConnection, AsyncHttpConnection
 from .exceptions import *
 
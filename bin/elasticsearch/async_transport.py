@@ -0,0 +1,457 @@
+import copy
+import heapq
+import sys
+import time
+from collections import deque
+from itertools import count
+from types import GeneratorType
+
+from urllib3.util.selectors import DefaultSelector
+
+from .connection.http_async import AsyncHttpConnection
+from .transport import Transport
+from .exceptions import TransportError, ConnectionError
+
+# requests kept in flight at once by `perform_requests` unless told otherwise
+DEFAULT_MAX_IN_FLIGHT = 64
+
+# generated by `TaskRunner` as the value of a task that completed
+TASK_DONE = object()
+
+
+class Request(object):
+    """
+    A request a task waits for. Tasks are generators yielding the requests
+    they wait for, whoever runs them (`run` or a `TaskRunner`) sends the
+    request and sends the deserialized response back into the task, or
+    throws the error into it. A task can also yield another task, to get the
+    list of its other values once it completed.
+    """
+    __slots__ = ('transport', 'method', 'url', 'headers', 'params', 'body')
+
+    def __init__(self, transport, method, url, headers=None, params=None, body=None):
+        self.transport = transport
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.params = params
+        self.body = body
+
+    def send(self):
+        """
+        Send the request from the calling thread, returns its response.
+        """
+        return self.transport.perform_request(self.method, self.url,
+            headers=self.headers, params=self.params, body=self.body)
+
+
+class _RecordingTransport(object):
+    """
+    Stands in for the transport of a client, returning the requests of the
+    client's api methods instead of sending them.
+    """
+    def __init__(self, transport):
+        self.transport = transport
+        self.serializer = transport.serializer
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        return Request(self.transport, method, url, headers, params, body)
+
+
+def prepare(client, api, *args, **kwargs):
+    """
+    Return the :class:`Request` calling `api` of `client` would send, e.g.
+    ``prepare(es, 'search', index='logs', body=body)``. Only the api methods
+    of the client itself are supported, not those of its namespaces
+    (``indices``, ``cluster``...).
+    """
+    recorder = copy.copy(client)
+    recorder.transport = _RecordingTransport(client.transport)
+    return getattr(recorder, api)(*args, **kwargs)
+
+
+def _nested(task):
+    """
+    Task running `task`, which can also yield other tasks: each one is run
+    in turn, its requests sent on and the list of its other values sent back
+    once it completed. An error of a nested task is thrown into its parent.
+    """
+    stack = [task]
+    # values of every nested task, one list per level below the top one
+    outputs = []
+    value, error = None, None
+    try:
+        while stack:
+            try:
+                current = stack[-1].throw(*error) if error is not None else stack[-1].send(value)
+            except StopIteration:
+                stack.pop()
+                value, error = outputs.pop() if outputs else None, None
+                continue
+            except Exception:
+                if not outputs:
+                    raise
+                stack.pop()
+                outputs.pop()
+                value, error = None, sys.exc_info()
+                continue
+            value, error = None, None
+            if isinstance(current, Request):
+                try:
+                    value = yield current
+                except Exception:
+                    error = sys.exc_info()
+            elif isinstance(current, GeneratorType):
+                stack.append(current)
+                outputs.append([])
+            elif outputs:
+                outputs[-1].append(current)
+            else:
+                yield current
+    finally:
+        for task in reversed(stack):
+            task.close()
+
+
+def run(task):
+    """
+    Run a task from the calling thread, sending its requests one at a time
+    with the blocking `perform_request`, and generate its other values.
+    """
+    task = _nested(task)
+    try:
+        value = next(task)
+        while True:
+            if not isinstance(value, Request):
+                yield value
+                value = next(task)
+                continue
+            try:
+                response = value.send()
+            except Exception:
+                value = task.throw(*sys.exc_info())
+            else:
+                value = task.send(response)
+    except StopIteration:
+        return
+    finally:
+        task.close()
+
+
+class _Call(object):
+    """
+    A request of a task on its way through a `TaskRunner`.
+    """
+    __slots__ = ('position', 'task', 'request', 'prepared', 'attempt', 'connection')
+
+    def __init__(self, position, task, request):
+        self.position = position
+        self.task = task
+        self.request = request
+        transport = request.transport
+        self.prepared = transport._prepare_request(request.method, request.params, request.body)
+        self.attempt = 0
+        self.connection = None
+
+
+class TaskRunner(object):
+    """
+    Runs many tasks from a single thread, keeping their requests in flight
+    at once.
+
+    A task is a generator yielding the :class:`Request` objects it waits for,
+    other tasks it waits for the list of values of, and any other value as
+    output. Iterating over the runner generates
+    ``(position, value)`` for every output of the task at `position` in
+    `tasks`, and ``(position, TASK_DONE)`` once that task completed. An error
+    raised by a task stops the runner and is raised to its caller.
+
+    The requests are sent over non-blocking sockets of
+    :class:`~elasticsearch.connection.AsyncHttpConnection` connections, so
+    their transports must use that connection class, as
+    :class:`AsyncTransport` does. They're advanced by one selector, retried
+    on another node and nodes are marked dead or live exactly like
+    `perform_request` does, and every request holds a slot of the
+    concurrency limiter of its transport while in flight.
+
+    A task is resumed as soon as its response arrived and runs until it
+    waits for its next request, it must not block meanwhile.
+    """
+    def __init__(self, tasks, max_in_flight=DEFAULT_MAX_IN_FLIGHT, max_tasks=None, window=None):
+        """
+        :arg tasks: iterable of tasks, it's consumed lazily, only when there
+            is room for more requests in flight
+        :arg max_in_flight: number of requests in flight at once
+        :arg max_tasks: number of tasks running at once, unlimited by default
+        :arg window: tasks are started in order, none more than `window`
+            positions after the oldest one still running, which bounds the
+            outputs a caller reordering them by position has to hold
+        """
+        self.tasks = enumerate(tasks)
+        self.exhausted = False
+        self.max_in_flight = max_in_flight
+        self.max_tasks = max_tasks
+        self.window = window
+        self.admitted = 0
+        self.running = {}
+        # tasks to resume, as (position, task, value, exc_info)
+        self.ready = deque()
+        # requests waiting for a slot
+        self.waiting = deque()
+        # rejected requests to retry, by the time they're due
+        self.delayed = []
+        self.sequence = count()
+        self.in_flight = {}
+        self.paused = set()
+        self.parked = {}
+        self.selector = None
+
+    def pause(self, position):
+        """
+        Stop resuming the task at `position` until `resume` is called, its
+        requests still complete meanwhile.
+        """
+        self.paused.add(position)
+
+    def resume(self, position):
+        """
+        Resume the task at `position` again after `pause`.
+        """
+        self.paused.discard(position)
+        step = self.parked.pop(position, None)
+        if step is not None:
+            self.ready.append(step)
+
+    def __iter__(self):
+        self.selector = DefaultSelector()
+        try:
+            while True:
+                self._admit()
+                if self.ready:
+                    position, task, value, error = step = self.ready.popleft()
+                    if position in self.paused:
+                        self.parked[position] = step
+                        continue
+                    try:
+                        output = task.throw(*error) if error is not None else task.send(value)
+                    except StopIteration:
+                        del self.running[position]
+                        yield position, TASK_DONE
+                        continue
+                    if isinstance(output, Request):
+                        self.waiting.append(_Call(position, task, output))
+                        continue
+                    # run the task on until it waits, before the others
+                    self.ready.appendleft((position, task, None, None))
+                    yield position, output
+                    continue
+
+                self._start_waiting()
+                if not (self.in_flight or self.waiting or self.delayed):
+                    if self.parked:
+                        raise RuntimeError('Every remaining task is paused')
+                    return
+                self._wait()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Abandon the requests in flight and close the remaining tasks.
+        """
+        now = time.time()
+        for exchange, call in self.in_flight.items():
+            exchange.detach()
+            call.connection.discard_socket(exchange.sock)
+            # the time waited so far is a lower bound of its latency
+            self._release(call, now - exchange.start, abandoned=True)
+        self.in_flight.clear()
+        for task in self.running.values():
+            task.close()
+        self.running.clear()
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+
+    def _admit(self):
+        """
+        Start another task when nothing is ready to run and there is room
+        for its requests.
+        """
+        if self.ready or self.exhausted:
+            return
+        if len(self.in_flight) + len(self.waiting) >= self.max_in_flight:
+            return
+        if self.max_tasks is not None and len(self.running) >= self.max_tasks:
+            return
+        if self.window is not None and self.running and self.admitted >= min(self.running) + self.window:
+            return
+        try:
+            position, task = next(self.tasks)
+        except StopIteration:
+            self.exhausted = True
+            return
+        task = _nested(task)
+        self.admitted += 1
+        self.running[position] = task
+        self.ready.append((position, task, None, None))
+
+    def _start_waiting(self):
+        """
+        Start the waiting requests the limits allow.
+        """
+        blocked = deque()
+        while self.waiting and len(self.in_flight) < self.max_in_flight:
+            call = self.waiting.popleft()
+            limiter = call.request.transport.concurrency_limiter
+            if limiter is not None and not limiter.try_acquire():
+                blocked.append(call)
+                continue
+            self._start(call)
+        blocked.extend(self.waiting)
+        self.waiting = blocked
+
+    def _start(self, call):
+        transport = call.request.transport
+        method, params, body, ignore, timeout = call.prepared
+        while True:
+            connection = transport.get_connection()
+            try:
+                exchange = connection.start_request(method, call.request.url, params, body, timeout, call.request.headers)
+            except TransportError as e:
+                # a node that can't even be connected to counts as a failed attempt
+                if not transport._should_retry(e) or call.attempt == transport.max_retries:
+                    if transport.concurrency_limiter is not None:
+                        transport.concurrency_limiter.release()
+                    self.ready.append((call.position, call.task, None, sys.exc_info()))
+                    return
+                transport.mark_dead(connection)
+                call.attempt += 1
+                continue
+            transport.connection_pool.request_started(connection)
+            exchange.attach(self.selector)
+            call.connection = connection
+            self.in_flight[exchange] = call
+            return
+
+    def _release(self, call, duration, error=None, abandoned=False):
+        """
+        Report a request that left the selector to the connection pool and
+        return its slot to the concurrency limiter.
+        """
+        failed = isinstance(error, ConnectionError)
+        call.request.transport.connection_pool.request_finished(call.connection, duration, failed)
+        limiter = call.request.transport.concurrency_limiter
+        if limiter is not None:
+            rejected = isinstance(error, TransportError) and error.status_code == 429
+            limiter.release(None if failed or abandoned else duration, rejected)
+
+    def _wait(self):
+        """
+        Wait for requests to complete or become due, and hand their
+        responses back to their tasks.
+        """
+        now = time.time()
+        if self.in_flight:
+            wait = min(exchange.deadline for exchange in self.in_flight) - now
+            if self.delayed:
+                wait = min(wait, self.delayed[0][0] - now)
+            for key, _ in self.selector.select(max(0, wait)):
+                key.data.on_ready()
+        elif self.delayed:
+            time.sleep(max(0, self.delayed[0][0] - now))
+        else:
+            # the limiter is held by other threads, wait for a slot of our own
+            call = self.waiting.popleft()
+            call.request.transport.concurrency_limiter.acquire()
+            self._start(call)
+
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.waiting.append(heapq.heappop(self.delayed)[2])
+        for exchange in [e for e in self.in_flight if e.done or e.check_timeout(now)]:
+            self._finish(self.in_flight.pop(exchange), exchange, now)
+
+    def _finish(self, call, exchange, now):
+        transport = call.request.transport
+        method, ignore = call.prepared[0], call.prepared[3]
+        duration = now - exchange.start
+        try:
+            status, headers, data = call.connection.finish_request(exchange, ignore)
+        except TransportError as e:
+            self._release(call, duration, e)
+            if method == 'HEAD' and e.status_code == 404:
+                self.ready.append((call.position, call.task, False, None))
+                return
+            if e.status_code == 429 and transport.concurrency_limiter is not None:
+                # the node is overloaded rather than dead, back off and retry
+                if call.attempt < transport.max_retries:
+                    due = now + transport._get_rejection_backoff(call.attempt)
+                    call.attempt += 1
+                    heapq.heappush(self.delayed, (due, next(self.sequence), call))
+                    return
+            elif transport._should_retry(e):
+                # only mark as dead if we are retrying
+                transport.mark_dead(call.connection)
+                if call.attempt < transport.max_retries:
+                    call.attempt += 1
+                    self.waiting.append(call)
+                    return
+            # hand the error of the last attempt to the task
+            self.ready.append((call.position, call.task, None, sys.exc_info()))
+            return
+
+        self._release(call, duration)
+        if method == 'HEAD':
+            self.ready.append((call.position, call.task, 200 <= status < 300, None))
+            return
+        # connection didn't fail, confirm it's live status
+        transport.connection_pool.mark_live(call.connection)
+        if data:
+            data = transport.deserializer.loads(data, headers.get('content-type'))
+        self.ready.append((call.position, call.task, data, None))
+
+
+class AsyncTransport(Transport):
+    """
+    Transport keeping many requests in flight from a single thread.
+
+    Requests given to `perform_requests`, or yielded by the tasks of a
+    :class:`TaskRunner`, are sent over non-blocking sockets of
+    :class:`~elasticsearch.connection.AsyncHttpConnection` connections and
+    advanced by one selector, so hundreds of lookups need neither a thread
+    nor a blocking socket each.
+
+    `perform_request` still works as usual, one request at a time.
+    """
+    def __init__(self, hosts, connection_class=AsyncHttpConnection,
+            max_in_flight=DEFAULT_MAX_IN_FLIGHT, **kwargs):
+        """
+        :arg max_in_flight: number of requests `perform_requests` keeps in
+            flight at once
+
+        Any other argument is passed on to
+        :class:`~elasticsearch.Transport`.
+        """
+        super(AsyncTransport, self).__init__(hosts, connection_class=connection_class, **kwargs)
+        self.max_in_flight = max_in_flight
+
+    def perform_requests(self, requests, max_in_flight=None):
+        """
+        Send many requests concurrently, generate ``(index, data)`` as each
+        one completes, where `index` is the position of the request in
+        `requests` and `data` its deserialized response. The first request
+        that fails for good raises its error.
+
+        :arg requests: iterable of ``(method, url, params, body)`` tuples, it's
+            consumed lazily, only as requests complete
+        :arg max_in_flight: overrides the number of requests in flight
+        """
+        def task(method, url, params, body):
+            yield (yield Request(self, method, url, params=params, body=body))
+
+        runner = TaskRunner((task(*request) for request in requests),
+                            max_in_flight or self.max_in_flight)
+        for index, data in runner:
+            if data is not TASK_DONE:
+                yield index, data
@@ -1,3 +1,4 @@
 from .base import Connection
 from .http_requests import RequestsHttpConnection
 from .http_urllib3 import Urllib3HttpConnection
+from .http_async import AsyncHttpConnection
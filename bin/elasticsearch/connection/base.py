@@ -109,6 +109,17 @@ class Connection(object):
         if response is not None:
             logger.debug('< %s', response)
 
+    def abort_request(self, thread):
+        """
+        Abort the request `thread` is waiting for over this connection, so
+        it fails right away with a :class:`~elasticsearch.ConnectionError`.
+        Returns `False` when there is no such request or the connection
+        doesn't support aborting requests, which is the default.
+
+        :arg thread: the thread that sent the request
+        """
+        return False
+
     def _raise_error(self, status_code, raw_data):
         """ Locate appropriate exception and raise it. """
         error_message = raw_data
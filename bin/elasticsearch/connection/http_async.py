@@ -0,0 +1,418 @@
+import errno
+import socket
+import ssl
+import threading
+import time
+from base64 import b64encode
+
+from urllib3.util.selectors import DefaultSelector, EVENT_READ, EVENT_WRITE
+
+from .base import Connection
+from .http_urllib3 import CA_CERTS, get_ssl_context
+from ..exceptions import ConnectionError, ImproperlyConfigured, ConnectionTimeout, SSLError
+from ..compat import urlencode
+
+# bytes read from a socket at once
+RECV_SIZE = 65536
+
+# socket errors meaning the operation would block
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS, errno.EALREADY)
+
+
+class HttpExchange(object):
+    """
+    A single HTTP/1.1 request and its response on a non-blocking socket.
+
+    Nothing blocks: the exchange says which socket events it waits for
+    (`sock` and `events`) and whoever runs the selector calls
+    `on_ready` when one of them happened, until `done` is set. A keep-alive
+    socket the node closed in the meantime is replaced once, transparently.
+    """
+    def __init__(self, connection, method, url, body, headers, timeout):
+        self.connection = connection
+        self.method = method
+        self.url = url
+        self.body = body
+        self.start = time.time()
+        self.deadline = self.start + timeout
+
+        request = ['%s %s HTTP/1.1' % (method, url), 'Host: %s:%s' % (connection.hostname, connection.port)]
+        for name, value in headers.items():
+            request.append('%s: %s' % (name, value))
+        request.append('Content-Length: %d' % (len(body) if body else 0))
+        request = ('\r\n'.join(request) + '\r\n\r\n').encode('latin-1')
+        self.request = request + body if body else request
+
+        self.done = False
+        self.error = None
+        self.status = None
+        self.headers = None
+        self.data = None
+
+        self.selector = None
+        self.registered = None
+        self.sock = None
+        self.events = None
+        self._connect()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def attach(self, selector):
+        """ Watch the socket of this exchange with `selector`. """
+        self.selector = selector
+        self._watch()
+
+    def detach(self):
+        if self.registered is not None:
+            self.selector.unregister(self.registered)
+            self.registered = None
+
+    def _watch(self):
+        if self.selector is None:
+            return
+        if self.registered is not self.sock:
+            self.detach()
+            if not self.done:
+                self.selector.register(self.sock, self.events, self)
+                self.registered = self.sock
+        elif self.done:
+            self.detach()
+        else:
+            self.selector.modify(self.sock, self.events, self)
+
+    def _connect(self, reuse=True):
+        self.sock, self.reused = self.connection.get_socket(reuse)
+        self.sent = 0
+        self.received = bytearray()
+        self.body_start = None
+        if self.reused:
+            self.step = self._send
+            self.events = EVENT_WRITE
+        else:
+            self.step = self._connected
+            self.events = EVENT_WRITE
+
+    def fail(self, error):
+        self.error = error
+        self.done = True
+        self._watch()
+        self.connection.discard_socket(self.sock)
+
+    def on_ready(self):
+        """ Make progress after a socket event, returns `True` once done. """
+        events = self.events
+        try:
+            self.step()
+        except ssl.SSLError as e:
+            if isinstance(e, ssl.SSLWantReadError):
+                self.events = EVENT_READ
+            elif isinstance(e, ssl.SSLWantWriteError):
+                self.events = EVENT_WRITE
+            else:
+                self.fail(SSLError('N/A', str(e), e))
+                return True
+        except socket.error as e:
+            if e.args and e.args[0] in WOULD_BLOCK:
+                pass
+            elif self.reused and not self.received:
+                # a keep-alive socket closed by the node, try a new one
+                self.connection.discard_socket(self.sock)
+                try:
+                    self._connect(reuse=False)
+                except socket.error as e:
+                    self.fail(ConnectionError('N/A', str(e), e))
+                    return True
+            else:
+                self.fail(ConnectionError('N/A', str(e), e))
+                return True
+        if self.done or self.events != events or self.registered is not self.sock:
+            self._watch()
+        return self.done
+
+    def check_timeout(self, now):
+        if not self.done and now >= self.deadline:
+            self.fail(ConnectionTimeout('TIMEOUT', 'Request timed out after %.3fs' % (now - self.start), None))
+            return True
+        return False
+
+    def _connected(self):
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise socket.error(error, errno.errorcode.get(error, 'connect failed'))
+        if self.connection.ssl_context is not None:
+            self.sock = self.connection.wrap_socket(self.sock)
+            self.step = self._handshake
+            self.step()
+        else:
+            self.step = self._send
+            self.step()
+
+    def _handshake(self):
+        self.sock.do_handshake()
+        self.connection.handshake_done(self.sock)
+        self.step = self._send
+        self.events = EVENT_WRITE
+        self.step()
+
+    def _send(self):
+        while self.sent < len(self.request):
+            self.events = EVENT_WRITE
+            self.sent += self.sock.send(self.request[self.sent:])
+        self.step = self._receive
+        self.events = EVENT_READ
+
+    def _receive(self):
+        while True:
+            chunk = self.sock.recv(RECV_SIZE)
+            if not chunk:
+                self._closed()
+                return
+            self.received += chunk
+            if self._parse():
+                return
+
+    def _closed(self):
+        if self.headers is not None and self.length is None and not self.chunked:
+            # body delimited by the end of the connection
+            self.data = bytes(self.received[self.body_start:])
+            self._finish(keep_alive=False)
+        else:
+            raise socket.error(errno.ECONNRESET, 'Connection closed by the node')
+
+    def _parse(self):
+        """ Parse what was received so far, returns `True` once complete. """
+        received = self.received
+        if self.headers is None:
+            end = received.find(b'\r\n\r\n')
+            if end < 0:
+                return False
+            lines = bytes(received[:end]).decode('latin-1').split('\r\n')
+            version, status = lines[0].split(' ', 2)[:2]
+            self.status = int(status)
+            self.headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                self.headers[name.strip().lower()] = value.strip()
+            self.keep_alive = version == 'HTTP/1.1' and self.headers.get('connection', '').lower() != 'close'
+            self.body_start = self.chunk_start = end + 4
+            self.chunks = []
+            self.chunked = self.headers.get('transfer-encoding', '').lower() == 'chunked'
+            self.length = None
+            if self.method == 'HEAD' or self.status in (204, 304) or 100 <= self.status < 200:
+                self.length = 0
+            elif 'content-length' in self.headers:
+                self.length = int(self.headers['content-length'])
+            elif not self.chunked:
+                self.keep_alive = False
+
+        if self.chunked:
+            return self._parse_chunks()
+        if self.length is not None and len(received) - self.body_start >= self.length:
+            self.data = bytes(received[self.body_start:self.body_start + self.length])
+            self._finish(self.keep_alive)
+            return True
+        return False
+
+    def _parse_chunks(self):
+        received = self.received
+        while True:
+            line_end = received.find(b'\r\n', self.chunk_start)
+            if line_end < 0:
+                return False
+            size = int(bytes(received[self.chunk_start:line_end]).split(b';', 1)[0], 16)
+            if size == 0:
+                # no trailers are sent by elasticsearch, only the final line
+                if len(received) < line_end + 4:
+                    return False
+                self.data = b''.join(self.chunks)
+                self._finish(self.keep_alive)
+                return True
+            end = line_end + 2 + size
+            if len(received) < end + 2:
+                return False
+            self.chunks.append(bytes(received[line_end + 2:end]))
+            self.chunk_start = end + 2
+
+    def _finish(self, keep_alive):
+        self.done = True
+        self._watch()
+        if keep_alive:
+            self.connection.release_socket(self.sock)
+        else:
+            self.connection.discard_socket(self.sock)
+
+
+class AsyncHttpConnection(Connection):
+    """
+    Connection using non-blocking sockets driven by a selector, without any
+    http library. Requests started with `start_request` are advanced by the
+    caller's event loop, which is how
+    :class:`~elasticsearch.AsyncTransport` keeps many of them in flight from
+    a single thread. `perform_request` runs one request to completion, so
+    the connection works with the regular :class:`~elasticsearch.Transport`
+    too.
+
+    :arg host: hostname of the node (default: localhost)
+    :arg port: port to use (integer, default: 9200)
+    :arg url_prefix: optional url prefix for elasticsearch
+    :arg timeout: default timeout in seconds (float, default: 10)
+    :arg http_auth: optional http auth information as either ':' separated
+        string or a tuple
+    :arg use_ssl: use ssl for the connection if `True`
+    :arg verify_certs: whether to verify SSL certificates
+    :arg ca_certs: optional path to CA bundle
+    :arg ssl_context: `ssl.SSLContext` to use instead of creating one
+    :arg maxsize: the number of idle sockets kept open to this host
+    :arg headers: any custom http headers to be add to requests
+    """
+    def __init__(self, host='localhost', port=9200, http_auth=None,
+            use_ssl=False, verify_certs=True, ca_certs=None, ssl_context=None,
+            maxsize=10, headers=None, **kwargs):
+
+        super(AsyncHttpConnection, self).__init__(host=host, port=port, use_ssl=use_ssl, **kwargs)
+        self.hostname = host
+        self.port = port
+        self.headers = {'connection': 'keep-alive'}
+        if http_auth is not None:
+            if isinstance(http_auth, (tuple, list)):
+                http_auth = ':'.join(http_auth)
+            self.headers['authorization'] = 'Basic ' + b64encode(http_auth.encode('utf-8')).decode('ascii')
+        if headers:
+            for k in headers:
+                self.headers[k.lower()] = headers[k]
+        self.headers.setdefault('content-type', 'application/json')
+
+        self.ssl_context = None
+        if self.use_ssl or ssl_context:
+            if ssl_context is None:
+                cafile = CA_CERTS if ca_certs is None else ca_certs
+                if verify_certs and not cafile:
+                    raise ImproperlyConfigured("Root certificates are missing for certificate "
+                        "validation. Either pass them in using the ca_certs parameter or "
+                        "install certifi to use it automatically.")
+                ssl_context = get_ssl_context(cafile, verify_certs)
+            self.ssl_context = ssl_context
+        # last TLS session with this host, resumed by new sockets where the ssl module supports it
+        self.tls_session = None
+        self.tls_handshakes = {'full': 0, 'resumed': 0}
+
+        self.maxsize = maxsize
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def get_socket(self, reuse=True):
+        """ Return an idle keep-alive socket or start connecting a new one, and whether it was reused. """
+        if reuse:
+            with self.lock:
+                if self.idle:
+                    return self.idle.pop(), True
+
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            self.hostname, self.port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        error = sock.connect_ex(address)
+        if error and error not in WOULD_BLOCK:
+            sock.close()
+            raise socket.error(error, errno.errorcode.get(error, 'connect failed'))
+        return sock, False
+
+    def wrap_socket(self, sock):
+        kwargs = {}
+        if self.tls_session is not None:
+            kwargs['session'] = self.tls_session
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.hostname,
+                                            do_handshake_on_connect=False, **kwargs)
+
+    def handshake_done(self, sock):
+        with self.lock:
+            if getattr(sock, 'session_reused', False):
+                self.tls_handshakes['resumed'] += 1
+            else:
+                self.tls_handshakes['full'] += 1
+        self._keep_session(sock)
+
+    def _keep_session(self, sock):
+        # ssl.SSLSession only exists on python 3.6 and later
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            self.tls_session = session
+
+    def release_socket(self, sock):
+        if self.ssl_context is not None:
+            # TLS 1.3 session tickets only arrive after the handshake
+            self._keep_session(sock)
+        with self.lock:
+            if len(self.idle) < self.maxsize:
+                self.idle.append(sock)
+                return
+        sock.close()
+
+    def discard_socket(self, sock):
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+    def start_request(self, method, url, params=None, body=None, timeout=None, headers=None):
+        """
+        Start sending a request, returns the :class:`HttpExchange` to drive
+        with a selector and to pass to `finish_request` once done.
+        """
+        url = self.url_prefix + url
+        if params:
+            url = '%s?%s' % (url, urlencode(params))
+        request_headers = self.headers
+        if headers:
+            request_headers = dict(self.headers)
+            request_headers.update(headers)
+        try:
+            return HttpExchange(self, method, url, body, request_headers, timeout or self.timeout)
+        except socket.error as e:
+            self.log_request_fail(method, self.host + url, url, body, 0, exception=e)
+            raise ConnectionError('N/A', str(e), e)
+
+    def finish_request(self, exchange, ignore=()):
+        """
+        Return ``(status, headers, data)`` of a completed exchange, raising
+        the same errors as the other connections do.
+        """
+        method, url, body = exchange.method, exchange.url, exchange.body
+        full_url = self.host + url
+        duration = time.time() - exchange.start
+        if exchange.error is not None:
+            self.log_request_fail(method, full_url, url, body, duration, exception=exchange.error)
+            raise exchange.error
+
+        raw_data = exchange.data.decode('utf-8')
+        if not (200 <= exchange.status < 300) and exchange.status not in ignore:
+            self.log_request_fail(method, full_url, url, body, duration, exchange.status, raw_data)
+            self._raise_error(exchange.status, raw_data)
+
+        self.log_request_success(method, full_url, url, body, exchange.status, raw_data, duration)
+        return exchange.status, exchange.headers, raw_data
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        exchange = self.start_request(method, url, params, body, timeout, headers)
+        selector = DefaultSelector()
+        try:
+            exchange.attach(selector)
+            while not exchange.done:
+                for key, _ in selector.select(max(0, exchange.deadline - time.time())):
+                    key.data.on_ready()
+                exchange.check_timeout(time.time())
+        finally:
+            exchange.detach()
+            selector.close()
+        return self.finish_request(exchange, ignore)
+
+    def close(self):
+        """
+        Explicitly closes the idle sockets
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for sock in idle:
+            self.discard_socket(sock)
@@ -1,5 +1,7 @@
 import time
 import ssl
+import socket
+import threading
 import urllib3
 from urllib3.exceptions import ReadTimeoutError, SSLError as UrllibSSLError
 import warnings
@@ -29,6 +31,76 @@ def create_ssl_context(**kwargs):
     return ctx
 
 
+# contexts shared by all connections with the same settings, see `get_ssl_context`
+SSL_CONTEXTS = {}
+_ssl_contexts_lock = threading.Lock()
+
+def get_ssl_context(cafile=None, verify_certs=True):
+    """
+    Return the SSL context for connections using the given CA bundle and
+    certificate verification, creating it on first use.
+
+    Loading the CA bundle and setting up a context is expensive, sharing one
+    context between every connection to a cluster does it once per process.
+    """
+    key = (cafile, verify_certs)
+    with _ssl_contexts_lock:
+        ctx = SSL_CONTEXTS.get(key)
+        if ctx is None:
+            ctx = create_ssl_context(cafile=cafile)
+            if not verify_certs:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            SSL_CONTEXTS[key] = ctx
+        return ctx
+
+
+class AbortablePoolMixin(object):
+    """
+    Connection pool remembering the connection every thread is sending its
+    request over, so another thread can `abort` it.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AbortablePoolMixin, self).__init__(*args, **kwargs)
+        self.in_use = {}
+        self.in_use_lock = threading.Lock()
+
+    def _get_conn(self, timeout=None):
+        conn = super(AbortablePoolMixin, self)._get_conn(timeout)
+        with self.in_use_lock:
+            self.in_use[threading.current_thread()] = conn
+        return conn
+
+    def _put_conn(self, conn):
+        # urlopen puts the connection back, or None, once the response is read
+        with self.in_use_lock:
+            self.in_use.pop(threading.current_thread(), None)
+        super(AbortablePoolMixin, self)._put_conn(conn)
+
+    def abort(self, thread):
+        """
+        Shut down the socket `thread` is sending a request over, returns
+        `False` if it isn't sending one.
+        """
+        with self.in_use_lock:
+            sock = getattr(self.in_use.get(thread), 'sock', None)
+            if sock is None:
+                return False
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                return False
+            return True
+
+
+class AbortableHTTPConnectionPool(AbortablePoolMixin, urllib3.HTTPConnectionPool):
+    pass
+
+
+class AbortableHTTPSConnectionPool(AbortablePoolMixin, urllib3.HTTPSConnectionPool):
+    pass
+
+
 class Urllib3HttpConnection(Connection):
     """
     Default connection class using the `urllib3` library and the http protocol.
@@ -76,7 +148,7 @@ class Urllib3HttpConnection(Connection):
                 self.headers[k.lower()] = headers[k]
 
         self.headers.setdefault('content-type', 'application/json')
-        pool_class = urllib3.HTTPConnectionPool
+        pool_class = AbortableHTTPConnectionPool
         kw = {}
 
         # if providing an SSL context, raise error if any other SSL related flag is used
@@ -93,20 +165,19 @@ class Urllib3HttpConnection(Connection):
                     "install certifi to use it automatically.")
             if verify_certs or ca_certs or ssl_version:
                 warnings.warn('Use of `verify_certs`, `ca_certs`, `ssl_version` have been deprecated in favor of using SSLContext`', DeprecationWarning)
-            pool_class = urllib3.HTTPSConnectionPool
+            pool_class = AbortableHTTPSConnectionPool
 
             if not ssl_context:
-                # if SSLContext hasn't been passed in, create one.
+                # if SSLContext hasn't been passed in, use the one shared by
+                # connections with the same settings
                 cafile = CA_CERTS if ca_certs is None else ca_certs
                 # need to skip if sslContext isn't avail
                 try:
-                    ssl_context = create_ssl_context(cafile=cafile)
+                    ssl_context = get_ssl_context(cafile, verify_certs)
                 except AttributeError:
                     ssl_context = None
 
                 if not verify_certs and ssl_context is not None:
-                    ssl_context.check_hostname = False
-                    ssl_context.verify_mode = ssl.CERT_NONE
                     warnings.warn(
                         'Connecting to %s using SSL with verify_certs=False is insecure.' % host)
 
@@ -121,6 +192,9 @@ class Urllib3HttpConnection(Connection):
             })
         self.pool = pool_class(host, port=port, timeout=self.timeout, maxsize=maxsize, **kw)
 
+    def abort_request(self, thread):
+        return self.pool.abort(thread)
+
     def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
         url = self.url_prefix + url
         if params:
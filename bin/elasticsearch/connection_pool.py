@@ -44,6 +44,25 @@ class ConnectionSelector(object):
         """
         pass
 
+    def request_started(self, connection):
+        """
+        Called when a request is about to be sent over the connection.
+
+        :arg connection: the connection that was selected
+        """
+        pass
+
+    def request_finished(self, connection, duration, failed=False):
+        """
+        Called when a request sent over the connection has completed.
+
+        :arg connection: the connection the request was sent over
+        :arg duration: number of seconds the request took
+        :arg failed: `True` if the connection itself failed (as opposed to
+            the node returning an error response)
+        """
+        pass
+
 
 class RandomSelector(ConnectionSelector):
     """
@@ -66,6 +85,76 @@ class RoundRobinSelector(ConnectionSelector):
         self.data.rr %= len(connections)
         return connections[self.data.rr]
 
+
+class EWMASelector(ConnectionSelector):
+    """
+    Latency aware selector. Keeps an exponentially weighted moving average of
+    the request latency and the number of requests in flight for every
+    connection, and selects the connection with the lowest
+    ``latency * (in_flight + 1)`` score. Connections without any latency
+    information (new or just resurrected) are preferred so they get probed.
+    """
+    def __init__(self, opts, decay=0.3):
+        """
+        :arg opts: dictionary of connection instances and their options
+        :arg decay: weight given to the latest latency sample, between 0 and 1
+        """
+        super(EWMASelector, self).__init__(opts)
+        self.decay = decay
+        self.latency = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def _score(self, connection):
+        in_flight = self.in_flight.get(connection, 0)
+        latency = self.latency.get(connection)
+        if latency is None:
+            return (0, in_flight)
+        return (1, latency * (in_flight + 1))
+
+    def select(self, connections):
+        with self.lock:
+            return min(connections, key=self._score)
+
+    def request_started(self, connection):
+        with self.lock:
+            self.in_flight[connection] = self.in_flight.get(connection, 0) + 1
+
+    def request_finished(self, connection, duration, failed=False):
+        with self.lock:
+            self.in_flight[connection] = max(self.in_flight.get(connection, 1) - 1, 0)
+            if failed:
+                # forget the history, the connection will be probed again
+                # once it has been resurrected
+                self.latency.pop(connection, None)
+            elif connection in self.latency:
+                self.latency[connection] += self.decay * (duration - self.latency[connection])
+            else:
+                self.latency[connection] = duration
+
+    def scores(self):
+        """
+        Return the current latency average, in flight count and score of all
+        connections that have been used, keyed by host. Useful for debugging.
+        """
+        with self.lock:
+            return dict(
+                (connection.host, {
+                    'latency': self.latency.get(connection),
+                    'in_flight': self.in_flight.get(connection, 0),
+                    'score': self._score(connection)[1],
+                })
+                for connection in set(self.latency) | set(self.in_flight)
+            )
+
+
+# selectors by the name they can be referred to in configuration
+SELECTORS = {
+    'random': RandomSelector,
+    'round_robin': RoundRobinSelector,
+    'ewma': EWMASelector,
+}
+
 class ConnectionPool(object):
     """
     Container holding the :class:`~elasticsearch.Connection` instances,
@@ -228,6 +317,24 @@ class ConnectionPool(object):
         # only one connection, no need for a selector
         return connections[0]
 
+    def request_started(self, connection):
+        """
+        Inform the selector that a request is being sent over the connection.
+
+        :arg connection: the connection returned by `get_connection`
+        """
+        self.selector.request_started(connection)
+
+    def request_finished(self, connection, duration, failed=False):
+        """
+        Inform the selector that a request sent over the connection completed.
+
+        :arg connection: the connection the request was sent over
+        :arg duration: number of seconds the request took
+        :arg failed: `True` if the connection itself failed
+        """
+        self.selector.request_finished(connection, duration, failed)
+
     def close(self):
         """
         Explicitly closes connections
@@ -256,6 +363,6 @@ class DummyConnectionPool(ConnectionPool):
 
     def _noop(self, *args, **kwargs):
         pass
-    mark_dead = mark_live = resurrect = _noop
+    mark_dead = mark_live = resurrect = request_started = request_finished = _noop
 
 
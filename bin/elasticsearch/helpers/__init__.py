@@ -2,10 +2,12 @@ from __future__ import unicode_literals
 
 import logging
 from operator import methodcaller
+import random
 import time
 
 from ..exceptions import ElasticsearchException, TransportError
 from ..compat import map, string_types, Queue
+from ..async_transport import prepare, run
 
 
 logger = logging.getLogger('elasticsearch.helpers')
@@ -51,10 +53,12 @@ def expand_action(data):
 def _chunk_actions(actions, chunk_size, max_chunk_bytes, serializer):
     """
     Split actions into chunks by number or size, serialize them into strings in
-    the process.
+    the process. ``max_chunk_bytes`` can be a callable returning the size limit,
+    called again for every chunk.
     """
     bulk_actions, bulk_data = [], []
     size, action_count = 0, 0
+    max_bytes = max_chunk_bytes() if callable(max_chunk_bytes) else max_chunk_bytes
     for action, data in actions:
         raw_data, raw_action = data, action
         action = serializer.dumps(action)
@@ -65,10 +69,11 @@ def _chunk_actions(actions, chunk_size, max_chunk_bytes, serializer):
             cur_size += len(data) + 1
 
         # full chunk, send it and start a new one
-        if bulk_actions and (size + cur_size > max_chunk_bytes or action_count == chunk_size):
+        if bulk_actions and (size + cur_size > max_bytes or action_count == chunk_size):
             yield bulk_data, bulk_actions
             bulk_actions, bulk_data = [], []
             size, action_count = 0, 0
+            max_bytes = max_chunk_bytes() if callable(max_chunk_bytes) else max_chunk_bytes
 
         bulk_actions.append(action)
         if data is not None:
@@ -119,6 +124,12 @@ def _process_bulk_chunk(client, bulk_actions, bulk_data, raise_on_exception=True
                 yield False, err
             return
 
+    # rejected items mean the cluster can't keep up, slow down the transport
+    limiter = getattr(client.transport, 'concurrency_limiter', None)
+    if limiter is not None and resp.get('errors') and any(
+            item.get('status') == 429 for i in resp['items'] for item in i.values()):
+        limiter.backoff()
+
     # go through request-reponse pairs and detect failures
     for data, (op_type, item) in zip(bulk_data, map(methodcaller('popitem'), resp['items'])):
         ok = 200 <= item.get('status', 500) < 300
@@ -136,6 +147,55 @@ def _process_bulk_chunk(client, bulk_actions, bulk_data, raise_on_exception=True
     if errors:
         raise BulkIndexError('%i document(s) failed to index.' % len(errors), errors)
 
+def _process_bulk_chunk_with_retries(client, bulk_actions, bulk_data, raise_on_exception=True,
+                                     raise_on_error=True, max_retries=0, initial_backoff=2,
+                                     max_backoff=600, **kwargs):
+    """
+    Send a bulk request like :func:`_process_bulk_chunk`, sending the documents
+    rejected with a ``429`` again up to ``max_retries`` times. Returns the
+    results in the order of the actions, retried ones included.
+    """
+    results = [None] * len(bulk_data)
+    positions = list(range(len(bulk_data)))
+
+    for attempt in range(max_retries + 1):
+        to_retry, to_retry_data, to_retry_positions = [], [], []
+        if attempt:
+            # random wait up to the backoff, spreads out the retries of the
+            # chunks sent at once
+            time.sleep(random.uniform(0, min(max_backoff, initial_backoff * 2**(attempt-1))))
+
+        try:
+            for position, data, (ok, info) in zip(
+                        positions,
+                        bulk_data,
+                        _process_bulk_chunk(client, bulk_actions, bulk_data,
+                                            raise_on_exception,
+                                            raise_on_error, **kwargs)
+                    ):
+                # retry if we get 429 and we are not in the last attempt
+                if not ok and attempt < max_retries \
+                        and list(info.values())[0].get('status') == 429:
+                    # _process_bulk_chunk expects strings so we need to
+                    # re-serialize the data
+                    to_retry.extend(map(client.transport.serializer.dumps, data))
+                    to_retry_data.append(data)
+                    to_retry_positions.append(position)
+                else:
+                    results[position] = ok, info
+
+        except TransportError as e:
+            # suppress 429 errors since we will retry them
+            if attempt == max_retries or e.status_code != 429:
+                raise
+        else:
+            if not to_retry:
+                break
+            # retry only subset of documents that didn't succeed
+            bulk_actions, bulk_data, positions = to_retry, to_retry_data, to_retry_positions
+
+    return results
+
 def streaming_bulk(client, actions, chunk_size=500, max_chunk_bytes=100 * 1024 * 1024,
                    raise_on_error=True, expand_action_callback=expand_action,
                    raise_on_exception=True, max_retries=0, initial_backoff=2,
@@ -150,14 +210,17 @@ def streaming_bulk(client, actions, chunk_size=500, max_chunk_bytes=100 * 1024 *
 
     If you specify ``max_retries`` it will also retry any documents that were
     rejected with a ``429`` status code. To do this it will wait (**by calling
-    time.sleep which will block**) for ``initial_backoff`` seconds and then,
-    every subsequent rejection for the same chunk, for double the time every
-    time up to ``max_backoff`` seconds.
+    time.sleep which will block**) for up to ``initial_backoff`` seconds and
+    then, every subsequent rejection for the same chunk, for up to double the
+    time every time up to ``max_backoff`` seconds. The actual wait is picked at
+    random up to that value. Results keep the order of the actions, retried
+    documents included.
 
     :arg client: instance of :class:`~elasticsearch.Elasticsearch` to use
     :arg actions: iterable containing the actions to be executed
     :arg chunk_size: number of docs in one chunk sent to es (default: 500)
-    :arg max_chunk_bytes: the maximum size of the request in bytes (default: 100MB)
+    :arg max_chunk_bytes: the maximum size of the request in bytes (default: 100MB),
+        or a callable returning it, called before every chunk
     :arg raise_on_error: raise ``BulkIndexError`` containing errors (as `.errors`)
         from the execution of the last chunk when some occur. By default we raise.
     :arg raise_on_exception: if ``False`` then don't propagate exceptions from
@@ -167,8 +230,8 @@ def streaming_bulk(client, actions, chunk_size=500, max_chunk_bytes=100 * 1024 *
         (`None` if data line should be omitted).
     :arg max_retries: maximum number of times a document will be retried when
         ``429`` is received, set to 0 (default) for no retires on ``429``
-    :arg initial_backoff: number of seconds we should wait before the first
-        retry. Any subsequent retries will be powers of ``inittial_backoff *
+    :arg initial_backoff: number of seconds we should wait at most before the
+        first retry. Any subsequent retries will be powers of ``inittial_backoff *
         2**retry_number``
     :arg max_backoff: maximum number of seconds a retry will wait
     :arg yield_ok: if set to False will skip successful documents in the output
@@ -179,45 +242,13 @@ def streaming_bulk(client, actions, chunk_size=500, max_chunk_bytes=100 * 1024 *
                                                   max_chunk_bytes,
                                                   client.transport.serializer):
 
-        for attempt in range(max_retries + 1):
-            to_retry, to_retry_data = [], []
-            if attempt:
-                time.sleep(min(max_backoff, initial_backoff * 2**(attempt-1)))
-
-            try:
-                for data, (ok, info) in zip(
-                            bulk_data,
-                            _process_bulk_chunk(client, bulk_actions, bulk_data,
-                                                raise_on_exception,
-                                                raise_on_error, **kwargs)
-                        ):
-
-                    if not ok:
-                        action, info = info.popitem()
-                        # retry if retries enabled, we get 429, and we are not
-                        # in the last attempt
-                        if max_retries \
-                                and info['status'] == 429 \
-                                and (attempt+1) <= max_retries:
-                            # _process_bulk_chunk expects strings so we need to
-                            # re-serialize the data
-                            to_retry.extend(map(client.transport.serializer.dumps, data))
-                            to_retry_data.append(data)
-                        else:
-                            yield ok, {action: info}
-                    elif yield_ok:
-                        yield ok, info
-
-            except TransportError as e:
-                # suppress 429 errors since we will retry them
-                if not max_retries or e.status_code != 429:
-                    raise
-            else:
-                if not to_retry:
-                    break
-                # retry only subset of documents that didn't succeed
-                bulk_actions, bulk_data = to_retry, to_retry_data
-
+        for ok, info in _process_bulk_chunk_with_retries(client, bulk_actions, bulk_data,
+                                                         raise_on_exception, raise_on_error,
+                                                         max_retries, initial_backoff,
+                                                         max_backoff, **kwargs):
+            if ok and not yield_ok:
+                continue
+            yield ok, info
 
 def bulk(client, actions, stats_only=False, **kwargs):
     """
@@ -275,7 +306,8 @@ def parallel_bulk(client, actions, thread_count=4, chunk_size=500,
     :arg actions: iterator containing the actions
     :arg thread_count: size of the threadpool to use for the bulk requests
     :arg chunk_size: number of docs in one chunk sent to es (default: 500)
-    :arg max_chunk_bytes: the maximum size of the request in bytes (default: 100MB)
+    :arg max_chunk_bytes: the maximum size of the request in bytes (default: 100MB),
+        or a callable returning it, called before every chunk
     :arg raise_on_error: raise ``BulkIndexError`` containing errors (as `.errors`)
         from the execution of the last chunk when some occur. By default we raise.
     :arg raise_on_exception: if ``False`` then don't propagate exceptions from
@@ -285,6 +317,15 @@ def parallel_bulk(client, actions, thread_count=4, chunk_size=500,
         (`None` if data line should be omitted).
     :arg queue_size: size of the task queue between the main thread (producing
         chunks to send) and the processing threads.
+    :arg max_retries: maximum number of times a document will be retried when
+        ``429`` is received, see :func:`~elasticsearch.helpers.streaming_bulk`.
+        The processing thread of the chunk waits between the retries.
+    :arg initial_backoff: number of seconds to wait at most before the first retry
+    :arg max_backoff: maximum number of seconds a retry will wait
+
+    When the client's transport was created with ``adaptive_concurrency`` the
+    number of chunks actually sent at once is bounded by its concurrency
+    limit, which shrinks when the cluster rejects requests or items.
     """
     # Avoid importing multiprocessing unless parallel_bulk is used
     # to avoid exceptions on restricted environments like App Engine
@@ -302,7 +343,7 @@ def parallel_bulk(client, actions, thread_count=4, chunk_size=500,
 
     try:
         for result in pool.imap(
-            lambda bulk_chunk: list(_process_bulk_chunk(client, bulk_chunk[1], bulk_chunk[0], **kwargs)),
+            lambda bulk_chunk: _process_bulk_chunk_with_retries(client, bulk_chunk[1], bulk_chunk[0], **kwargs),
             _chunk_actions(actions, chunk_size, max_chunk_bytes, client.transport.serializer)
             ):
             for item in result:
@@ -353,6 +394,21 @@ def scan(client, query=None, scroll='5m', raise_on_error=True,
             doc_type="books"
         )
 
+    """
+    return run(scan_task(client, query, scroll, raise_on_error, preserve_order,
+                         size, request_timeout, clear_scroll, scroll_kwargs, **kwargs))
+
+def scan_task(client, query=None, scroll='5m', raise_on_error=True,
+              preserve_order=False, size=1000, request_timeout=None, clear_scroll=True,
+              scroll_kwargs=None, **kwargs):
+    """
+    The task behind :func:`scan`, yielding the requests it waits for and the
+    hits, to run many scrolls at once with a
+    :class:`~elasticsearch.async_transport.TaskRunner`. Takes the same
+    arguments as :func:`scan`.
+
+    A scroll the task is closed in the middle of is cleared with a blocking
+    request.
     """
     scroll_kwargs = scroll_kwargs or {}
 
@@ -360,7 +416,7 @@ def scan(client, query=None, scroll='5m', raise_on_error=True,
         query = query.copy() if query else {}
         query["sort"] = "_doc"
     # initial search
-    resp = client.search(body=query, scroll=scroll, size=size,
+    resp = yield prepare(client, 'search', body=query, scroll=scroll, size=size,
                          request_timeout=request_timeout, **kwargs)
 
     scroll_id = resp.get('_scroll_id')
@@ -368,16 +424,7 @@ def scan(client, query=None, scroll='5m', raise_on_error=True,
         return
 
     try:
-        first_run = True
         while True:
-            # if we didn't set search_type to scan initial search contains data
-            if first_run:
-                first_run = False
-            else:
-                resp = client.scroll(scroll_id, scroll=scroll,
-                                     request_timeout=request_timeout,
-                                     **scroll_kwargs)
-
             for hit in resp['hits']['hits']:
                 yield hit
 
@@ -398,6 +445,13 @@ def scan(client, query=None, scroll='5m', raise_on_error=True,
             # end of scroll
             if scroll_id is None or not resp['hits']['hits']:
                 break
+            resp = yield prepare(client, 'scroll', scroll_id, scroll=scroll,
+                                 request_timeout=request_timeout,
+                                 **scroll_kwargs)
+
+        if scroll_id and clear_scroll:
+            yield prepare(client, 'clear_scroll', body={'scroll_id': [scroll_id]}, ignore=(404, ))
+            scroll_id = None
     finally:
         if scroll_id and clear_scroll:
             client.clear_scroll(body={'scroll_id': [scroll_id]}, ignore=(404, ))
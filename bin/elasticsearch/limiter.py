@@ -0,0 +1,119 @@
+import threading
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """
+    Limits the number of requests in flight to the cluster using additive
+    increase, multiplicative decrease (AIMD), the same scheme TCP uses for its
+    congestion window.
+
+    Every completed request grows the limit by roughly one per window of
+    requests. A rejection (``429``) halves it, and a moving average of the
+    latency rising well above the best latency seen shrinks it gently, so
+    the parallelism settles on what the cluster's thread pools can keep up
+    with. The limit is decreased at most once per window, a burst of
+    rejections caused by the same overload only counts once.
+
+    It's shared by all threads using the same
+    :class:`~elasticsearch.Transport`, which acquires a slot for every request
+    it sends, and by the tasks a
+    :class:`~elasticsearch.async_transport.TaskRunner` sends requests for.
+    """
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=32,
+            backoff_ratio=.5, latency_backoff_ratio=.9, latency_tolerance=2.0,
+            smoothing=.2, baseline_drift=.01):
+        """
+        :arg initial_limit: number of requests allowed in flight at start
+        :arg min_limit: the limit never drops below this value
+        :arg max_limit: the limit never grows above this value
+        :arg backoff_ratio: factor applied to the limit on a rejection
+        :arg latency_backoff_ratio: factor applied to the limit when the
+            latency is rising
+        :arg latency_tolerance: latency is considered rising when its moving
+            average exceeds the baseline latency by this factor
+        :arg smoothing: weight of the latest sample in the latency average
+        :arg baseline_drift: rate at which the baseline latency follows higher
+            latencies, allowing it to recover from an unusually fast sample
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self.backoff_ratio = backoff_ratio
+        self.latency_backoff_ratio = latency_backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        self.baseline_drift = baseline_drift
+
+        self.in_flight = 0
+        # completions since the last decrease
+        self.completed = int(self.limit)
+        self.latency = None
+        self.baseline = None
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Block until a request can be sent without exceeding the limit.
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def try_acquire(self):
+        """
+        Take a slot if a request can be sent without exceeding the limit,
+        returns `False` without waiting otherwise.
+        """
+        with self.condition:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, duration=None, rejected=False):
+        """
+        Return the slot taken by `acquire` or `try_acquire` and adjust the
+        limit.
+
+        :arg duration: number of seconds the request took, `None` if the
+            request failed without a meaningful latency
+        :arg rejected: `True` if the cluster rejected the request
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.completed += 1
+            if rejected:
+                self._decrease(self.backoff_ratio)
+            elif duration is not None:
+                self._update(duration)
+            self.condition.notify_all()
+
+    def backoff(self):
+        """
+        Shrink the limit after a rejection reported outside of the request
+        status, like rejected items in a bulk response.
+        """
+        with self.condition:
+            self._decrease(self.backoff_ratio)
+
+    def _decrease(self, ratio):
+        if self.completed < self.limit:
+            return
+        self.completed = 0
+        self.limit = max(float(self.min_limit), self.limit * ratio)
+
+    def _update(self, duration):
+        if self.latency is None:
+            self.latency = self.baseline = duration
+        else:
+            self.latency += self.smoothing * (duration - self.latency)
+            if duration < self.baseline:
+                self.baseline = duration
+            else:
+                self.baseline += self.baseline_drift * (duration - self.baseline)
+
+        if self.latency > self.baseline * self.latency_tolerance:
+            self._decrease(self.latency_backoff_ratio)
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
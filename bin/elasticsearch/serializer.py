@@ -2,6 +2,7 @@ try:
     import simplejson as json
 except ImportError:
     import json
+import re
 import uuid
 from datetime import date, datetime
 from decimal import Decimal
@@ -9,6 +10,84 @@ from decimal import Decimal
 from .exceptions import SerializationError, ImproperlyConfigured
 from .compat import string_types
 
+class JSONCodec(object):
+    """
+    JSON implementation used by :class:`JSONSerializer`, wrapping a module
+    with the interface of the standard library ``json`` module.
+    """
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+
+    def loads(self, s, object_pairs_hook=None):
+        if object_pairs_hook is None:
+            return self.module.loads(s)
+        return self.module.loads(s, object_pairs_hook=object_pairs_hook)
+
+    def dumps(self, data, default):
+        return self.module.dumps(data, default=default, ensure_ascii=False)
+
+    def decoder(self, object_pairs_hook=None):
+        """ Decoder exposing ``raw_decode`` """
+        return self.module.JSONDecoder(object_pairs_hook=object_pairs_hook)
+
+class UltraJSONCodec(JSONCodec):
+    """
+    Decodes with ``ujson``. It has no hooks for object pairs, doesn't decode
+    into a caller given position and encodes unknown types its own way, so
+    these fall back to the standard library.
+    """
+    def __init__(self, name, module, fallback):
+        super(UltraJSONCodec, self).__init__(name, module)
+        self.fallback = fallback
+
+    def loads(self, s, object_pairs_hook=None):
+        if object_pairs_hook is None:
+            return self.module.loads(s)
+        return self.fallback.loads(s, object_pairs_hook)
+
+    def dumps(self, data, default):
+        return self.fallback.dumps(data, default)
+
+    def decoder(self, object_pairs_hook=None):
+        return self.fallback.decoder(object_pairs_hook)
+
+# available codecs by name, the standard library one is always there
+JSON_CODECS = {}
+# order in which ``auto`` picks a codec, fastest first
+CODEC_PREFERENCE = ('ujson', 'simplejson', 'json')
+# codec used unless configured otherwise
+DEFAULT_CODEC = 'simplejson' if json.__name__ == 'simplejson' else 'json'
+
+def register_codec(codec):
+    JSON_CODECS[codec.name] = codec
+
+def get_codec(name=None):
+    """
+    Return the codec registered under `name`, the default codec if `name` is
+    ``None`` or the first available in `CODEC_PREFERENCE` for ``auto``.
+    """
+    if name is None:
+        name = DEFAULT_CODEC
+    elif name == 'auto':
+        name = next(n for n in CODEC_PREFERENCE if n in JSON_CODECS)
+    try:
+        return JSON_CODECS[name]
+    except KeyError:
+        raise ImproperlyConfigured('JSON codec %s is not available, expected one of %s' % (
+            name, ', '.join(sorted(JSON_CODECS))))
+
+import json as _stdlib_json
+register_codec(JSONCodec('json', _stdlib_json))
+if json is not _stdlib_json:
+    register_codec(JSONCodec('simplejson', json))
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    register_codec(UltraJSONCodec('ujson', ujson, JSON_CODECS[DEFAULT_CODEC]))
+
 class TextSerializer(object):
     mimetype = 'text/plain'
 
@@ -21,9 +100,27 @@ class TextSerializer(object):
 
         raise SerializationError('Cannot serialize %r into text.' % data)
 
+# key under which each search hit holds its original JSON text
+RAW_HIT = '_raw_hit'
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
 class JSONSerializer(object):
     mimetype = 'application/json'
 
+    def __init__(self, intern_keys=False, raw_hits=False, codec=None):
+        """
+        :arg codec: name of the JSON codec to use, see `get_codec`
+        :arg intern_keys: decode object keys through a table shared by the
+            whole document, so keys repeated across objects (like the field
+            names of every hit in a search response) are stored only once
+        :arg raw_hits: store the JSON text each search hit was decoded from
+            under the ``_raw_hit`` key of the hit, saves encoding it again
+        """
+        self.intern_keys = intern_keys
+        self.raw_hits = raw_hits
+        self.codec = get_codec(codec)
+
     def default(self, data):
         if isinstance(data, (date, datetime)):
             return data.isoformat()
@@ -35,17 +132,93 @@ class JSONSerializer(object):
 
     def loads(self, s):
         try:
-            return json.loads(s)
-        except (ValueError, TypeError) as e:
+            if self.raw_hits:
+                return self._loads_raw_hits(s)
+            if self.intern_keys:
+                return self.codec.loads(s, self._interning_hook())
+            return self.codec.loads(s)
+        except (ValueError, TypeError, IndexError) as e:
             raise SerializationError(s, e)
 
+    def _loads_raw_hits(self, s):
+        if self.intern_keys:
+            decoder = self.codec.decoder(self._interning_hook())
+        else:
+            decoder = self.codec.decoder()
+        obj, end = self._walk(s, WHITESPACE.match(s).end(), decoder.raw_decode, ('hits', 'hits'))
+        if WHITESPACE.match(s, end).end() != len(s):
+            raise ValueError('Extra data at %d' % end)
+        return obj
+
+    def _walk(self, s, idx, decode, path):
+        """
+        Decode the JSON value starting at ``s[idx]`` while descending into
+        the objects along ``path``, the array at the end of it holds the hits.
+        Returns the value and the index right after it.
+        """
+        if not path:
+            return self._walk_hits(s, idx, decode)
+        if s[idx] != '{':
+            return decode(s, idx)
+
+        result = {}
+        idx = WHITESPACE.match(s, idx + 1).end()
+        if s[idx] == '}':
+            return result, idx + 1
+        while True:
+            key, idx = decode(s, idx)
+            idx = WHITESPACE.match(s, idx).end()
+            if s[idx] != ':':
+                raise ValueError('Expecting : delimiter at %d' % idx)
+            idx = WHITESPACE.match(s, idx + 1).end()
+            if key == path[0]:
+                result[key], idx = self._walk(s, idx, decode, path[1:])
+            else:
+                result[key], idx = decode(s, idx)
+            idx = WHITESPACE.match(s, idx).end()
+            if s[idx] == '}':
+                return result, idx + 1
+            if s[idx] != ',':
+                raise ValueError('Expecting , delimiter at %d' % idx)
+            idx = WHITESPACE.match(s, idx + 1).end()
+
+    @staticmethod
+    def _walk_hits(s, idx, decode):
+        if s[idx] != '[':
+            return decode(s, idx)
+
+        hits = []
+        idx = WHITESPACE.match(s, idx + 1).end()
+        if s[idx] == ']':
+            return hits, idx + 1
+        while True:
+            hit, end = decode(s, idx)
+            if isinstance(hit, dict):
+                hit[RAW_HIT] = s[idx:end]
+            hits.append(hit)
+            idx = WHITESPACE.match(s, end).end()
+            if s[idx] == ']':
+                return hits, idx + 1
+            if s[idx] != ',':
+                raise ValueError('Expecting , delimiter at %d' % idx)
+            idx = WHITESPACE.match(s, idx + 1).end()
+
+    @staticmethod
+    def _interning_hook():
+        # one table per document, it is dropped along with the decoder state
+        intern_key = {}.setdefault
+
+        def hook(pairs):
+            return dict([(intern_key(key, key), value) for key, value in pairs])
+        return hook
+
     def dumps(self, data):
         # don't serialize strings
         if isinstance(data, string_types):
             return data
 
         try:
-            return json.dumps(data, default=self.default, ensure_ascii=False)
+            return self.codec.dumps(data, self.default)
         except (ValueError, TypeError) as e:
             raise SerializationError(data, e)
 
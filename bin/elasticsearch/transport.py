@@ -1,12 +1,26 @@
 import time
-from itertools import chain
+import heapq
+import logging
+import random
+import threading
+from collections import deque
+from itertools import chain, count
 
 from .connection import Urllib3HttpConnection
 from .connection_pool import ConnectionPool, DummyConnectionPool
+from .limiter import AdaptiveConcurrencyLimiter
 from .serializer import JSONSerializer, Deserializer, DEFAULT_SERIALIZERS
 from .exceptions import ConnectionError, TransportError, SerializationError, \
                         ConnectionTimeout, ImproperlyConfigured
 
+logger = logging.getLogger('elasticsearch')
+
+# idempotent read endpoints that can safely be sent to more than one node
+HEDGED_ENDPOINTS = ('_search', '_count', '_msearch', '_field_caps')
+
+# number of latency samples needed before the hedge delay is derived from them
+HEDGE_MIN_SAMPLES = 20
+
 
 def get_host_info(node_info, host):
     """
@@ -27,6 +41,55 @@ def get_host_info(node_info, host):
         return None
     return host
 
+class HedgeTimer(object):
+    """
+    Calls functions once their delay expired, unless cancelled before, from
+    a single daemon thread shared by all the requests of a transport, so a
+    request that completes in time never needs a thread of its own.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.entries = []
+        self.sequence = count()
+        self.thread = None
+
+    def schedule(self, delay, func):
+        """
+        Call `func` after `delay` seconds, returns the entry to `cancel`.
+        """
+        entry = [time.time() + delay, next(self.sequence), func]
+        with self.condition:
+            heapq.heappush(self.entries, entry)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self.condition:
+            entry[2] = None
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    # cancelled entries are dropped once they're the next one
+                    while self.entries and self.entries[0][2] is None:
+                        heapq.heappop(self.entries)
+                    now = time.time()
+                    if self.entries and self.entries[0][0] <= now:
+                        func = heapq.heappop(self.entries)[2]
+                        break
+                    self.condition.wait(self.entries[0][0] - now if self.entries else None)
+            # the thread is shared by every request, one failing hedge must
+            # not stop the others
+            try:
+                func()
+            except Exception:
+                logger.exception('Hedge function %r failed.', func)
+
 class Transport(object):
     """
     Encapsulation of transport-related to logic. Handles instantiation of the
@@ -39,7 +102,10 @@ class Transport(object):
         sniff_on_start=False, sniffer_timeout=None, sniff_timeout=.1,
         sniff_on_connection_fail=False, serializer=JSONSerializer(), serializers=None,
         default_mimetype='application/json', max_retries=3, retry_on_status=(502, 503, 504, ),
-        retry_on_timeout=False, send_get_body_as='GET', **kwargs):
+        retry_on_timeout=False, send_get_body_as='GET', hedge_requests=False,
+        hedge_percentile=95, hedge_delay=.5, adaptive_concurrency=False,
+        max_concurrency=32, rejection_backoff=.5, max_rejection_backoff=30,
+        **kwargs):
         """
         :arg hosts: list of dictionaries, each containing keyword arguments to
             create a `connection_class` instance
@@ -72,6 +138,24 @@ class Transport(object):
             don't support passing bodies with GET requests. If you set this to
             'POST' a POST method will be used instead, if to 'source' then the body
             will be serialized and passed as a query parameter `source`.
+        :arg hedge_requests: if no response to a read request (search, count,
+            msearch, field_caps) arrived after the hedge delay, send the same
+            request to another node and use whichever response comes first
+            (default `False`). Searches opening a scroll aren't hedged, the
+            slower one would leave a scroll context behind.
+        :arg hedge_percentile: percentile of the recent read latencies used
+            as the hedge delay, defaults to `95`
+        :arg hedge_delay: hedge delay in seconds used until enough latency
+            samples have been collected
+        :arg adaptive_concurrency: limit the number of requests in flight with
+            an :class:`~elasticsearch.limiter.AdaptiveConcurrencyLimiter` and
+            retry requests rejected with a ``429`` (default `False`)
+        :arg max_concurrency: upper bound for the adaptive concurrency limit
+        :arg rejection_backoff: number of seconds the first retry of a
+            rejected request waits at most, doubled on every retry. The actual
+            wait is picked at random up to that value.
+        :arg max_rejection_backoff: maximum number of seconds a retry of a
+            rejected request waits
 
         Any extra keyword arguments will be passed to the `connection_class`
         when creating and instance unless overridden by that connection's
@@ -93,6 +177,20 @@ class Transport(object):
         self.retry_on_status = retry_on_status
         self.send_get_body_as = send_get_body_as
 
+        # request hedging config
+        self.hedge_requests = hedge_requests
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.hedge_latencies = deque(maxlen=200)
+        self.hedge_timer = HedgeTimer() if hedge_requests else None
+
+        # concurrency control config
+        self.concurrency_limiter = None
+        if adaptive_concurrency:
+            self.concurrency_limiter = AdaptiveConcurrencyLimiter(max_limit=max_concurrency)
+        self.rejection_backoff = rejection_backoff
+        self.max_rejection_backoff = max_rejection_backoff
+
         # data serializer
         self.serializer = serializer
 
@@ -255,26 +353,150 @@ class Transport(object):
         if self.sniff_on_connection_fail:
             self.sniff_hosts()
 
-    def perform_request(self, method, url, headers=None, params=None, body=None):
+    def _perform_request_on(self, connection, method, url, params, body, headers, ignore, timeout, aborted=None):
         """
-        Perform the actual request. Retrieve a connection from the connection
-        pool, pass all the information to it's perform_request method and
-        return the data.
+        Send the request over the given connection, reporting its duration
+        back to the connection pool so latency aware selectors can use it,
+        and to the concurrency limiter if there is one.
 
-        If an exception was raised, mark the connection as failed and retry (up
-        to `max_retries` times).
+        `aborted` is set when a faster hedged request aborted this one, the
+        connection failing then is only a slow latency sample.
+        """
+        limiter = self.concurrency_limiter
+        if limiter is not None:
+            limiter.acquire()
+        self.connection_pool.request_started(connection)
+        start = time.time()
+        failed, rejected = True, False
+        try:
+            response = connection.perform_request(method, url, params, body, headers=headers, ignore=ignore, timeout=timeout)
+            failed = False
+            return response
+        except TransportError as e:
+            # an error response from the node is still a valid latency sample
+            failed = isinstance(e, ConnectionError) and not (aborted is not None and aborted.is_set())
+            rejected = e.status_code == 429
+            raise
+        finally:
+            duration = time.time() - start
+            self.connection_pool.request_finished(connection, duration, failed)
+            if limiter is not None:
+                limiter.release(None if failed else duration, rejected)
 
-        If the operation was succesful and the connection used was previously
-        marked as dead, mark it as live, resetting it's failure count.
+    def _get_rejection_backoff(self, attempt):
+        """
+        Number of seconds to wait before retrying a rejected request, random
+        up to an exponentially growing cap to spread out the retries of
+        concurrent requests.
+        """
+        return random.uniform(0, min(self.max_rejection_backoff, self.rejection_backoff * 2 ** attempt))
 
-        :arg method: HTTP method to use
-        :arg url: absolute url (without host) to target
-        :arg headers: dictionary of headers, will be handed over to the
-            underlying :class:`~elasticsearch.Connection` class
-        :arg params: dictionary of query parameters, will be handed over to the
-            underlying :class:`~elasticsearch.Connection` class for serialization
-        :arg body: body of the request, will be serializes using serializer and
-            passed to the connection
+    def _should_hedge(self, method, url, params):
+        if not self.hedge_requests or method == 'HEAD':
+            return False
+        # a duplicate opening a scroll would leak its scroll context
+        if params and 'scroll' in params:
+            return False
+        return url.rstrip('/').rsplit('/', 1)[-1] in HEDGED_ENDPOINTS
+
+    def _get_hedge_delay(self):
+        """
+        Number of seconds to wait for a read request before hedging it, the
+        configured percentile of the recent read latencies.
+        """
+        latencies = sorted(self.hedge_latencies)
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return self.hedge_delay
+        index = int(len(latencies) * self.hedge_percentile / 100.0)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def _get_hedge_connection(self, connection):
+        """
+        Select a live connection other than `connection`, or `None` if the
+        pool doesn't have one.
+        """
+        others = [c for c in self.connection_pool.connections if c is not connection]
+        if len(others) < 2:
+            return others[0] if others else None
+        return self.connection_pool.selector.select(others)
+
+    def _perform_hedged_request(self, connection, method, url, params, body, headers, ignore, timeout):
+        """
+        Send the request over `connection` from the calling thread and, when
+        it hasn't completed within the hedge delay, send a duplicate over
+        another connection from a new thread. Returns the connection that
+        responded first and its response.
+
+        A duplicate responding first aborts the original request, when the
+        connection doesn't support that the original is waited for and its
+        response ignored. A slower duplicate is left to complete in the
+        background. When both fail the error of the original is raised.
+        """
+        caller = threading.current_thread()
+        condition = threading.Condition()
+        # set once the duplicate responded before the original
+        aborted = threading.Event()
+        original = {'done': False}
+        duplicate = {}
+
+        def _send(conn):
+            try:
+                response, error = self._perform_request_on(conn, method, url, params, body, headers, ignore, timeout), None
+            except Exception as e:
+                response, error = None, e
+            with condition:
+                duplicate.update(response=response, error=error, done=True)
+                if error is None and not original['done']:
+                    aborted.set()
+                    # under the lock, so the calling thread can't have moved
+                    # on to another request over the same connection
+                    connection.abort_request(caller)
+                condition.notify_all()
+
+        def _hedge():
+            conn = self._get_hedge_connection(connection)
+            with condition:
+                if conn is None or original['done']:
+                    return
+                duplicate['connection'] = conn
+            thread = threading.Thread(target=_send, args=(conn, ))
+            thread.daemon = True
+            try:
+                thread.start()
+            except Exception as e:
+                # without a duplicate in flight the caller must not wait for it
+                with condition:
+                    duplicate.update(response=None, error=e, done=True)
+                    condition.notify_all()
+                raise
+
+        start = time.time()
+        timer = self.hedge_timer.schedule(self._get_hedge_delay(), _hedge)
+        try:
+            response, error = self._perform_request_on(connection, method, url, params, body, headers, ignore, timeout, aborted), None
+        except TransportError as e:
+            response, error = None, e
+        finally:
+            self.hedge_timer.cancel(timer)
+            with condition:
+                original['done'] = True
+
+        with condition:
+            # a failure is only final once the duplicate failed too
+            while error is not None and 'connection' in duplicate and not duplicate.get('done'):
+                condition.wait()
+        if duplicate.get('done') and duplicate['error'] is None and (aborted.is_set() or error is not None):
+            connection, response = duplicate['connection'], duplicate['response']
+        elif error is not None:
+            raise error
+
+        self.hedge_latencies.append(time.time() - start)
+        return connection, response
+
+    def _prepare_request(self, method, params, body):
+        """
+        Serialize the body and take the transport level parameters out of
+        `params`, returns ``(method, params, body, ignore, timeout)``.
         """
         if body is not None:
             body = self.serializer.dumps(body)
@@ -307,25 +529,64 @@ class Transport(object):
             if isinstance(ignore, int):
                 ignore = (ignore, )
 
+        return method, params, body, ignore, timeout
+
+    def _should_retry(self, e):
+        """
+        Whether a request that failed with `e` is retried on another node,
+        the node it failed on is marked as dead if so.
+        """
+        if isinstance(e, ConnectionTimeout):
+            return self.retry_on_timeout
+        elif isinstance(e, ConnectionError):
+            return True
+        return e.status_code in self.retry_on_status
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        """
+        Perform the actual request. Retrieve a connection from the connection
+        pool, pass all the information to it's perform_request method and
+        return the data.
+
+        If an exception was raised, mark the connection as failed and retry (up
+        to `max_retries` times).
+
+        If the operation was succesful and the connection used was previously
+        marked as dead, mark it as live, resetting it's failure count.
+
+        :arg method: HTTP method to use
+        :arg url: absolute url (without host) to target
+        :arg headers: dictionary of headers, will be handed over to the
+            underlying :class:`~elasticsearch.Connection` class
+        :arg params: dictionary of query parameters, will be handed over to the
+            underlying :class:`~elasticsearch.Connection` class for serialization
+        :arg body: body of the request, will be serializes using serializer and
+            passed to the connection
+        """
+        method, params, body, ignore, timeout = self._prepare_request(method, params, body)
+        hedge = self._should_hedge(method, url, params)
+
         for attempt in range(self.max_retries + 1):
             connection = self.get_connection()
 
             try:
-                status, headers, data = connection.perform_request(method, url, params, body, headers=headers, ignore=ignore, timeout=timeout)
+                if hedge:
+                    connection, (status, headers, data) = self._perform_hedged_request(connection, method, url, params, body, headers, ignore, timeout)
+                else:
+                    status, headers, data = self._perform_request_on(connection, method, url, params, body, headers, ignore, timeout)
 
             except TransportError as e:
                 if method == 'HEAD' and e.status_code == 404:
                     return False
 
-                retry = False
-                if isinstance(e, ConnectionTimeout):
-                    retry = self.retry_on_timeout
-                elif isinstance(e, ConnectionError):
-                    retry = True
-                elif e.status_code in self.retry_on_status:
-                    retry = True
+                if e.status_code == 429 and self.concurrency_limiter is not None:
+                    # the node is overloaded rather than dead, back off and retry
+                    if attempt == self.max_retries:
+                        raise
+                    time.sleep(self._get_rejection_backoff(attempt))
+                    continue
 
-                if retry:
+                if self._should_retry(e):
                     # only mark as dead if we are retrying
                     self.mark_dead(connection)
                     # raise exception on last retry
@@ -9,12 +9,23 @@ import re
 import sys
 import json
 import time
+import heapq
 import calendar
+import threading
+from Queue import Queue
+from collections import deque
 from datetime import datetime
 from pprint import pprint
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch, helpers, Transport, AsyncTransport
+from elasticsearch.async_transport import TaskRunner, TASK_DONE, prepare, run
+from elasticsearch.connection_pool import SELECTORS
+from elasticsearch.serializer import JSONSerializer, RAW_HIT, JSON_CODECS, CODEC_PREFERENCE, \
+    DEFAULT_CODEC, get_codec
+from elasticsplunk_catalog import IndexCatalog, catalog_path, DEFAULT_TTL
+from elasticsplunk_query import compile_query, DEFAULT_TIME_ROUNDING, \
+    ORDERS, ORDER_ASC, ORDER_DESC, ORDER_NONE
 from splunklib.searchcommands import \
-    dispatch, GeneratingCommand, Configuration, Option, validators
+    dispatch, GeneratingCommand, Configuration, Option, validators, RecordSchema, SchemaRecord
 
 
 # Time units for relative time conversion
@@ -35,12 +46,18 @@ KEY_ELASTIC_SOURCE = "_source"
 ACTION_SEARCH = "search"
 ACTION_INDICES_LIST = "indices-list"
 ACTION_CLUSTER_HEALTH = "cluster-health"
+ACTION_CODEC_BENCHMARK = "codec-benchmark"
+
+# Search response pages decoded by each codec and number of timed rounds
+BENCHMARK_PAGES = 10
+BENCHMARK_ROUNDS = 3
 
 # Config keys
 KEY_CONFIG_EADDR = "hosts"
 KEY_CONFIG_TIMESTAMP = "tsfield"
 KEY_CONFIG_USE_SSL = "use_ssl"
 KEY_CONFIG_VERIFY_CERTS = "verify_certs"
+KEY_CONFIG_SELECTOR = "selector"
 KEY_CONFIG_FIELDS = "fields"
 KEY_CONFIG_EXCLUDE_FIELDS = "exclude_fields"
 KEY_CONFIG_SOURCE_TYPE = "stype"
@@ -55,25 +72,51 @@ KEY_CONFIG_QUERY = "query"
 KEY_CONFIG_NO_TIMESTAMP = "no_timestamp"
 KEY_CONFIG_CONVERT_TIMESTAMP = "convert_timestamp"
 KEY_CONFIG_GET_MAPPING = "get_mapping"
+KEY_CONFIG_PRUNE_INDICES = "prune_indices"
+KEY_CONFIG_CATALOG_TTL = "catalog_ttl"
+KEY_CONFIG_TIME_ROUNDING = "time_rounding"
+KEY_CONFIG_EXPLAIN_QUERY = "explain_query"
+KEY_CONFIG_ORDER = "order"
+KEY_CONFIG_INTERN_KEYS = "intern_keys"
+KEY_CONFIG_JSON_CODEC = "json_codec"
+KEY_CONFIG_ASYNC_TRANSPORT = "async_transport"
+
+# include_raw value producing only _raw, without a field per source field
+INCLUDE_RAW_ONLY = "only"
+
+# Config keys passed as is to the transport
+KEYS_CONFIG_TRANSPORT = ("hedge_requests", "hedge_percentile", "hedge_delay",
+                         "adaptive_concurrency", "max_concurrency", "max_retries")
 
 # Splunk keys
 KEY_SPLUNK_TIMESTAMP = "_time"
 KEY_SPLUNK_EARLIEST = "startTime"
 KEY_SPLUNK_LATEST = "endTime"
 KEY_SPLUNK_RAW = "_raw"
+KEY_SPLUNK_CLUSTER = "es_cluster"
 
 # Default time range
 DEFAULT_EARLIEST = "now-24h"
 DEFAULT_LATEST = "now"
 
+# Default connection selector
+DEFAULT_SELECTOR = "round_robin"
+
+# Max length of a pruned index list, longer lists don't fit in the request URL
+MAX_INDEX_LIST_LENGTH = 3000
+
+# Max number of events buffered per cluster when searching multiple clusters
+CLUSTER_QUEUE_SIZE = 1000
+
 @Configuration()
 class ElasticSplunk(GeneratingCommand):
     """ElasticSplunk custom search command"""
 
-    action = Option(require=False, default=ACTION_SEARCH, doc="[search,indices-list,cluster-health")
-    eaddr = Option(require=False, default="127.0.0.1 9200", doc="server:port,server:port or config item")
+    action = Option(require=False, default=ACTION_SEARCH, doc="[search,indices-list,cluster-health,codec-benchmark]")
+    eaddr = Option(require=False, default="127.0.0.1 9200", doc="server:port,server:port, config item or config item,config item")
     index = Option(require=False, default=None, doc="Index to search")
     scan = Option(require=False, default=False, doc="Perform a scan search")
+    order = Option(require=False, default=None, doc="Sort order on tsfield [asc,desc,none], none is fastest, default asc or none with scan")
     stype = Option(require=False, default=None, doc="Source/doc_type")
     tsfield = Option(require=False, default="@timestamp", doc="Field holding the event timestamp")
     query = Option(require=False, default="*", doc="Query string in ES DSL")
@@ -81,17 +124,27 @@ class ElasticSplunk(GeneratingCommand):
     exclude_fields = Option(require=False, default=None, doc="Exclude selected fields")
     limit = Option(require=False, default=10000, doc="Max number of hits")
     include_es = Option(require=False, default=False, doc="Include Elasticsearch relevant fields")
-    include_raw = Option(require=False, default=False, doc="Include event source")
+    include_raw = Option(require=False, default=False, doc="Include event source as _raw, only to skip the other fields")
     use_ssl = Option(require=False, default=None, doc="Use SSL")
     verify_certs = Option(require=False, default=None, doc="Verify SSL Certificates")
     no_timestamp = Option(require=False, default=False, doc="Elastic data has no timestamps, generate dummy")
     convert_timestamp = Option(require=False, default=True, doc="Convert timestamps from text to unix timestamp")
     get_mapping = Option(require=False, default=False, doc="Get elasticsearch mapping and generate blank line with all fields")
+    prune_indices = Option(require=False, default=None, doc="Only search indices holding events within the time range")
+    time_rounding = Option(require=False, default=None, doc="Round now relative time ranges to this many seconds, 0 to disable")
+    explain_query = Option(require=False, default=False, doc="Show the generated search body")
+    intern_keys = Option(require=False, default=None, doc="Share field name strings across decoded hits")
     earliest = Option(require=False, default=None,
                       doc="Earliest event, format relative eg. now-4h or 2016-11-18T23:45:00")
     latest = Option(require=False, default=None,
                     doc="Latest event, format 2016-11-17T23:45:00")
 
+    def prepare(self):
+        """Tell Splunk when the generated events are in descending time order"""
+        if self.action == ACTION_SEARCH and self.order == ORDER_DESC \
+                and self.no_timestamp not in [True, "true", "True", 1, "y"]:
+            self.configuration.generates_timeorder = True
+
     @staticmethod
     def parse_dates(time_value):
         """Parse relative dates if specified"""
@@ -125,23 +178,37 @@ class ElasticSplunk(GeneratingCommand):
         dt = datetime.strptime(timestring, "%Y-%m-%dT%H:%M:%S.%fZ")
         return str(calendar.timegm(dt.timetuple())) + "." + str(dt.microsecond)
 
-    def _get_search_config(self):
-        """Parse and configure search parameters"""
-
-        # Load default configs if available
+    @staticmethod
+    def _load_config():
+        """Load default configs if available"""
         app_path = os.path.dirname(os.path.abspath(__file__)) + "/.."
         local_config = "{0}/local/elasticsplunk.json".format(app_path)
         if os.path.isfile(local_config):
             config_file = open(local_config)
-            config = json.load(config_file)
-        else:
-            config = {}
+            return json.load(config_file)
+        return {}
+
+    def _get_clusters(self):
+        """Return the config items to search when eaddr lists more than one, otherwise None"""
+        names = self.eaddr.split(",")
+        if len(names) < 2:
+            return None
+        config = self._load_config()
+        if all(name in config for name in names):
+            return names
+        return None
+
+    def _get_search_config(self, eaddr=None):
+        """Parse and configure search parameters"""
+
+        eaddr = self.eaddr if eaddr is None else eaddr
+        config = self._load_config()
 
         # Load eaddr stored config
-        if self.eaddr in config:
-            config = config[self.eaddr]
+        if eaddr in config:
+            config = config[eaddr]
         else:
-            config[KEY_CONFIG_EADDR] = self.eaddr.split(",")
+            config[KEY_CONFIG_EADDR] = eaddr.split(",")
 
         if KEY_CONFIG_TIMESTAMP not in config:
             config[KEY_CONFIG_TIMESTAMP] = self.tsfield
@@ -160,6 +227,22 @@ class ElasticSplunk(GeneratingCommand):
         elif KEY_CONFIG_VERIFY_CERTS not in config:
             config[KEY_CONFIG_VERIFY_CERTS] = False
 
+        # Connection selection strategy
+        if KEY_CONFIG_SELECTOR not in config:
+            config[KEY_CONFIG_SELECTOR] = DEFAULT_SELECTOR
+        if config[KEY_CONFIG_SELECTOR] not in SELECTORS:
+            raise Exception("Unknown selector {0}, expected one of {1}".format(
+                config[KEY_CONFIG_SELECTOR], ",".join(sorted(SELECTORS))))
+
+        # JSON codec, checked here so a missing one fails before searching
+        if KEY_CONFIG_JSON_CODEC in config:
+            get_codec(config[KEY_CONFIG_JSON_CODEC])
+        else:
+            config[KEY_CONFIG_JSON_CODEC] = None
+
+        # Non-blocking transport, from the stored config
+        config[KEY_CONFIG_ASYNC_TRANSPORT] = True if config.get(KEY_CONFIG_ASYNC_TRANSPORT) in [True, "true", "True", 1, "y"] else False
+
         # Fields to fetch
         if self.fields:
             config[KEY_CONFIG_FIELDS] = self.fields.split(",")
@@ -177,12 +260,16 @@ class ElasticSplunk(GeneratingCommand):
         # source type
         config[KEY_CONFIG_SOURCE_TYPE] = self.stype.split(",") if self.stype else None
 
+        # Only time ranges relative to now are rounded, explicit times are kept as is
+        relative_latest = False
         if self.latest:
             config[KEY_CONFIG_LATEST] = self.parse_dates(self.latest)
+            relative_latest = self.latest == DEFAULT_LATEST
         elif hasattr(self.search_results_info, KEY_SPLUNK_LATEST):
             config[KEY_CONFIG_LATEST] = int(self.search_results_info.endTime)
         else:
             config[KEY_CONFIG_LATEST] = self.parse_dates(DEFAULT_LATEST)
+            relative_latest = True
 
         if self.earliest:
             config[KEY_CONFIG_EARLIEST] = config[KEY_CONFIG_LATEST] - self.parse_dates(self.earliest)
@@ -192,45 +279,77 @@ class ElasticSplunk(GeneratingCommand):
             config[KEY_CONFIG_EARLIEST] = config[KEY_CONFIG_LATEST] - self.parse_dates(DEFAULT_EARLIEST)
 
         config[KEY_CONFIG_SCAN] = True if self.scan in [True, "true", "True", 1, "y"] else False
+        # Scans are cheapest in index order, only sorted when asked for
+        if self.order is None:
+            config[KEY_CONFIG_ORDER] = ORDER_NONE if config[KEY_CONFIG_SCAN] else ORDER_ASC
+        elif self.order in ORDERS:
+            config[KEY_CONFIG_ORDER] = self.order
+        else:
+            raise Exception("Unknown order {0}, expected one of {1}".format(self.order, ",".join(ORDERS)))
         config[KEY_CONFIG_INDEX] = self.index
         config[KEY_CONFIG_INCLUDE_ES] = self.include_es
-        config[KEY_CONFIG_INCLUDE_RAW] = self.include_raw
+        if self.include_raw == INCLUDE_RAW_ONLY:
+            config[KEY_CONFIG_INCLUDE_RAW] = INCLUDE_RAW_ONLY
+        else:
+            config[KEY_CONFIG_INCLUDE_RAW] = True if self.include_raw in [True, "true", "True", 1, "y"] else False
         config[KEY_CONFIG_LIMIT] = self.limit
         config[KEY_CONFIG_QUERY] = self.query
         config[KEY_CONFIG_NO_TIMESTAMP] = True if self.no_timestamp in [True, "true", "True", 1, "y"] else False
         config[KEY_CONFIG_CONVERT_TIMESTAMP] = True if self.convert_timestamp in [True, "true", "True", 1, "y"] else False
         config[KEY_CONFIG_GET_MAPPING] = True if self.get_mapping in [True, "true", "True", 1, "y"] else False
 
+        # Index pruning, from the option or the stored config
+        if self.prune_indices != None:
+            config[KEY_CONFIG_PRUNE_INDICES] = True if self.prune_indices in [True, "true", "True", 1, "y"] else False
+        elif KEY_CONFIG_PRUNE_INDICES not in config:
+            config[KEY_CONFIG_PRUNE_INDICES] = False
+        if KEY_CONFIG_CATALOG_TTL not in config:
+            config[KEY_CONFIG_CATALOG_TTL] = DEFAULT_TTL
+
+        if not relative_latest:
+            config[KEY_CONFIG_TIME_ROUNDING] = 0
+        elif self.time_rounding != None:
+            config[KEY_CONFIG_TIME_ROUNDING] = int(self.time_rounding)
+        elif KEY_CONFIG_TIME_ROUNDING not in config:
+            config[KEY_CONFIG_TIME_ROUNDING] = DEFAULT_TIME_ROUNDING
+        config[KEY_CONFIG_EXPLAIN_QUERY] = True if self.explain_query in [True, "true", "True", 1, "y"] else False
+
+        # Key interning, from the option or the stored config
+        if self.intern_keys != None:
+            config[KEY_CONFIG_INTERN_KEYS] = True if self.intern_keys in [True, "true", "True", 1, "y"] else False
+        elif KEY_CONFIG_INTERN_KEYS not in config:
+            config[KEY_CONFIG_INTERN_KEYS] = False
+
         return config
 
 
-    def _parse_hit(self, config, hit, all_fields):
-        """Parse a Elasticsearch Hit"""
+    def _parse_hit(self, config, hit, schema, padded):
+        """Parse a Elasticsearch Hit into a record of schema, padded records have every field of schema set"""
 
-        event = {}
+        event = SchemaRecord(schema, None) if padded else SchemaRecord(schema)
+        source = hit[KEY_ELASTIC_SOURCE]
         if config[KEY_CONFIG_NO_TIMESTAMP]:
             event[KEY_SPLUNK_TIMESTAMP] = time.time()
         elif config[KEY_CONFIG_CONVERT_TIMESTAMP]:
-            event[KEY_SPLUNK_TIMESTAMP] = self.to_epoch(hit[KEY_ELASTIC_SOURCE][config[KEY_CONFIG_TIMESTAMP]])
+            event[KEY_SPLUNK_TIMESTAMP] = self.to_epoch(source[config[KEY_CONFIG_TIMESTAMP]])
         else:
-            event[KEY_SPLUNK_TIMESTAMP] = hit[KEY_ELASTIC_SOURCE][config[KEY_CONFIG_TIMESTAMP]]
-        for key in hit[KEY_ELASTIC_SOURCE]:
-            if key != config[KEY_CONFIG_TIMESTAMP]:
-                if isinstance(hit[KEY_ELASTIC_SOURCE][key], dict):
-                    event.update(_flattern(key, hit[KEY_ELASTIC_SOURCE][key]))
-                else:
-                    event[key] = hit[KEY_ELASTIC_SOURCE][key]
+            event[KEY_SPLUNK_TIMESTAMP] = source[config[KEY_CONFIG_TIMESTAMP]]
+        if config[KEY_CONFIG_INCLUDE_RAW] != INCLUDE_RAW_ONLY:
+            for key in source:
+                if key != config[KEY_CONFIG_TIMESTAMP]:
+                    if isinstance(source[key], dict):
+                        event.update(_flattern(key, source[key]))
+                    else:
+                        event[key] = source[key]
 
         if config[KEY_CONFIG_INCLUDE_ES]:
             for key in KEYS_ELASTIC:
                 event["es{0}".format(key)] = hit[key]
 
         if config[KEY_CONFIG_INCLUDE_RAW]:
-            event[KEY_SPLUNK_RAW] = json.dumps(hit)
-
-        for field in all_fields:
-            if not field in event:
-                event[field] = None
+            # the serializer keeps the text the hit was decoded from
+            raw = hit.get(RAW_HIT)
+            event[KEY_SPLUNK_RAW] = raw if raw is not None else json.dumps(hit)
 
         return event
 
@@ -258,8 +377,34 @@ class ElasticSplunk(GeneratingCommand):
         status[KEY_SPLUNK_TIMESTAMP] = int(time.time())
         yield status
 
-    def _search(self, esclient, config):
-        """Search Generate events to Splunk from a Elasticsearch search"""
+    def _prune_indices(self, esclient, config):
+        """Narrow the searched indices down to those that can hold events in the time range
+
+        Returns False when no index can hold matching events.
+        """
+        catalog = IndexCatalog(esclient, config[KEY_CONFIG_TIMESTAMP],
+                               catalog_path(config[KEY_CONFIG_EADDR], config[KEY_CONFIG_TIMESTAMP]),
+                               config[KEY_CONFIG_CATALOG_TTL])
+        indices = catalog.prune(config[KEY_CONFIG_INDEX] or "*",
+                                config[KEY_CONFIG_EARLIEST], config[KEY_CONFIG_LATEST])
+        if not indices:
+            return False
+
+        index_list = ",".join(indices)
+        if len(index_list) <= MAX_INDEX_LIST_LENGTH:
+            self.logger.debug("Pruned index %s to %s", config[KEY_CONFIG_INDEX], index_list)
+            config[KEY_CONFIG_INDEX] = index_list
+        return True
+
+    def _prepare_search(self, esclient, config, fieldnames=()):
+        """Prune the indices and build the schema and body of a search
+
+        Returns (schema, padded, body), or None when no index can hold matching events.
+        """
+
+        if config[KEY_CONFIG_PRUNE_INDICES] and not config[KEY_CONFIG_NO_TIMESTAMP]:
+            if not self._prune_indices(esclient, config):
+                return None
 
         all_fields = []
         if config[KEY_CONFIG_GET_MAPPING]:
@@ -270,70 +415,249 @@ class ElasticSplunk(GeneratingCommand):
                 for field in fields:
                         all_fields.append(field)
 
+        # Events share one schema, the record writer encodes them straight from their slots
+        schema = RecordSchema([KEY_SPLUNK_TIMESTAMP] + list(fieldnames) + all_fields)
+        padded = bool(all_fields)
+
         # Search body
         # query-string-syntax
         # www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
         if config[KEY_CONFIG_NO_TIMESTAMP]:
-            body = {
-                "query": {
-                    "query_string" : {
-                        "query" : config[KEY_CONFIG_QUERY],
-                    }
-                }
-            }
+            body = compile_query(config[KEY_CONFIG_QUERY])
         else:
-            body = {
-                "sort":[{config[KEY_CONFIG_TIMESTAMP]:{"order": "asc"}}],
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"range": {
-                                config[KEY_CONFIG_TIMESTAMP]: {
-                                    "gte": config[KEY_CONFIG_EARLIEST],
-                                    "lte": config[KEY_CONFIG_LATEST],
-                                    "format": "epoch_second",
-                                }
-                            }},
-                            {"query_string" : {
-                                "query" : config[KEY_CONFIG_QUERY],
-                            }}
-                        ]
-                    }
-                }
-            }
+            body = compile_query(config[KEY_CONFIG_QUERY],
+                                 tsfield=config[KEY_CONFIG_TIMESTAMP],
+                                 earliest=config[KEY_CONFIG_EARLIEST],
+                                 latest=config[KEY_CONFIG_LATEST],
+                                 order=config[KEY_CONFIG_ORDER],
+                                 rounding=config[KEY_CONFIG_TIME_ROUNDING])
+
+        if config[KEY_CONFIG_EXPLAIN_QUERY]:
+            self.write_info("Search body for index {0}: {1}", config[KEY_CONFIG_INDEX], json.dumps(body))
+
+        return schema, padded, body
+
+    @staticmethod
+    def _search_task(esclient, config, body):
+        """Task generating the hits of a search body, see elasticsearch.async_transport"""
 
-        # Execute search
         if config[KEY_CONFIG_SCAN]:
-            res = helpers.scan(esclient,
-                               size=config[KEY_CONFIG_LIMIT],
-                               index=config[KEY_CONFIG_INDEX],
-                               _source_include=config[KEY_CONFIG_FIELDS],
-                               _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
-                               doc_type=config[KEY_CONFIG_SOURCE_TYPE],
-                               query=body)
-            for hit in res:
-                yield self._parse_hit(config, hit, all_fields)
-        else:
-            res = esclient.search(index=config[KEY_CONFIG_INDEX],
+            return helpers.scan_task(esclient,
+                                     size=config[KEY_CONFIG_LIMIT],
+                                     index=config[KEY_CONFIG_INDEX],
+                                     _source_include=config[KEY_CONFIG_FIELDS],
+                                     _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
+                                     doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                                     preserve_order=config[KEY_CONFIG_ORDER] != ORDER_NONE,
+                                     query=body)
+        return _hits_task(prepare(esclient, "search",
+                                  index=config[KEY_CONFIG_INDEX],
                                   size=config[KEY_CONFIG_LIMIT],
                                   _source_include=config[KEY_CONFIG_FIELDS],
                                   _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
                                   doc_type=config[KEY_CONFIG_SOURCE_TYPE],
-                                  body=body)
-            for hit in res['hits']['hits']:
-                yield self._parse_hit(config, hit, all_fields)
+                                  body=body))
+
+    def _log_connections(self, esclient, config):
+        """Log the connection statistics of a client for debugging"""
+
+        # Latency aware selectors expose their view of the nodes for debugging
+        selector = getattr(esclient.transport.connection_pool, "selector", None)
+        if hasattr(selector, "scores"):
+            self.logger.debug("Connection scores: %s", json.dumps(selector.scores()))
+
+        # Full versus resumed TLS handshakes per node, only counted by the async connections
+        if config[KEY_CONFIG_USE_SSL]:
+            pool = esclient.transport.connection_pool
+            handshakes = dict((connection.host, connection.tls_handshakes)
+                              for connection in getattr(pool, "orig_connections", pool.connections)
+                              if getattr(connection, "tls_handshakes", None) is not None)
+            if handshakes:
+                self.logger.debug("TLS handshakes: %s", json.dumps(handshakes))
+
+    def _search(self, esclient, config):
+        """Search Generate events to Splunk from a Elasticsearch search"""
+
+        search = self._prepare_search(esclient, config)
+        if search is None:
+            return
+        schema, padded, body = search
+        for hit in run(self._search_task(esclient, config, body)):
+            yield self._parse_hit(config, hit, schema, padded)
+        self._log_connections(esclient, config)
+
+    @staticmethod
+    def _feed_cluster(hits, queue):
+        """Pass the hits of a cluster search through queue"""
+        try:
+            for hit in hits:
+                queue.put((None, hit))
+        except Exception as error:
+            queue.put((error, None))
+        queue.put((None, None))
+
+    @staticmethod
+    def _drain_cluster(queue):
+        """Yield the hits of a cluster search from its queue"""
+        while True:
+            error, hit = queue.get()
+            if error is not None:
+                raise error
+            if hit is None:
+                return
+            yield hit
+
+    @staticmethod
+    def _drain_runner(runner, events, buffers, done, position):
+        """Yield the hits of the cluster search at position, run by runner with the others
+
+        Hits of the other clusters met meanwhile are kept in their buffers, a
+        cluster is paused while its buffer is full.
+        """
+        buffer = buffers[position]
+        while True:
+            while not buffer:
+                if position in done:
+                    return
+                other, hit = next(events)
+                if hit is TASK_DONE:
+                    done.add(other)
+                    continue
+                buffers[other].append(hit)
+                if len(buffers[other]) >= CLUSTER_QUEUE_SIZE:
+                    runner.pause(other)
+            hit = buffer.popleft()
+            runner.resume(position)
+            yield hit
+
+    @staticmethod
+    def _merge_keys(hits, position, config):
+        """Yield (key, position, sequence, hit) for the hits of a cluster, sortable across clusters
+
+        Hits sorted on tsfield are merged on their raw sort value, which is the
+        same for every timestamp format. Unsorted hits are interleaved as they arrive.
+        """
+        sorted_hits = not config[KEY_CONFIG_NO_TIMESTAMP] and config[KEY_CONFIG_ORDER] != ORDER_NONE
+        direction = -1 if config[KEY_CONFIG_ORDER] == ORDER_DESC else 1
+        for sequence, hit in enumerate(hits):
+            key = direction * hit["sort"][0] if sorted_hits else sequence
+            yield key, position, sequence, hit
+
+    def _search_clusters(self, clusters):
+        """Search multiple clusters concurrently and merge their events in time order
+
+        Searches are prepared and their hits parsed on this thread, so messages
+        and schemas are never touched concurrently. When every cluster uses the
+        async transport their requests are all driven from this thread too,
+        otherwise every cluster is searched by a thread of its own.
+        """
+
+        searches = []
+        for name in clusters:
+            config = self._get_search_config(name)
+            esclient = self._create_client(config)
+            search = self._prepare_search(esclient, config, [KEY_SPLUNK_CLUSTER])
+            if search is not None:
+                searches.append((name, config, esclient, search))
+        tasks = [self._search_task(esclient, config, search[2]) for _, config, esclient, search in searches]
+
+        runner = events = None
+        if all(isinstance(esclient.transport, AsyncTransport) for _, _, esclient, _ in searches):
+            runner = TaskRunner(tasks)
+            events = iter(runner)
+            buffers = [deque() for _ in tasks]
+            done = set()
+            hits = [self._drain_runner(runner, events, buffers, done, position) for position in range(len(tasks))]
+        else:
+            hits = []
+            for task in tasks:
+                queue = Queue(CLUSTER_QUEUE_SIZE)
+                thread = threading.Thread(target=self._feed_cluster, args=(run(task), queue))
+                thread.daemon = True
+                thread.start()
+                hits.append(self._drain_cluster(queue))
+
+        try:
+            drains = [self._merge_keys(cluster_hits, position, searches[position][1])
+                      for position, cluster_hits in enumerate(hits)]
+            for _, position, _, hit in heapq.merge(*drains):
+                name, config, _, (schema, padded, _) = searches[position]
+                event = self._parse_hit(config, hit, schema, padded)
+                event[KEY_SPLUNK_CLUSTER] = name
+                yield event
+        finally:
+            if events is not None:
+                events.close()
+
+    @staticmethod
+    def _create_client(config, serializer_class=JSONSerializer):
+        """Create Elasticsearch client"""
+        return Elasticsearch(
+            config[KEY_CONFIG_EADDR],
+            verify_certs=config[KEY_CONFIG_VERIFY_CERTS],
+            use_ssl=config[KEY_CONFIG_USE_SSL],
+            selector_class=SELECTORS[config[KEY_CONFIG_SELECTOR]],
+            transport_class=AsyncTransport if config[KEY_CONFIG_ASYNC_TRANSPORT] else Transport,
+            serializer=serializer_class(intern_keys=config[KEY_CONFIG_INTERN_KEYS],
+                                        raw_hits=bool(config[KEY_CONFIG_INCLUDE_RAW]),
+                                        codec=config[KEY_CONFIG_JSON_CODEC]),
+            **dict((key, config[key]) for key in KEYS_CONFIG_TRANSPORT if key in config))
+
+    def _benchmark_codecs(self, config):
+        """Time every available JSON codec decoding response pages of the search"""
+
+        esclient = self._create_client(config, CapturingSerializer)
+        events = self._search(esclient, config)
+        for _ in events:
+            if len(esclient.transport.serializer.pages) >= BENCHMARK_PAGES:
+                break
+        events.close()
+
+        pages = [page for page in esclient.transport.serializer.pages if '"hits"' in page]
+        if not pages:
+            raise Exception("The search returned no pages to benchmark with")
+        size = sum(len(page.encode("utf-8")) for page in pages)
+        expected = [get_codec("json").loads(page) for page in pages]
+
+        for name in CODEC_PREFERENCE:
+            if name not in JSON_CODECS:
+                continue
+            codec = JSON_CODECS[name]
+            best = None
+            for _ in range(BENCHMARK_ROUNDS):
+                start = time.time()
+                decoded = [codec.loads(page) for page in pages]
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+            yield {
+                KEY_SPLUNK_TIMESTAMP: time.time(),
+                "codec": name,
+                "default": name == DEFAULT_CODEC,
+                "pages": len(pages),
+                "bytes": size,
+                "seconds": round(best, 6),
+                "mb_per_second": round(size / 1048576.0 / best, 2) if best else None,
+                "identical": decoded == expected,
+            }
 
     def generate(self):
         """Generate events to Splunk"""
 
+        # Search several configured clusters at once
+        clusters = self._get_clusters()
+        if clusters:
+            if self.action != ACTION_SEARCH:
+                raise Exception("Only action={0} supports multiple clusters in eaddr".format(ACTION_SEARCH))
+            return self._search_clusters(clusters)
+
         # Get config
         config = self._get_search_config()
 
+        if self.action == ACTION_CODEC_BENCHMARK:
+            return self._benchmark_codecs(config)
+
         # Create Elasticsearch client
-        esclient = Elasticsearch(
-            config[KEY_CONFIG_EADDR],
-            verify_certs=config[KEY_CONFIG_VERIFY_CERTS],
-            use_ssl=config[KEY_CONFIG_USE_SSL])
+        esclient = self._create_client(config)
 
         if self.action == ACTION_SEARCH:
             return self._search(esclient, config)
@@ -342,14 +666,49 @@ class ElasticSplunk(GeneratingCommand):
         if self.action == ACTION_CLUSTER_HEALTH:
             return self._cluster_health(esclient)
 
+class CapturingSerializer(JSONSerializer):
+    """JSON serializer keeping the text of every response it decodes"""
+
+    def __init__(self, **kwargs):
+        super(CapturingSerializer, self).__init__(**kwargs)
+        self.pages = []
+
+    def loads(self, s):
+        self.pages.append(s)
+        return super(CapturingSerializer, self).loads(s)
+
+def _hits_task(request):
+    """Task generating the hits of a search request"""
+    res = yield request
+    for hit in res['hits']['hits']:
+        yield hit
+
+# Dotted names built by _flattern, by parent key and child key, so every event
+# reuses the same name strings
+DOTTED_NAMES = {}
+MAX_DOTTED_NAMES = 10000
+
+def _dotted_name(key, inkey):
+    names = DOTTED_NAMES.get(key)
+    if names is None:
+        if len(DOTTED_NAMES) >= MAX_DOTTED_NAMES:
+            return key+"."+inkey
+        names = DOTTED_NAMES[key] = {}
+    name = names.get(inkey)
+    if name is None:
+        name = key+"."+inkey
+        if len(names) < MAX_DOTTED_NAMES:
+            names[inkey] = name
+    return name
+
 def _flattern(key, data):
     result = {}
     for inkey in data:
         if isinstance(data[inkey], dict):
             for inkey2, value in _flattern(inkey, data[inkey]).items():
-                result[key+"."+inkey2] = value
+                result[_dotted_name(key, inkey2)] = value
         else:
-            result[key+"."+inkey] = data[inkey]
+            result[_dotted_name(key, inkey)] = data[inkey]
     return result
 
 # Find all occurrences of a key in nested python dictionaries and lists
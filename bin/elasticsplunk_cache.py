@@ -0,0 +1,89 @@
+# vim: set fileencoding=utf-8:
+# ElasticSplunk correlation cache
+# Least recently used cache of the parsed documents correlating with a key,
+# streams piped into esscorrelate repeat the same values many times
+#
+
+import threading
+from collections import OrderedDict
+
+# Default max number of cached keys
+DEFAULT_MAX_ENTRIES = 10000
+
+# Default max size of the cached documents in bytes
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Estimated size of a field that isn't text, and of every key and document
+VALUE_BYTES = 16
+
+
+def events_size(events):
+    """Estimated size in bytes of a list of parsed documents"""
+    size = VALUE_BYTES
+    for event in events:
+        size += VALUE_BYTES
+        for key, value in event.iteritems():
+            size += len(key) + VALUE_BYTES
+            if isinstance(value, basestring):
+                size += len(value)
+            elif isinstance(value, list):
+                size += sum(len(v) if isinstance(v, basestring) else VALUE_BYTES for v in value)
+    return size
+
+
+class ResultCache(object):
+    """Parsed documents by key, evicting the least recently used keys when
+    more than max_entries keys or max_bytes bytes are cached, safe to share
+    between threads"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, cache_misses=False):
+        """
+        :param cache_misses: also cache keys without documents, saves searching
+            again for values that never correlate
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_misses = cache_misses
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Return the documents cached for key, or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            # most recently used keys are kept at the end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, events):
+        """Cache the documents of key, unless they are larger than the whole cache"""
+        if not events and not self.cache_misses:
+            return
+        size = events_size(events)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (events, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
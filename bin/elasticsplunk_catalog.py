@@ -0,0 +1,164 @@
+# vim: set fileencoding=utf-8:
+# ElasticSplunk index catalog
+# Cached min/max event timestamp per index, used to only search the indices
+# that can contain events within the searched time range
+#
+
+import os
+import re
+import json
+import time
+import hashlib
+import calendar
+import tempfile
+from datetime import datetime
+
+# Seconds after which the range of an index that is still written to is refreshed
+DEFAULT_TTL = 300
+
+# Events in a date named index may fall outside the date by this many seconds
+NAME_SLACK = 86400
+
+# Max number of indices aggregated per refresh request, keeps the URL short
+REFRESH_CHUNK = 100
+
+# Date suffixes of index names, e.g. logs-2017.11.18.13, logs-2017-11-18 or logs-2017.11
+DATE_PATTERNS = (
+    (re.compile(r"(\d{4})[.\-_](\d{2})[.\-_](\d{2})[.\-_](\d{2})$"), 3600),
+    (re.compile(r"(\d{4})[.\-_]?(\d{2})[.\-_]?(\d{2})$"), 86400),
+    (re.compile(r"(\d{4})[.\-_](\d{2})$"), None),
+)
+
+
+def name_range(name):
+    """Return the (start, end) epoch range of the period in a date named index, or None"""
+    for pattern, length in DATE_PATTERNS:
+        match = pattern.search(name)
+        if not match:
+            continue
+        parts = [int(part) for part in match.groups()]
+        try:
+            if length is None:
+                # monthly index, ends where the next month starts
+                year, month = parts
+                start = calendar.timegm(datetime(year, month, 1).timetuple())
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+                return start, calendar.timegm((year, month, 1, 0, 0, 0))
+            if len(parts) == 3:
+                parts.append(0)
+            # datetime rejects days the month doesn't have, timegm rolls them over
+            start = calendar.timegm(datetime(*parts).timetuple())
+            return start, start + length
+        except (ValueError, OverflowError):
+            return None
+    return None
+
+
+def catalog_path(hosts, tsfield):
+    """Location of the catalog file for a cluster and timestamp field"""
+    app_path = os.path.dirname(os.path.abspath(__file__)) + "/.."
+    key = hashlib.md5(json.dumps([sorted(hosts), tsfield])).hexdigest()
+    return "{0}/local/catalog/{1}.json".format(app_path, key)
+
+
+class IndexCatalog(object):
+    """Catalog of the min/max timestamp of each index, cached on disk
+
+    Ranges are computed with min/max aggregations on the timestamp field and
+    only for indices missing from the catalog or whose range may have changed:
+    indices named after a date are sealed once that period is over, all other
+    indices are refreshed every ttl seconds and treated as open ended since
+    they may receive newer events in the meantime.
+    """
+
+    def __init__(self, esclient, tsfield, path, ttl=DEFAULT_TTL):
+        self.esclient = esclient
+        self.tsfield = tsfield
+        self.path = path
+        self.ttl = ttl
+        self.indices = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as catalog_file:
+                return json.load(catalog_file)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write to a temporary file first so concurrent searches never read a partial catalog
+        handle, temp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "w") as catalog_file:
+            json.dump(self.indices, catalog_file)
+        os.rename(temp_path, self.path)
+
+    def _resolve(self, pattern):
+        """Concrete names of the indices matching an index pattern"""
+        rows = self.esclient.cat.indices(index=pattern, h="index", format="json")
+        return [row["index"] for row in rows]
+
+    @staticmethod
+    def _is_sealed(name, entry):
+        period = name_range(name)
+        return period is not None and period[1] + NAME_SLACK < entry["checked"]
+
+    def _is_stale(self, name, now):
+        entry = self.indices.get(name)
+        if entry is None:
+            return True
+        return not self._is_sealed(name, entry) and entry["checked"] + self.ttl < now
+
+    def refresh(self, names):
+        """Compute the range of the given indices that are missing or stale"""
+        now = time.time()
+        stale = [name for name in names if self._is_stale(name, now)]
+
+        for offset in range(0, len(stale), REFRESH_CHUNK):
+            chunk = stale[offset:offset + REFRESH_CHUNK]
+            res = self.esclient.search(index=chunk, size=0, ignore_unavailable=True, body={
+                "aggs": {
+                    "indices": {
+                        "terms": {"field": "_index", "size": len(chunk)},
+                        "aggs": {
+                            "min": {"min": {"field": self.tsfield}},
+                            "max": {"max": {"field": self.tsfield}},
+                        }
+                    }
+                }
+            })
+            ranges = {}
+            for bucket in res["aggregations"]["indices"]["buckets"]:
+                ranges[bucket["key"]] = (bucket["min"]["value"], bucket["max"]["value"])
+            for name in chunk:
+                low, high = ranges.get(name, (None, None))
+                self.indices[name] = {
+                    "min": low / 1000.0 if low is not None else None,
+                    "max": high / 1000.0 if high is not None else None,
+                    "checked": now,
+                }
+
+        if stale:
+            self._save()
+
+    def _overlaps(self, name, earliest, latest):
+        entry = self.indices[name]
+        if entry["min"] is None:
+            # no timestamped events when last checked, only skip it for good once sealed
+            return not self._is_sealed(name, entry)
+        if self._is_sealed(name, entry):
+            return entry["min"] <= latest and entry["max"] >= earliest
+        return entry["min"] <= latest
+
+    def prune(self, pattern, earliest, latest):
+        """Return the names of the indices matching pattern that may hold events between earliest and latest"""
+        candidates = []
+        for name in self._resolve(pattern):
+            period = name_range(name)
+            if period is None or (period[0] - NAME_SLACK <= latest and period[1] + NAME_SLACK >= earliest):
+                candidates.append(name)
+
+        self.refresh(candidates)
+        return [name for name in candidates if self._overlaps(name, earliest, latest)]
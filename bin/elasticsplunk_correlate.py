@@ -10,11 +10,20 @@ import sys
 import re
 import time
 import json
+import math
 import calendar
+import threading
+from Queue import Queue
+from collections import OrderedDict, deque
 from datetime import datetime
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch, helpers, Transport, AsyncTransport
+from elasticsearch.async_transport import TaskRunner, TASK_DONE, Request, prepare, run
+from elasticsearch.connection_pool import SELECTORS
+from elasticsearch.serializer import JSONSerializer, get_codec
+from elasticsplunk_query import compile_query, ORDER_ASC, ORDER_DESC
+from elasticsplunk_cache import ResultCache, DEFAULT_MAX_ENTRIES, DEFAULT_MAX_BYTES, events_size
 from splunklib.searchcommands import \
-    dispatch, StreamingCommand, Configuration, Option, validators
+    dispatch, StreamingCommand, Configuration, Option, validators, SearchMetric
 
 # Time units for relative time conversion
 UNITS = {
@@ -36,6 +45,9 @@ KEY_CONFIG_EADDR = "hosts"
 KEY_CONFIG_TIMESTAMP = "tsfield"
 KEY_CONFIG_USE_SSL = "use_ssl"
 KEY_CONFIG_VERIFY_CERTS = "verify_certs"
+KEY_CONFIG_SELECTOR = "selector"
+KEY_CONFIG_JSON_CODEC = "json_codec"
+KEY_CONFIG_ASYNC_TRANSPORT = "async_transport"
 KEY_CONFIG_FIELDS = "fields"
 KEY_CONFIG_EXCLUDE_FIELDS = "exclude_fields"
 KEY_CONFIG_SOURCE_TYPE = "stype"
@@ -51,6 +63,20 @@ KEY_CONFIG_NO_TIMESTAMP = "no_timestamp"
 KEY_CONFIG_CONVERT_TIMESTAMP = "convert_timestamp"
 KEY_CONFIG_RETURN_MV = "return_mv"
 KEY_CONFIG_MATCH_ANY = "match_any"
+KEY_CONFIG_BATCH_SIZE = "batch_size"
+KEY_CONFIG_JOIN_MODE = "join_mode"
+KEY_CONFIG_CACHE_ENTRIES = "cache_entries"
+KEY_CONFIG_CACHE_BYTES = "cache_bytes"
+KEY_CONFIG_CACHE_MISSES = "cache_misses"
+KEY_CONFIG_CONCURRENCY = "concurrency"
+KEY_CONFIG_PRELOAD = "preload"
+KEY_CONFIG_PRELOAD_BYTES = "preload_bytes"
+KEY_CONFIG_WINDOW = "window"
+KEY_CONFIG_TOP = "top"
+
+# Config keys passed as is to the transport
+KEYS_CONFIG_TRANSPORT = ("hedge_requests", "hedge_percentile", "hedge_delay",
+                         "adaptive_concurrency", "max_concurrency", "max_retries")
 
 # Splunk keys
 KEY_SPLUNK_TIMESTAMP = "_time"
@@ -62,6 +88,29 @@ KEY_SPLUNK_RAW = "_raw"
 DEFAULT_EARLIEST = "now-24h"
 DEFAULT_LATEST = "now"
 
+# Default connection selector
+DEFAULT_SELECTOR = "round_robin"
+
+# Default number of records searched with a single msearch request
+DEFAULT_BATCH_SIZE = 100
+
+# Min number of idle connections kept per node, raised to the concurrency
+MIN_CONNECTIONS = 10
+
+# Default max size in bytes of the documents loaded with preload
+DEFAULT_PRELOAD_BYTES = 256 * 1024 * 1024
+
+# Max number of hits a single search can return with the index defaults
+MAX_RESULT_WINDOW = 10000
+
+# Name of the inner hits holding the latest documents of a collapsed value
+TOP_HITS = "top"
+
+# Join modes, a search per record or a terms query per batch joined locally
+JOIN_SEARCH = "search"
+JOIN_TERMS = "terms"
+JOIN_MODES = (JOIN_SEARCH, JOIN_TERMS)
+
 
 @Configuration()
 class ElasticSplunkCorrelate(StreamingCommand):
@@ -71,6 +120,17 @@ class ElasticSplunkCorrelate(StreamingCommand):
     eaddr = Option(require=False, default="127.0.0.1 9200", doc="server:port,server:port or config item")
     index = Option(require=False, default=None, doc="Index to search")
     scan = Option(require=False, default=False, doc="Perform a scan search")
+    batch_size = Option(require=False, default=DEFAULT_BATCH_SIZE, doc="Records searched per msearch request, not used with scan")
+    join_mode = Option(require=False, default=JOIN_SEARCH, doc="search or terms, fetch the matches of a whole batch with a terms query and join locally")
+    cache_entries = Option(require=False, default=DEFAULT_MAX_ENTRIES, doc="Max number of correlate values with cached results, 0 disables the cache")
+    cache_bytes = Option(require=False, default=DEFAULT_MAX_BYTES, doc="Max size in bytes of the cached results")
+    cache_misses = Option(require=False, default=False, doc="Also cache correlate values without results")
+    concurrency = Option(require=False, default=1, doc="Number of searches or batches correlated at once")
+    preload = Option(require=False, default=False, doc="Load all documents matching the query once and join every record locally")
+    preload_bytes = Option(require=False, default=DEFAULT_PRELOAD_BYTES, doc="Max size in bytes of the preloaded documents")
+    window = Option(require=False, default=None, doc="Time span, eg. 5m, searched before and after the _time of every record instead of earliest and latest")
+    top = Option(require=False, default=None, doc="Only return the latest N documents of every record")
+    latest_only = Option(require=False, default=False, doc="Only return the latest document of every record, same as top=1")
     stype = Option(require=False, default=None, doc="Source/doc_type")
     tsfield = Option(require=False, default="@timestamp", doc="Field holding the event timestamp")
     query = Option(require=False, default="*", doc="Query string in ES DSL")
@@ -115,6 +175,15 @@ class ElasticSplunkCorrelate(StreamingCommand):
         if re.search(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$", time_value):
             return int(time.mktime(time.strptime(time_value, "%Y-%m-%dT%H:%M:%S")))
 
+    @staticmethod
+    def parse_span(span):
+        """Parse a time span like 30, 30s or 5m into seconds"""
+        match = re.search(r"^(\d+)([a-zA-Z]?)$", span)
+        if not match or match.group(2) and match.group(2) not in UNITS:
+            raise Exception("Invalid time span {0}, expected a number followed by one of {1}".format(
+                span, ",".join(sorted(UNITS))))
+        return int(match.group(1)) * UNITS[match.group(2) or "s"]
+
     @staticmethod
     def to_epoch(timestring):
         """Convert UTC date string returned by elasticsearch to epoch"""
@@ -156,6 +225,22 @@ class ElasticSplunkCorrelate(StreamingCommand):
         elif KEY_CONFIG_VERIFY_CERTS not in config:
             config[KEY_CONFIG_VERIFY_CERTS] = False
 
+        # Connection selection strategy
+        if KEY_CONFIG_SELECTOR not in config:
+            config[KEY_CONFIG_SELECTOR] = DEFAULT_SELECTOR
+        if config[KEY_CONFIG_SELECTOR] not in SELECTORS:
+            raise Exception("Unknown selector {0}, expected one of {1}".format(
+                config[KEY_CONFIG_SELECTOR], ",".join(sorted(SELECTORS))))
+
+        # JSON codec, checked here so a missing one fails before searching
+        if KEY_CONFIG_JSON_CODEC in config:
+            get_codec(config[KEY_CONFIG_JSON_CODEC])
+        else:
+            config[KEY_CONFIG_JSON_CODEC] = None
+
+        # Non-blocking transport, from the stored config
+        config[KEY_CONFIG_ASYNC_TRANSPORT] = True if config.get(KEY_CONFIG_ASYNC_TRANSPORT) in [True, "true", "True", 1, "y"] else False
+
         # Fields to correlate
         if self.correlate_fields:
             config[KEY_CONFIG_CORRELATE_FIELDS] = self.correlate_fields.split(",")
@@ -193,102 +278,399 @@ class ElasticSplunkCorrelate(StreamingCommand):
         else:
             config[KEY_CONFIG_EARLIEST] = config[KEY_CONFIG_LATEST] - self.parse_dates(DEFAULT_EARLIEST)
 
-        config[KEY_CONFIG_SCAN] = True self.scan in [True, "true", "True", 1, "y"] else False
+        config[KEY_CONFIG_SCAN] = True if self.scan in [True, "true", "True", 1, "y"] else False
         config[KEY_CONFIG_INDEX] = self.index
         config[KEY_CONFIG_INCLUDE_ES] = self.include_es
         config[KEY_CONFIG_INCLUDE_RAW] = self.include_raw
-        config[KEY_CONFIG_LIMIT] = self.limit
+        config[KEY_CONFIG_LIMIT] = int(self.limit)
+        if config[KEY_CONFIG_LIMIT] < 1:
+            raise Exception("limit must be at least 1")
         config[KEY_CONFIG_QUERY] = self.query
         config[KEY_CONFIG_NO_TIMESTAMP] = True if self.no_timestamp in [True, "true", "True", 1, "y"] else False
-        config[KEY_CONFIG_CONVERT_TIMESTAMP] = True self.convert_timestamp in [True, "true", "True", 1, "y"] else False
+        config[KEY_CONFIG_CONVERT_TIMESTAMP] = True if self.convert_timestamp in [True, "true", "True", 1, "y"] else False
         config[KEY_CONFIG_RETURN_MV] = True if self.return_mv in [True, "true", "True", 1, "y"] else False
-        config[KEY_CONFIG_MATCH_ANY] = True self.match_any in [True, "true", "True", 1, "y"]: else False
+        config[KEY_CONFIG_MATCH_ANY] = True if self.match_any in [True, "true", "True", 1, "y"] else False
+        config[KEY_CONFIG_BATCH_SIZE] = int(self.batch_size)
+        if config[KEY_CONFIG_BATCH_SIZE] < 1:
+            raise Exception("batch_size must be at least 1")
+        config[KEY_CONFIG_JOIN_MODE] = self.join_mode
+        if config[KEY_CONFIG_JOIN_MODE] not in JOIN_MODES:
+            raise Exception("Unknown join_mode {0}, expected one of {1}".format(
+                config[KEY_CONFIG_JOIN_MODE], ",".join(JOIN_MODES)))
+        if config[KEY_CONFIG_JOIN_MODE] == JOIN_TERMS and config[KEY_CONFIG_MATCH_ANY]:
+            raise Exception("join_mode=terms matches all correlate_fields exactly, it can't be used with match_any")
+        config[KEY_CONFIG_CACHE_ENTRIES] = int(self.cache_entries)
+        config[KEY_CONFIG_CACHE_BYTES] = int(self.cache_bytes)
+        config[KEY_CONFIG_CACHE_MISSES] = True if self.cache_misses in [True, "true", "True", 1, "y"] else False
+        config[KEY_CONFIG_CONCURRENCY] = int(self.concurrency)
+        if config[KEY_CONFIG_CONCURRENCY] < 1:
+            raise Exception("concurrency must be at least 1")
+        config[KEY_CONFIG_PRELOAD] = True if self.preload in [True, "true", "True", 1, "y"] else False
+        config[KEY_CONFIG_PRELOAD_BYTES] = int(self.preload_bytes)
+        if config[KEY_CONFIG_PRELOAD] and config[KEY_CONFIG_MATCH_ANY]:
+            raise Exception("preload matches all correlate_fields exactly, it can't be used with match_any")
+        if self.window:
+            if config[KEY_CONFIG_NO_TIMESTAMP] or not config[KEY_CONFIG_CONVERT_TIMESTAMP]:
+                raise Exception("window compares timestamps, it can't be used with no_timestamp or convert_timestamp=false")
+            config[KEY_CONFIG_WINDOW] = self.parse_span(self.window)
+        else:
+            config[KEY_CONFIG_WINDOW] = None
+
+        # Latest documents only, searched in descending time order
+        if self.top:
+            config[KEY_CONFIG_TOP] = int(self.top)
+        elif self.latest_only in [True, "true", "True", 1, "y"]:
+            config[KEY_CONFIG_TOP] = 1
+        else:
+            config[KEY_CONFIG_TOP] = None
+        if config[KEY_CONFIG_TOP] is not None:
+            if config[KEY_CONFIG_TOP] < 1:
+                raise Exception("top must be at least 1")
+            if config[KEY_CONFIG_NO_TIMESTAMP]:
+                raise Exception("top returns the latest documents, it can't be used with no_timestamp")
+            if config[KEY_CONFIG_JOIN_MODE] == JOIN_TERMS and (
+                    len(config[KEY_CONFIG_CORRELATE_FIELDS]) > 1 or config[KEY_CONFIG_WINDOW] is not None):
+                raise Exception("top with join_mode=terms collapses on the correlate field, "
+                                "it needs a single correlate field and no window")
+            # never more than top documents per record, nothing to scroll through
+            config[KEY_CONFIG_LIMIT] = config[KEY_CONFIG_TOP]
+            config[KEY_CONFIG_SCAN] = False
 
         return config
 
-    def _search(self, esclient, config, record):
-        """Search Correlate Splunk events from a Elasticsearch search"""
+    def _build_body(self, config, record, time_range=None):
+        """Search body matching the Elasticsearch documents correlating with a
+        record, within its time range unless given another one"""
 
-        # Search body
-        # query-string-syntax
-        # www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
-        if config[KEY_CONFIG_NO_TIMESTAMP]:
-            body = {
-                "query": {
-                    "bool": {
-                            "must": [
-                                {"query_string" : {
-                                    "query" : config[KEY_CONFIG_QUERY],
-                                }}
-                        ]
-                    }
-                }
-            }
-        else:
-            body = {
-                "sort":[{config[KEY_CONFIG_TIMESTAMP]:{"order": "asc"}}],
-                "query": {
-                    "bool": {
-                        "must": [
-                            {"range": {
-                                config[KEY_CONFIG_TIMESTAMP]: {
-                                    "gte": config[KEY_CONFIG_EARLIEST],
-                                    "lte": config[KEY_CONFIG_LATEST],
-                                    "format": "epoch_second",
-                                }
-                            }},
-                            {"query_string" : {
-                                "query" : config[KEY_CONFIG_QUERY],
-                            }}
-                        ]
-                    }
-                }
-            }
-
-    	# Populate body with correlation fields
+        # Correlation clauses, matched in filter context as scores aren't used
+        filters = []
         if config[KEY_CONFIG_CORRELATE_FIELDS]:
             if config[KEY_CONFIG_MATCH_ANY]:
                 dismax = {   "dis_max" : {"queries": []}}
-                #body["query"]["bool"]["must"].append({"dis_max" : {"queries": []}})
                 for field in config[KEY_CONFIG_CORRELATE_FIELDS]:
                     dismax["dis_max"]["queries"].append({"match" : {field: record[field]}})
-                body["query"]["bool"]["must"].append(dismax)
+                filters.append(dismax)
             else:
                 for field in config[KEY_CONFIG_CORRELATE_FIELDS]:
-                    body["query"]["bool"]["must"].append({"match" : {field: record[field]}})
+                    filters.append({"match" : {field: record[field]}})
+
+        return self._compile(config, filters, time_range or _time_range(config, record))
+
+    def _compile(self, config, filters, time_range=None):
+        """Search body for the configured query with additional filters, within
+        the given time range or the configured one"""
+
+        earliest, latest = time_range or (config[KEY_CONFIG_EARLIEST], config[KEY_CONFIG_LATEST])
+
+        # Search body
+        # query-string-syntax
+        # www.elastic.co/guide/en/elasticsearch/reference/current/query-dsl-query-string-query.html
+        if config[KEY_CONFIG_NO_TIMESTAMP]:
+            return compile_query(config[KEY_CONFIG_QUERY], filters=filters)
+        return compile_query(config[KEY_CONFIG_QUERY],
+                             tsfield=config[KEY_CONFIG_TIMESTAMP],
+                             earliest=earliest,
+                             latest=latest,
+                             filters=filters,
+                             order=ORDER_DESC if config[KEY_CONFIG_TOP] else ORDER_ASC)
+
+    def _search(self, esclient, config, record):
+        """Task correlating a Splunk event with a Elasticsearch search, see elasticsearch.async_transport"""
+
+        body = self._build_body(config, record)
 
         # Execute search
         if config[KEY_CONFIG_SCAN]:
-            res = helpers.scan(esclient,
-                               size=config[KEY_CONFIG_LIMIT],
-                               index=config[KEY_CONFIG_INDEX],
-                               _source_include=config[KEY_CONFIG_FIELDS],
-                               _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
-                               doc_type=config[KEY_CONFIG_SOURCE_TYPE],
-                               query=body)
-            for row in self._generate_row(config, res, record):
-                yield row
+            scan = helpers.scan_task(esclient,
+                                     size=config[KEY_CONFIG_LIMIT],
+                                     index=config[KEY_CONFIG_INDEX],
+                                     _source_include=config[KEY_CONFIG_FIELDS],
+                                     _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
+                                     doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                                     query=body)
+            # the scan's requests are passed on, so rows are generated as
+            # pages arrive instead of once the whole scroll completed
+            events = []
+            response = error = None
+            try:
+                while True:
+                    try:
+                        value = scan.throw(*error) if error is not None else scan.send(response)
+                    except StopIteration:
+                        break
+                    response = error = None
+                    if isinstance(value, Request):
+                        try:
+                            response = yield value
+                        except Exception:
+                            error = sys.exc_info()
+                        continue
+                    event = self._parse_hit(config, value)
+                    if config[KEY_CONFIG_RETURN_MV]:
+                        events.append(event)
+                        continue
+                    for row in self._generate_row(config, [event], record):
+                        yield row
+            finally:
+                scan.close()
+            if config[KEY_CONFIG_RETURN_MV]:
+                for row in self._generate_row(config, events, record):
+                    yield row
         else:
-            res = esclient.search(index=config[KEY_CONFIG_INDEX],
-                                  size=config[KEY_CONFIG_LIMIT],
-                                  _source_include=config[KEY_CONFIG_FIELDS],
-                                  _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
-                                  doc_type=config[KEY_CONFIG_SOURCE_TYPE],
-                                  body=body)
-            for row in self._generate_row(config, res['hits']['hits'], record):
+            key = _cache_key(config, record)
+            events = self._cache.get(key) if self._cache is not None else None
+            if events is None:
+                res = yield prepare(esclient, "search",
+                                    index=config[KEY_CONFIG_INDEX],
+                                    size=config[KEY_CONFIG_LIMIT],
+                                    _source_include=config[KEY_CONFIG_FIELDS],
+                                    _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
+                                    doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                                    body=body)
+                events = [self._parse_hit(config, hit) for hit in res['hits']['hits']]
+                if self._cache is not None:
+                    self._cache.put(key, events)
+            for row in self._generate_row(config, events, record):
                 yield row
 
-    def _generate_row(self,config, hits, record):
-        """Generate row(s) combining row piped from splunk and hit from Elasticsearch"""
+    def _lookup_cache(self, config, records):
+        """Cache keys of a batch of Splunk events, the cached results by key and
+        one event for every key that has to be searched"""
+
+        keys = [_cache_key(config, record) for record in records]
+        results = {}
+        pending = OrderedDict()
+        for record, key in zip(records, keys):
+            # events repeating a key within the batch are searched once
+            if key in results or key in pending:
+                continue
+            events = self._cache.get(key) if self._cache is not None else None
+            if events is None:
+                pending[key] = record
+            else:
+                results[key] = events
+        return keys, results, pending
+
+    def _store(self, results, key, events):
+        results[key] = events
+        if self._cache is not None:
+            self._cache.put(key, events)
+
+    def _search_batch(self, esclient, config, records):
+        """Task correlating a batch of Splunk events with a single msearch, rows are generated in input order"""
+
+        keys, results, pending = self._lookup_cache(config, records)
+
+        # Keys with the same correlate values and overlapping time ranges are
+        # searched together, each one gets the hits within its own range.
+        # The latest hits of merged ranges aren't the latest of each key
+        groups = OrderedDict()
+        for key, record in pending.iteritems():
+            groups.setdefault(key if config[KEY_CONFIG_TOP] else key[:-2], []).append((key[-2:], (key, record)))
+        searches = []
+        for ranges in groups.itervalues():
+            searches.extend(_merge_ranges(ranges))
+
+        # A merged search returning as many hits as it asked for may have cut
+        # off documents of its later keys, those are searched again on their own
+        while searches:
+            body = []
+            for earliest, latest, items in searches:
+                search = self._build_body(config, items[0][1], (earliest, latest))
+                search["size"] = _batch_size(config, items)
+                source = {}
+                if config[KEY_CONFIG_FIELDS]:
+                    source["includes"] = config[KEY_CONFIG_FIELDS]
+                if config[KEY_CONFIG_EXCLUDE_FIELDS]:
+                    source["excludes"] = config[KEY_CONFIG_EXCLUDE_FIELDS]
+                if source:
+                    search["_source"] = source
+                body.append({})
+                body.append(search)
+
+            res = yield prepare(esclient, "msearch",
+                                body=body,
+                                index=config[KEY_CONFIG_INDEX],
+                                doc_type=config[KEY_CONFIG_SOURCE_TYPE])
+
+            # responses come back in the order of the searches
+            truncated = []
+            for (_, _, items), response in zip(searches, res["responses"]):
+                if "error" in response:
+                    raise Exception("Search failed: {0}".format(json.dumps(response["error"])))
+                events = [self._parse_hit(config, hit) for hit in response['hits']['hits']]
+                cutoff = None
+                if len(items) > 1 and len(events) >= _batch_size(config, items):
+                    cutoff = float(events[-1][KEY_SPLUNK_TIMESTAMP])
+                for key, record in items:
+                    selected = _select(config, events, key[-2:])
+                    if cutoff is not None and len(selected) < config[KEY_CONFIG_LIMIT] and key[-1] >= cutoff:
+                        truncated.append((key[-2], key[-1], [(key, record)]))
+                    else:
+                        self._store(results, key, selected)
+            searches = truncated
+
+        for record, key in zip(records, keys):
+            for row in self._generate_row(config, results[key], record):
+                yield row
+
+    def _join_batch(self, esclient, config, records):
+        """Task correlating a batch of Splunk events by fetching the documents
+        matching any of their values with terms queries and joining them locally"""
+
+        keys, results, pending = self._lookup_cache(config, records)
+
+        fields = config[KEY_CONFIG_CORRELATE_FIELDS]
+        record_joins = dict((key, _join_keys(record, fields)) for key, record in pending.iteritems())
+
+        # Distinct values of every correlate field in the batch
+        values = dict((field, set()) for field in fields)
+        for joins in record_joins.itervalues():
+            for key in joins:
+                for field, value in zip(fields, key):
+                    values[field].add(value)
+
+        # Time ranges of the batch, overlapping ones merged
+        ranges = [(earliest, latest) for earliest, latest, _ in
+                  _merge_ranges([(key[-2:], None) for key in pending])]
+
+        # Hash index of the parsed documents on their correlate field values
+        index = {}
+        if all(values.values()):
+            hits = yield self._fetch_terms(esclient, config, values, ranges)
+            for hit in hits:
+                event = self._parse_hit(config, hit)
+                for key in _join_keys(_source_fields(hit[KEY_ELASTIC_SOURCE], fields), fields):
+                    index.setdefault(key, []).append(event)
+
+        for key, joins in record_joins.iteritems():
+            self._store(results, key, _select(config, _join(index, joins), key[-2:]))
+
+        for record, key in zip(records, keys):
+            for row in self._generate_row(config, results[key], record):
+                yield row
+
+    def _fetch_terms(self, esclient, config, values, ranges):
+        """Task generating the documents matching the given correlate field
+        values within any of the time ranges, scrolled through in time order"""
+
+        fields = config[KEY_CONFIG_CORRELATE_FIELDS]
+        filters = []
+        if len(ranges) > 1:
+            filters.append({"bool": {"should": [
+                {"range": {config[KEY_CONFIG_TIMESTAMP]: {"gte": earliest, "lte": latest, "format": "epoch_second"}}}
+                for earliest, latest in ranges]}})
+        # the body's own range covers all of them
+        time_range = (ranges[0][0], max(latest for _, latest in ranges))
+
+        if config[KEY_CONFIG_TOP]:
+            hits = yield self._fetch_top(esclient, config, fields[0], sorted(values[fields[0]]), filters, time_range)
+            for hit in hits:
+                yield hit
+            return
+
+        body = self._compile(config, [{"terms": {field: sorted(values[field])}} for field in fields] + filters,
+                             time_range)
+        # scrolled on the timestamp sort, or in index order without one
+        hits = yield helpers.scan_task(esclient,
+                                       size=config[KEY_CONFIG_LIMIT],
+                                       index=config[KEY_CONFIG_INDEX],
+                                       _source_include=_join_includes(config),
+                                       _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
+                                       doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                                       preserve_order=not config[KEY_CONFIG_NO_TIMESTAMP],
+                                       query=body)
+        for hit in hits:
+            yield hit
+
+    def _fetch_top(self, esclient, config, field, values, filters, time_range):
+        """Task generating the top latest documents of each of the values of
+        field, with searches collapsed on field. Collapsed searches can't be
+        paged, but return a single hit per value, so each one takes up to
+        MAX_RESULT_WINDOW of the values"""
+
+        source = {}
+        if _join_includes(config):
+            source["includes"] = _join_includes(config)
+        if config[KEY_CONFIG_EXCLUDE_FIELDS]:
+            source["excludes"] = config[KEY_CONFIG_EXCLUDE_FIELDS]
+
+        for start in range(0, len(values), MAX_RESULT_WINDOW):
+            chunk = values[start:start + MAX_RESULT_WINDOW]
+            body = self._compile(config, [{"terms": {field: chunk}}] + filters, time_range)
+            body["collapse"] = {"field": field, "inner_hits": {
+                "name": TOP_HITS,
+                "size": config[KEY_CONFIG_TOP],
+                "sort": body["sort"],
+                "_source": source or True,
+            }}
+            # the collapsed hits themselves are one of the inner hits
+            body["_source"] = False
+            body["size"] = len(chunk)
+
+            res = yield prepare(esclient, "search",
+                                index=config[KEY_CONFIG_INDEX],
+                                doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                                body=body)
+            for hit in res['hits']['hits']:
+                for inner in hit['inner_hits'][TOP_HITS]['hits']['hits']:
+                    yield inner
+
+    def _preload(self, esclient, config):
+        """Hash index of all documents matching the query on their correlate field values"""
+
+        fields = config[KEY_CONFIG_CORRELATE_FIELDS]
+        res = helpers.scan(esclient,
+                           size=config[KEY_CONFIG_LIMIT],
+                           index=config[KEY_CONFIG_INDEX],
+                           _source_include=_join_includes(config),
+                           _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
+                           doc_type=config[KEY_CONFIG_SOURCE_TYPE],
+                           preserve_order=not config[KEY_CONFIG_NO_TIMESTAMP],
+                           query=self._compile(config, [], _preload_range(config)))
+
+        index = {}
+        count = 0
+        size = 0
+        for hit in res:
+            event = self._parse_hit(config, hit)
+            size += events_size([event])
+            if size > config[KEY_CONFIG_PRELOAD_BYTES]:
+                raise Exception("The documents to preload exceed preload_bytes={0}, narrow down the query "
+                                "or raise preload_bytes".format(config[KEY_CONFIG_PRELOAD_BYTES]))
+            count += 1
+            for key in _join_keys(_source_fields(hit[KEY_ELASTIC_SOURCE], fields), fields):
+                index.setdefault(key, []).append(event)
+
+        self.write_info("Preloaded {0} documents with {1} distinct keys, {2} bytes", count, len(index), size)
+        return index
+
+    def _join_preloaded(self, esclient, config, index, records):
+        """Correlate Splunk events with the preloaded documents, events with a
+        window reaching beyond the preloaded time range are searched"""
+        fields = config[KEY_CONFIG_CORRELATE_FIELDS]
+        earliest, latest = _preload_range(config)
+        for record in records:
+            time_range = _time_range(config, record)
+            if config[KEY_CONFIG_WINDOW] is not None and not earliest <= time_range[0] <= time_range[1] <= latest:
+                rows = run(self._search(esclient, config, record))
+            else:
+                events = _select(config, _join(index, _join_keys(record, fields)), time_range)
+                rows = self._generate_row(config, events, record)
+            for row in rows:
+                yield row
+
+    def _generate_row(self,config, events, record):
+        """Generate row(s) combining row piped from splunk and parsed hits from Elasticsearch"""
         for field in record:
             if field in config[KEY_CONFIG_CORRELATE_FIELDS]:
                 record[field] = None
         if config[KEY_CONFIG_RETURN_MV]:
-            for hit in hits:
-                parsed = self._parse_hit(config, hit)
+            for parsed in events:
                 for a in parsed:
                     if not a in record:
-                        record[a] = parsed[a]
+                        # copied, parsed events can be shared by several records
+                        record[a] = list(parsed[a]) if isinstance(parsed[a], list) else parsed[a]
                     elif isinstance(record[a], list):
                         record[a].append(parsed[a])
                     else:
@@ -298,8 +680,7 @@ class ElasticSplunkCorrelate(StreamingCommand):
                         record[a].append(parsed[a])
             yield record
         else:
-            for hit in hits:
-                parsed = self._parse_hit(config, hit)
+            for parsed in events:
                 record.update(parsed)
                 yield record
 
@@ -338,11 +719,261 @@ class ElasticSplunkCorrelate(StreamingCommand):
         esclient = Elasticsearch(
             config[KEY_CONFIG_EADDR],
             verify_certs=config[KEY_CONFIG_VERIFY_CERTS],
-            use_ssl=config[KEY_CONFIG_USE_SSL])
+            use_ssl=config[KEY_CONFIG_USE_SSL],
+            selector_class=SELECTORS[config[KEY_CONFIG_SELECTOR]],
+            transport_class=AsyncTransport if config[KEY_CONFIG_ASYNC_TRANSPORT] else Transport,
+            serializer=JSONSerializer(codec=config[KEY_CONFIG_JSON_CODEC]),
+            maxsize=max(MIN_CONNECTIONS, config[KEY_CONFIG_CONCURRENCY]),
+            **dict((key, config[key]) for key in KEYS_CONFIG_TRANSPORT if key in config))
+
+        # Results of repeated correlate values, not used by scans
+        if config[KEY_CONFIG_CACHE_ENTRIES] > 0:
+            self._cache = ResultCache(config[KEY_CONFIG_CACHE_ENTRIES],
+                                      config[KEY_CONFIG_CACHE_BYTES],
+                                      config[KEY_CONFIG_CACHE_MISSES])
+        else:
+            self._cache = None
+
+        # Every record is joined locally, without searching
+        if config[KEY_CONFIG_PRELOAD]:
+            index = self._preload(esclient, config)
+            for item in self._join_preloaded(esclient, config, index, records):
+                yield item
+            return
+
+        if config[KEY_CONFIG_JOIN_MODE] == JOIN_TERMS:
+            search_batch = self._join_batch
+            batches = _batches(records, config[KEY_CONFIG_BATCH_SIZE])
+        # Scrolling can't be batched, each record gets its own scan
+        elif config[KEY_CONFIG_SCAN] or config[KEY_CONFIG_BATCH_SIZE] == 1:
+            search_batch = lambda esclient, config, batch: self._search(esclient, config, batch[0])
+            batches = _batches(records, 1)
+        else:
+            search_batch = self._search_batch
+            batches = _batches(records, config[KEY_CONFIG_BATCH_SIZE])
 
-        for record in records:
-                for item in self._search(esclient, config, record):
-                    yield item
+        if config[KEY_CONFIG_CONCURRENCY] > 1 and isinstance(esclient.transport, AsyncTransport):
+            rows = self._run_concurrently(esclient, config, search_batch, batches)
+        elif config[KEY_CONFIG_CONCURRENCY] > 1:
+            rows = self._search_concurrently(esclient, config, search_batch, batches)
+        else:
+            rows = (row for batch in batches for row in run(search_batch(esclient, config, batch)))
+        for item in rows:
+            yield item
+
+        if self._cache is not None and self._cache.hits + self._cache.misses:
+            self._report_cache()
+
+    def _search_concurrently(self, esclient, config, search_batch, batches):
+        """Correlate batches on concurrency threads sharing the client, rows are
+        generated in input order
+
+        The transport's adaptive concurrency limit and retries apply to the
+        searches of all threads, so they back off together when the cluster
+        rejects requests.
+        """
+
+        tasks = Queue()
+        workers = []
+        for _ in range(config[KEY_CONFIG_CONCURRENCY]):
+            worker = threading.Thread(target=self._correlate_worker,
+                                      args=(esclient, config, search_batch, tasks))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        # Reorder buffer, a result slot per batch in input order. Twice the
+        # concurrency keeps every thread busy while the oldest batch is written
+        window = deque()
+        try:
+            for batch in batches:
+                slot = Queue(1)
+                tasks.put((batch, slot))
+                window.append(slot)
+                if len(window) >= 2 * len(workers):
+                    for row in _collect(window.popleft()):
+                        yield row
+            while window:
+                for row in _collect(window.popleft()):
+                    yield row
+        finally:
+            for _ in workers:
+                tasks.put(None)
+
+    def _run_concurrently(self, esclient, config, search_batch, batches):
+        """Correlate batches with the searches of concurrency of them in flight
+        at once from this thread, rows are generated in input order
+
+        Rows of the oldest batch are generated as they come, those of the
+        batches after it are held until it completes.
+        """
+
+        runner = TaskRunner((search_batch(esclient, config, batch) for batch in batches),
+                            esclient.transport.max_in_flight,
+                            max_tasks=config[KEY_CONFIG_CONCURRENCY],
+                            window=2 * config[KEY_CONFIG_CONCURRENCY])
+        held = {}
+        done = set()
+        oldest = 0
+        for position, row in runner:
+            if row is not TASK_DONE:
+                if position == oldest:
+                    yield row
+                else:
+                    # rows are copied, the same record is generated once per hit
+                    held.setdefault(position, []).append(row.copy())
+                continue
+            done.add(position)
+            while oldest in done:
+                done.remove(oldest)
+                oldest += 1
+                for held_row in held.pop(oldest, ()):
+                    yield held_row
+
+    @staticmethod
+    def _correlate_worker(esclient, config, search_batch, tasks):
+        """Correlate batches from tasks until getting None, each result goes to the batch's slot"""
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            batch, slot = task
+            try:
+                # rows are copied, the same record is generated once per hit
+                slot.put((None, [row.copy() for row in run(search_batch(esclient, config, batch))]))
+            except Exception as e:
+                slot.put((e, None))
+
+    def _report_cache(self):
+        """Cache efficiency as a search message and a search inspector metric,
+        metrics need protocol v2 (chunked = true in commands.conf)"""
+        cache = self._cache
+        self.write_info("Correlation cache: {0} hits, {1} misses, hit ratio {2:.1%}, {3} keys, {4} bytes, {5} evicted",
+                        cache.hits, cache.misses, cache.hit_ratio(), len(cache), cache.size, cache.evictions)
+        if self.protocol_version == 2:
+            # invocations are lookups, the output the ones answered from the cache
+            self.write_metric("correlation_cache", SearchMetric(None, cache.hits + cache.misses, None, cache.hits))
+
+def _batches(records, size):
+    """Group records in lists of size records"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _collect(slot):
+    """Rows of a batch correlated by a worker, raises the error it failed with"""
+    error, rows = slot.get()
+    if error is not None:
+        raise error
+    return rows
+
+def _cache_key(config, record):
+    """Correlate field values of a record and the time range they are searched in"""
+    values = []
+    for field in config[KEY_CONFIG_CORRELATE_FIELDS]:
+        value = record.get(field)
+        values.append(tuple(value) if isinstance(value, list) else value)
+    return tuple(values) + _time_range(config, record)
+
+def _join_keys(record, fields):
+    """Tuples of correlate field values a record or document can be joined on,
+    one for every combination of values of its multivalue fields"""
+    keys = [()]
+    for field in fields:
+        value = record.get(field)
+        if value is None:
+            return []
+        values = value if isinstance(value, list) else [value]
+        keys = [key + (_join_value(v),) for key in keys for v in values]
+    return keys
+
+def _join(index, joins):
+    """Documents from the hash index matching any of the join keys"""
+    events = []
+    seen = set()
+    for join in joins:
+        for event in index.get(join, ()):
+            # a document with multivalue fields can match several keys
+            if id(event) not in seen:
+                seen.add(id(event))
+                events.append(event)
+    return events
+
+def _select(config, events, time_range):
+    """Up to limit of the events, only the ones within the time range with a window"""
+    if config[KEY_CONFIG_WINDOW] is not None:
+        earliest, latest = time_range
+        events = [event for event in events if earliest <= float(event[KEY_SPLUNK_TIMESTAMP]) <= latest]
+    return events[:config[KEY_CONFIG_LIMIT]]
+
+def _batch_size(config, items):
+    """Hits asked for by a search covering the time ranges of several keys"""
+    return max(config[KEY_CONFIG_LIMIT], min(config[KEY_CONFIG_LIMIT] * len(items), MAX_RESULT_WINDOW))
+
+def _time_range(config, record):
+    """Time range searched for a record, around its _time with a window"""
+    window = config[KEY_CONFIG_WINDOW]
+    if window is None:
+        return config[KEY_CONFIG_EARLIEST], config[KEY_CONFIG_LATEST]
+    if record.get(KEY_SPLUNK_TIMESTAMP) in (None, ""):
+        raise Exception("window searches around the _time of every record, found a record without it")
+    timestamp = float(record[KEY_SPLUNK_TIMESTAMP])
+    return int(math.floor(timestamp - window)), int(math.ceil(timestamp + window))
+
+def _preload_range(config):
+    """Time range preloaded, widened by the window for the events near its edges"""
+    earliest, latest = config[KEY_CONFIG_EARLIEST], config[KEY_CONFIG_LATEST]
+    if config[KEY_CONFIG_WINDOW] is None:
+        return earliest, latest
+    return earliest - config[KEY_CONFIG_WINDOW], latest + config[KEY_CONFIG_WINDOW]
+
+def _merge_ranges(ranges):
+    """Merge overlapping ((earliest, latest), item) pairs, into (earliest, latest, items)
+    tuples covering the ranges of their items"""
+    merged = []
+    for (earliest, latest), item in sorted(ranges, key=lambda pair: pair[0]):
+        if merged and earliest <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], latest)
+            merged[-1][2].append(item)
+        else:
+            merged.append([earliest, latest, [item]])
+    return [tuple(group) for group in merged]
+
+def _join_includes(config):
+    """Source fields to fetch, the correlate fields are needed to join the documents"""
+    includes = config[KEY_CONFIG_FIELDS]
+    if includes:
+        includes = includes + [field for field in config[KEY_CONFIG_CORRELATE_FIELDS] if field not in includes]
+    return includes
+
+def _join_value(value):
+    """Compare values from Splunk, always text, and from Elasticsearch as text"""
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return unicode(json.dumps(value))
+
+def _source_fields(source, fields):
+    """Values of fields, possibly in dotted notation, from a document source"""
+    result = {}
+    for field in fields:
+        if field in source:
+            result[field] = source[field]
+            continue
+        value = source
+        for part in field.split("."):
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            result[field] = value
+    return result
 
 def _flattern(key, data):
     result = {}
@@ -0,0 +1,431 @@
+# vim: set fileencoding=utf-8:
+# ElasticSplunkIndex
+# streaming command that indexes events from Splunk as new Elasticsearch documents
+#
+
+import sys
+import os
+import json
+import time
+import threading
+from collections import deque
+from datetime import datetime
+from elasticsearch import Elasticsearch, helpers, Transport, AsyncTransport, TransportError
+from elasticsearch.connection_pool import SELECTORS
+from elasticsearch.serializer import JSONSerializer, get_codec
+from splunklib.searchcommands import \
+    dispatch, StreamingCommand, Configuration, Option, validators
+
+# Config keys
+KEY_CONFIG_EADDR = "hosts"
+KEY_CONFIG_TIMESTAMP = "tsfield"
+KEY_CONFIG_USE_SSL = "use_ssl"
+KEY_CONFIG_VERIFY_CERTS = "verify_certs"
+KEY_CONFIG_SELECTOR = "selector"
+KEY_CONFIG_JSON_CODEC = "json_codec"
+KEY_CONFIG_ASYNC_TRANSPORT = "async_transport"
+KEY_CONFIG_FIELDS = "fields"
+KEY_CONFIG_EXCLUDE_FIELDS = "exclude_fields"
+KEY_CONFIG_INDEX = "index"
+KEY_CONFIG_INDEX_FIELD = "index_field"
+KEY_CONFIG_SOURCE_TYPE = "stype"
+KEY_CONFIG_SOURCE_TYPE_FIELD = "stype_field"
+KEY_CONFIG_ID_FIELD = "id_field"
+KEY_CONFIG_ROUTING_FIELD = "routing_field"
+KEY_CONFIG_PIPELINE = "pipeline"
+KEY_CONFIG_PIPELINE_FIELD = "pipeline_field"
+KEY_CONFIG_OP_TYPE = "op_type"
+KEY_CONFIG_CHUNK_SIZE = "chunk_size"
+KEY_CONFIG_MAX_CHUNK_BYTES = "max_chunk_bytes"
+KEY_CONFIG_AUTO_TUNE = "auto_tune"
+KEY_CONFIG_THREADS = "threads"
+KEY_CONFIG_QUEUE_SIZE = "queue_size"
+KEY_CONFIG_CHUNK_METRICS = "chunk_metrics"
+
+# Config keys passed as is to the transport
+KEYS_CONFIG_TRANSPORT = ("hedge_requests", "hedge_percentile", "hedge_delay",
+                         "adaptive_concurrency", "max_concurrency", "max_retries")
+
+# Splunk keys
+KEY_SPLUNK_TIMESTAMP = "_time"
+
+# Default connection selector
+DEFAULT_SELECTOR = "round_robin"
+
+# Default document type
+DEFAULT_SOURCE_TYPE = "doc"
+
+# Bulk operations creating documents
+OP_TYPES = ("index", "create")
+
+# Min number of idle connections kept per node, raised to the number of threads
+MIN_CONNECTIONS = 10
+
+# Default bulk request limits, auto tuning starts at MIN_CHUNK_BYTES and
+# never goes over max_chunk_bytes
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_MAX_CHUNK_BYTES = 20 * 1024 * 1024
+MIN_CHUNK_BYTES = 256 * 1024
+
+# Bulk requests taking less seconds than this get bigger when auto tuning,
+# the ones taking twice as long get smaller
+TARGET_CHUNK_SECONDS = 1.0
+
+# Default number of bulk requests sent at once, and waiting to be sent
+DEFAULT_THREADS = 4
+DEFAULT_QUEUE_SIZE = 4
+
+# Bulk index result fields
+KEY_RESULT_STATUS = "es_status"
+KEY_RESULT_ID = "es_id"
+KEY_RESULT_RESULT = "es_result"
+KEY_RESULT_ERROR = "es_error"
+
+
+class ChunkTuner(object):
+    """Max size in bytes of the next bulk request, grown while requests are
+    accepted within TARGET_CHUNK_SECONDS, shrunk when they take longer and
+    halved when the cluster rejects documents"""
+
+    def __init__(self, initial, minimum, maximum):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self.size
+
+    def update(self, seconds, rejected):
+        with self.lock:
+            if rejected:
+                self.size = max(self.minimum, self.size // 2)
+            elif seconds < TARGET_CHUNK_SECONDS:
+                self.size = min(self.maximum, int(self.size * 1.25))
+            elif seconds > 2 * TARGET_CHUNK_SECONDS:
+                self.size = max(self.minimum, int(self.size * 0.8))
+
+
+class BulkMeter(object):
+    """Client for the bulk helpers sending bulk requests with an Elasticsearch
+    client, measuring each of them and tuning the size of the next ones"""
+
+    def __init__(self, client, tuner=None):
+        self.client = client
+        self.transport = client.transport
+        self.tuner = tuner
+        # chunk metrics, appended by the bulk threads
+        self.chunks = deque()
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def bulk(self, body, **kwargs):
+        start = time.time()
+        try:
+            resp = self.client.bulk(body, **kwargs)
+        except TransportError as e:
+            self._measure(body, time.time() - start, None, e.status_code == 429)
+            raise
+        self._measure(body, time.time() - start, resp["items"], False)
+        return resp
+
+    def _measure(self, body, seconds, items, rejected):
+        docs = body.count("\n") // 2
+        errors = docs
+        if items is not None:
+            statuses = [item.get("status", 500) for op in items for item in op.values()]
+            errors = sum(1 for status in statuses if not 200 <= status < 300)
+            rejected = rejected or 429 in statuses
+        if self.tuner is not None:
+            self.tuner.update(seconds, rejected)
+        with self._lock:
+            self._sequence += 1
+            sequence = self._sequence
+        self.chunks.append({
+            KEY_SPLUNK_TIMESTAMP: time.time(),
+            "chunk": sequence,
+            "docs": docs,
+            "bytes": len(body),
+            "seconds": round(seconds, 6),
+            "docs_per_second": round(docs / seconds, 2) if seconds else None,
+            "mb_per_second": round(len(body) / 1048576.0 / seconds, 2) if seconds else None,
+            "errors": errors,
+            "rejected": rejected,
+            "max_chunk_bytes": self.tuner() if self.tuner is not None else None,
+        })
+
+
+@Configuration()
+class ElasticSplunkIndex(StreamingCommand):
+    eaddr = Option(require=False, default="127.0.0.1 9200", doc="server:port,server:port or config item")
+    tsfield = Option(require=False, default="@timestamp", doc="Field to store the event timestamp in")
+    index = Option(require=False, default=None, doc="Index to write to, may contain strftime patterns like %Y.%m.%d filled in from _time")
+    index_field = Option(require=False, default=None, doc="Field containing the index to write to")
+    stype = Option(require=False, default=DEFAULT_SOURCE_TYPE, doc="Source/doc_type")
+    stype_field = Option(require=False, default=None, doc="Field containing the source/doc_type")
+    id_field = Option(require=False, default=None, doc="Field containing the document id, generated by Elasticsearch if not set")
+    routing_field = Option(require=False, default=None, doc="Field containing the routing value")
+    pipeline = Option(require=False, default=None, doc="Ingest pipeline")
+    pipeline_field = Option(require=False, default=None, doc="Field containing the ingest pipeline")
+    op_type = Option(require=False, default="index", doc="index or create, create fails for existing ids")
+    fields = Option(require=False, default=None, doc="Only include selected fields")
+    exclude_fields = Option(require=False, default=None, doc="Exclude selected fields")
+    chunk_size = Option(require=False, default=DEFAULT_CHUNK_SIZE, doc="Max number of documents per bulk request")
+    max_chunk_bytes = Option(require=False, default=DEFAULT_MAX_CHUNK_BYTES, doc="Max size in bytes of a bulk request")
+    auto_tune = Option(require=False, default=True, doc="Tune the size of bulk requests to the response times of the cluster")
+    threads = Option(require=False, default=DEFAULT_THREADS, doc="Number of bulk requests sent at once")
+    queue_size = Option(require=False, default=DEFAULT_QUEUE_SIZE, doc="Number of bulk requests waiting to be sent")
+    chunk_metrics = Option(require=False, default=False, doc="Return an event per bulk request instead of the records")
+    use_ssl = Option(require=False, default=None, doc="Use SSL")
+    verify_certs = Option(require=False, default=None, doc="Verify SSL Certificates")
+
+    @staticmethod
+    def to_datetime(timestamp):
+        """Convert a Splunk epoch timestamp to a UTC date string as returned by elasticsearch"""
+        return datetime.utcfromtimestamp(float(timestamp)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    def _get_search_config(self):
+        """Parse and configure indexing parameters"""
+
+        # Load default configs if available
+        app_path = os.path.dirname(os.path.abspath(__file__)) + "/.."
+        local_config = "{0}/local/elasticsplunk.json".format(app_path)
+        if os.path.isfile(local_config):
+            config_file = open(local_config)
+            config = json.load(config_file)
+        else:
+            config = {}
+
+        # Load eaddr stored config
+        if self.eaddr in config:
+            config = config[self.eaddr]
+        else:
+            config[KEY_CONFIG_EADDR] = self.eaddr.split(",")
+
+        if KEY_CONFIG_TIMESTAMP not in config:
+            config[KEY_CONFIG_TIMESTAMP] = self.tsfield
+
+        # Handle SSL connections
+        if self.use_ssl != None:
+            config[KEY_CONFIG_USE_SSL] = True if self.use_ssl == "true" else False
+        elif KEY_CONFIG_USE_SSL not in config:
+            config[KEY_CONFIG_USE_SSL] = False
+
+        if not config[KEY_CONFIG_USE_SSL]:
+            config[KEY_CONFIG_VERIFY_CERTS] = False
+        elif self.verify_certs != None:
+            config[KEY_CONFIG_VERIFY_CERTS] = True if self.verify_certs == "true" else False
+        elif KEY_CONFIG_VERIFY_CERTS not in config:
+            config[KEY_CONFIG_VERIFY_CERTS] = False
+
+        # Connection selection strategy
+        if KEY_CONFIG_SELECTOR not in config:
+            config[KEY_CONFIG_SELECTOR] = DEFAULT_SELECTOR
+        if config[KEY_CONFIG_SELECTOR] not in SELECTORS:
+            raise Exception("Unknown selector {0}, expected one of {1}".format(
+                config[KEY_CONFIG_SELECTOR], ",".join(sorted(SELECTORS))))
+
+        # JSON codec, checked here so a missing one fails before indexing
+        if KEY_CONFIG_JSON_CODEC in config:
+            get_codec(config[KEY_CONFIG_JSON_CODEC])
+        else:
+            config[KEY_CONFIG_JSON_CODEC] = None
+
+        # Non-blocking transport, from the stored config
+        config[KEY_CONFIG_ASYNC_TRANSPORT] = True if config.get(KEY_CONFIG_ASYNC_TRANSPORT) in [True, "true", "True", 1, "y"] else False
+
+        # Fields to index
+        config[KEY_CONFIG_FIELDS] = self.fields.split(",") if self.fields else None
+        config[KEY_CONFIG_EXCLUDE_FIELDS] = self.exclude_fields.split(",") if self.exclude_fields else None
+
+        # Document metadata
+        if not self.index and not self.index_field:
+            raise Exception("Index to write to not specified via either index or index_field parameter")
+        config[KEY_CONFIG_INDEX] = self.index
+        config[KEY_CONFIG_INDEX_FIELD] = self.index_field
+        config[KEY_CONFIG_SOURCE_TYPE] = self.stype
+        config[KEY_CONFIG_SOURCE_TYPE_FIELD] = self.stype_field
+        config[KEY_CONFIG_ID_FIELD] = self.id_field
+        config[KEY_CONFIG_ROUTING_FIELD] = self.routing_field
+        config[KEY_CONFIG_PIPELINE] = self.pipeline
+        config[KEY_CONFIG_PIPELINE_FIELD] = self.pipeline_field
+        config[KEY_CONFIG_OP_TYPE] = self.op_type
+        if config[KEY_CONFIG_OP_TYPE] not in OP_TYPES:
+            raise Exception("Unknown op_type {0}, expected one of {1}".format(
+                config[KEY_CONFIG_OP_TYPE], ",".join(OP_TYPES)))
+
+        # Bulk requests
+        config[KEY_CONFIG_CHUNK_SIZE] = int(self.chunk_size)
+        config[KEY_CONFIG_MAX_CHUNK_BYTES] = int(self.max_chunk_bytes)
+        config[KEY_CONFIG_AUTO_TUNE] = True if self.auto_tune in [True, "true", "True", 1, "y"] else False
+        config[KEY_CONFIG_THREADS] = int(self.threads)
+        config[KEY_CONFIG_QUEUE_SIZE] = int(self.queue_size)
+        if min(config[KEY_CONFIG_CHUNK_SIZE], config[KEY_CONFIG_MAX_CHUNK_BYTES],
+               config[KEY_CONFIG_THREADS], config[KEY_CONFIG_QUEUE_SIZE]) < 1:
+            raise Exception("chunk_size, max_chunk_bytes, threads and queue_size must be at least 1")
+        config[KEY_CONFIG_CHUNK_METRICS] = True if self.chunk_metrics in [True, "true", "True", 1, "y"] else False
+
+        return config
+
+    def _action(self, config, record):
+        """Bulk action indexing a record as a new document"""
+
+        # Splunk internal fields and the ones mapped to metadata aren't indexed
+        metadata_fields = set([config[KEY_CONFIG_INDEX_FIELD], config[KEY_CONFIG_SOURCE_TYPE_FIELD],
+                               config[KEY_CONFIG_ID_FIELD], config[KEY_CONFIG_ROUTING_FIELD],
+                               config[KEY_CONFIG_PIPELINE_FIELD]])
+
+        doc = {}
+        for field in config[KEY_CONFIG_FIELDS] or record:
+            if field.startswith("_") or field in metadata_fields:
+                continue
+            if config[KEY_CONFIG_EXCLUDE_FIELDS] and field in config[KEY_CONFIG_EXCLUDE_FIELDS]:
+                continue
+            # fields missing from an event are empty
+            if record.get(field) not in (None, ""):
+                doc[field] = record[field]
+
+        timestamp = record.get(KEY_SPLUNK_TIMESTAMP)
+        if timestamp not in (None, ""):
+            doc[config[KEY_CONFIG_TIMESTAMP]] = self.to_datetime(timestamp)
+
+        if config[KEY_CONFIG_INDEX_FIELD] and record.get(config[KEY_CONFIG_INDEX_FIELD]):
+            index = record[config[KEY_CONFIG_INDEX_FIELD]]
+        elif not config[KEY_CONFIG_INDEX]:
+            raise Exception("Record without an index in the {0} field".format(config[KEY_CONFIG_INDEX_FIELD]))
+        elif "%" in config[KEY_CONFIG_INDEX]:
+            if timestamp in (None, ""):
+                raise Exception("Index {0} is named after the date, found a record without _time".format(config[KEY_CONFIG_INDEX]))
+            index = datetime.utcfromtimestamp(float(timestamp)).strftime(config[KEY_CONFIG_INDEX])
+        else:
+            index = config[KEY_CONFIG_INDEX]
+
+        action = {
+            "_op_type": config[KEY_CONFIG_OP_TYPE],
+            "_index": index,
+            "_type": record.get(config[KEY_CONFIG_SOURCE_TYPE_FIELD]) or config[KEY_CONFIG_SOURCE_TYPE],
+            "_source": doc,
+        }
+        if config[KEY_CONFIG_ID_FIELD] and record.get(config[KEY_CONFIG_ID_FIELD]):
+            action["_id"] = record[config[KEY_CONFIG_ID_FIELD]]
+        if config[KEY_CONFIG_ROUTING_FIELD] and record.get(config[KEY_CONFIG_ROUTING_FIELD]):
+            action["_routing"] = record[config[KEY_CONFIG_ROUTING_FIELD]]
+        pipeline = record.get(config[KEY_CONFIG_PIPELINE_FIELD]) or config[KEY_CONFIG_PIPELINE]
+        if pipeline:
+            action["pipeline"] = pipeline
+        return action
+
+    def _result(self, record, ok, item):
+        """Record with the result of indexing it"""
+        _, item = item.popitem()
+        record[KEY_RESULT_STATUS] = item.get("status")
+        record[KEY_RESULT_ID] = item.get("_id")
+        record[KEY_RESULT_RESULT] = item.get("result")
+        error = item.get("error")
+        record[KEY_RESULT_ERROR] = json.dumps(error) if isinstance(error, dict) else error
+        return record
+
+    def _index_records(self, esclient, config, records):
+        """Index records with parallel bulk requests, generating each record
+        with its result in input order, or the metrics of every bulk request"""
+
+        if config[KEY_CONFIG_AUTO_TUNE]:
+            tuner = ChunkTuner(min(MIN_CHUNK_BYTES, config[KEY_CONFIG_MAX_CHUNK_BYTES]),
+                               min(MIN_CHUNK_BYTES, config[KEY_CONFIG_MAX_CHUNK_BYTES]),
+                               config[KEY_CONFIG_MAX_CHUNK_BYTES])
+        else:
+            tuner = None
+        meter = BulkMeter(esclient, tuner)
+
+        # records whose results are pending, bounded by the chunks queued and in flight
+        pending = deque()
+
+        # actions are read by a thread of the pool, which would swallow their errors
+        errors = []
+
+        def actions():
+            try:
+                for record in records:
+                    action = self._action(config, record)
+                    pending.append(record)
+                    yield action
+            except Exception as e:
+                errors.append(e)
+
+        # The queue blocks reading further records while queue_size chunks wait
+        # for a thread, and with adaptive concurrency the transport lowers the
+        # number of chunks in flight when the cluster rejects documents. The
+        # rejected documents are sent again, backing off like the transport
+        transport = esclient.transport
+        results = helpers.parallel_bulk(meter, actions(),
+                                        thread_count=config[KEY_CONFIG_THREADS],
+                                        queue_size=config[KEY_CONFIG_QUEUE_SIZE],
+                                        chunk_size=config[KEY_CONFIG_CHUNK_SIZE],
+                                        max_chunk_bytes=tuner or config[KEY_CONFIG_MAX_CHUNK_BYTES],
+                                        max_retries=transport.max_retries,
+                                        initial_backoff=transport.rejection_backoff,
+                                        max_backoff=transport.max_rejection_backoff,
+                                        raise_on_error=False,
+                                        raise_on_exception=False)
+
+        totals = {"chunks": 0, "docs": 0, "bytes": 0, "seconds": 0.0, "errors": 0, "rejected": 0}
+        for ok, item in results:
+            result = self._result(pending.popleft(), ok, item)
+            if not config[KEY_CONFIG_CHUNK_METRICS]:
+                yield result
+            for chunk in self._drain_chunks(meter, totals):
+                if config[KEY_CONFIG_CHUNK_METRICS]:
+                    yield chunk
+        for chunk in self._drain_chunks(meter, totals):
+            if config[KEY_CONFIG_CHUNK_METRICS]:
+                yield chunk
+
+        self._report(totals, tuner)
+        if errors:
+            raise errors[0]
+
+    def _drain_chunks(self, meter, totals):
+        """Metrics of the bulk requests completed since the last call, added to totals"""
+        while meter.chunks:
+            chunk = meter.chunks.popleft()
+            self.logger.debug("Bulk request: %s", json.dumps(chunk))
+            totals["chunks"] += 1
+            totals["docs"] += chunk["docs"]
+            totals["bytes"] += chunk["bytes"]
+            totals["seconds"] += chunk["seconds"]
+            totals["errors"] += chunk["errors"]
+            totals["rejected"] += 1 if chunk["rejected"] else 0
+            yield chunk
+
+    def _report(self, totals, tuner):
+        """Throughput as a search message"""
+        if not totals["chunks"]:
+            return
+        self.write_info("Indexed {0} documents with {1} bulk requests, {2:.2f} MB/s per request, "
+                        "{3} failed, {4} requests with rejections{5}",
+                        totals["docs"] - totals["errors"], totals["chunks"],
+                        totals["bytes"] / 1048576.0 / totals["seconds"] if totals["seconds"] else 0,
+                        totals["errors"], totals["rejected"],
+                        ", tuned max_chunk_bytes {0}".format(tuner()) if tuner is not None else "")
+
+    def stream(self, records):
+
+        # Get config
+        config = self._get_search_config()
+
+        # Create Elasticsearch client
+        esclient = Elasticsearch(
+            config[KEY_CONFIG_EADDR],
+            verify_certs=config[KEY_CONFIG_VERIFY_CERTS],
+            use_ssl=config[KEY_CONFIG_USE_SSL],
+            selector_class=SELECTORS[config[KEY_CONFIG_SELECTOR]],
+            transport_class=AsyncTransport if config[KEY_CONFIG_ASYNC_TRANSPORT] else Transport,
+            serializer=JSONSerializer(codec=config[KEY_CONFIG_JSON_CODEC]),
+            maxsize=max(MIN_CONNECTIONS, config[KEY_CONFIG_THREADS]),
+            **dict((key, config[key]) for key in KEYS_CONFIG_TRANSPORT if key in config))
+
+        for event in self._index_records(esclient, config, records):
+            yield event
+
+if __name__ == "__main__":
+    dispatch(ElasticSplunkIndex, sys.argv, sys.stdin, sys.stdout, __name__)
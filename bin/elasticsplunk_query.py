@@ -0,0 +1,79 @@
+# vim: set fileencoding=utf-8:
+# ElasticSplunk query compiler
+# Builds search bodies with the time range and other constraints in
+# non scoring filter context, so Elasticsearch can cache them
+#
+
+# Default granularity in seconds of now relative time ranges
+DEFAULT_TIME_ROUNDING = 60
+
+# Query string matching all documents, no clause needed for it
+MATCH_ALL_QUERY = "*"
+
+# Sort orders
+ORDER_ASC = "asc"
+ORDER_DESC = "desc"
+ORDER_NONE = "none"
+ORDERS = (ORDER_ASC, ORDER_DESC, ORDER_NONE)
+
+
+def round_range(earliest, latest, granularity):
+    """Widen a time range to whole multiples of granularity seconds
+
+    Searches relative to now are issued with a different range every second,
+    rounding makes repeated searches produce identical, cacheable filters.
+    """
+    if not granularity:
+        return earliest, latest
+    earliest = earliest - earliest % granularity
+    if latest % granularity:
+        latest = latest - latest % granularity + granularity
+    return earliest, latest
+
+
+def compile_query(query=MATCH_ALL_QUERY, tsfield=None, earliest=None, latest=None,
+                  filters=(), order=ORDER_ASC, rounding=0):
+    """Build a search body
+
+    :param query: query string in ES query string syntax
+    :param tsfield: timestamp field to restrict on and sort by, None when the
+        data has no timestamps
+    :param earliest: start of the time range in epoch seconds
+    :param latest: end of the time range in epoch seconds
+    :param filters: additional query clauses documents must match
+    :param order: sort order on tsfield, or none to return documents in
+        index order, the cheapest order for shards to produce
+    :param rounding: granularity in seconds to round the time range to
+
+    When sorting on tsfield scores are never used, so the query string goes
+    into filter context as well. Without a timestamp the query string stays
+    a scoring clause and results are sorted by relevance.
+    """
+    clauses = []
+    if tsfield is not None:
+        earliest, latest = round_range(earliest, latest, rounding)
+        clauses.append({"range": {
+            tsfield: {
+                "gte": earliest,
+                "lte": latest,
+                "format": "epoch_second",
+            }
+        }})
+    clauses.extend(filters)
+
+    query_clause = None
+    if query and query != MATCH_ALL_QUERY:
+        query_clause = {"query_string": {"query": query}}
+
+    if tsfield is None:
+        bool_query = {"must": [query_clause or {"match_all": {}}]}
+        if clauses:
+            bool_query["filter"] = clauses
+        return {"query": {"bool": bool_query}}
+
+    if query_clause:
+        clauses.append(query_clause)
+    return {
+        "sort": ["_doc"] if order == ORDER_NONE else [{tsfield: {"order": order}}],
+        "query": {"bool": {"filter": clauses}},
+    }
@@ -9,8 +9,11 @@ import sys
 import os
 import json
 import calendar
+from collections import deque
 from datetime import datetime
-from elasticsearch import Elasticsearch, helpers
+from elasticsearch import Elasticsearch, helpers, Transport, AsyncTransport
+from elasticsearch.connection_pool import SELECTORS
+from elasticsearch.serializer import JSONSerializer, get_codec
 from splunklib.searchcommands import \
     dispatch, StreamingCommand, Configuration, Option, validators
 
@@ -23,6 +26,9 @@ KEY_CONFIG_EADDR = "hosts"
 KEY_CONFIG_TIMESTAMP = "tsfield"
 KEY_CONFIG_USE_SSL = "use_ssl"
 KEY_CONFIG_VERIFY_CERTS = "verify_certs"
+KEY_CONFIG_SELECTOR = "selector"
+KEY_CONFIG_JSON_CODEC = "json_codec"
+KEY_CONFIG_ASYNC_TRANSPORT = "async_transport"
 KEY_CONFIG_FIELDS = "fields"
 KEY_CONFIG_EXCLUDE_FIELDS = "exclude_fields"
 KEY_CONFIG_INDEX_FIELD = "index_field"
@@ -34,11 +40,38 @@ KEY_CONFIG_INCLUDE_ES = "include_es"
 KEY_CONFIG_INCLUDE_RAW = "include_raw"
 KEY_CONFIG_CONVERT_TIMESTAMP = "convert_timestamp"
 KEY_CONFIG_FORCE_REFRESH = "force_refresh"
+KEY_CONFIG_CHUNK_SIZE = "chunk_size"
+KEY_CONFIG_MAX_CHUNK_BYTES = "max_chunk_bytes"
+KEY_CONFIG_THREADS = "threads"
+KEY_CONFIG_SKIP_UNCHANGED = "skip_unchanged"
+
+# Config keys passed as is to the transport
+KEYS_CONFIG_TRANSPORT = ("hedge_requests", "hedge_percentile", "hedge_delay",
+                         "adaptive_concurrency", "max_concurrency", "max_retries")
 
 # Splunk keys
 KEY_SPLUNK_TIMESTAMP = "_time"
 KEY_SPLUNK_RAW = "_raw"
 
+# Default connection selector
+DEFAULT_SELECTOR = "round_robin"
+
+# Min number of idle connections kept per node, raised to the number of threads
+MIN_CONNECTIONS = 10
+
+# Default max number of documents and bytes sent per bulk request
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_MAX_CHUNK_BYTES = 10 * 1024 * 1024
+
+# Bulk update result fields
+KEY_RESULT_STATUS = "es_status"
+KEY_RESULT_VERSION = "es_version"
+KEY_RESULT_RESULT = "es_result"
+KEY_RESULT_ERROR = "es_error"
+
+# Result of updates that wouldn't change the document, same as Elasticsearch's
+RESULT_NOOP = "noop"
+
 @Configuration()
 class ElasticSplunkUpdate(StreamingCommand):
     eaddr = Option(require=False, default="127.0.0.1 9200", doc="server:port,server:port or config item")
@@ -56,7 +89,11 @@ class ElasticSplunkUpdate(StreamingCommand):
     verify_certs = Option(require=False, default=None, doc="Verify SSL Certificates")
     convert_timestamp = Option(require=False, default=True, doc="Convert timestamps from text to unix timestamp")
     force_refresh = Option(require=False, default=False, doc="Force refresh of shards after update")
-    
+    chunk_size = Option(require=False, default=DEFAULT_CHUNK_SIZE, doc="Max number of documents per bulk request")
+    max_chunk_bytes = Option(require=False, default=DEFAULT_MAX_CHUNK_BYTES, doc="Max size in bytes of a bulk request")
+    threads = Option(require=False, default=1, doc="Number of bulk requests sent at once")
+    skip_unchanged = Option(require=False, default=False, doc="Fetch the documents first and only update the ones with changed fields")
+
 
     @staticmethod
     def to_epoch(timestring):
@@ -98,6 +135,22 @@ class ElasticSplunkUpdate(StreamingCommand):
             config[KEY_CONFIG_VERIFY_CERTS] = True if self.verify_certs == "true" else False
         elif KEY_CONFIG_VERIFY_CERTS not in config:
             config[KEY_CONFIG_VERIFY_CERTS] = False
+
+        # Connection selection strategy
+        if KEY_CONFIG_SELECTOR not in config:
+            config[KEY_CONFIG_SELECTOR] = DEFAULT_SELECTOR
+        if config[KEY_CONFIG_SELECTOR] not in SELECTORS:
+            raise Exception("Unknown selector {0}, expected one of {1}".format(
+                config[KEY_CONFIG_SELECTOR], ",".join(sorted(SELECTORS))))
+
+        # JSON codec, checked here so a missing one fails before searching
+        if KEY_CONFIG_JSON_CODEC in config:
+            get_codec(config[KEY_CONFIG_JSON_CODEC])
+        else:
+            config[KEY_CONFIG_JSON_CODEC] = None
+
+        # Non-blocking transport, from the stored config
+        config[KEY_CONFIG_ASYNC_TRANSPORT] = True if config.get(KEY_CONFIG_ASYNC_TRANSPORT) in [True, "true", "True", 1, "y"] else False
         
         # Fields to fetch
         if self.fields:
@@ -127,6 +180,14 @@ class ElasticSplunkUpdate(StreamingCommand):
         config[KEY_CONFIG_CONVERT_TIMESTAMP] = True if self.convert_timestamp in [True, "true", "True", 1, "y"] else False
         config[KEY_CONFIG_FORCE_REFRESH] = True if self.force_refresh in [True, "true", "True", 1, "y"] else False
 
+        # Bulk requests
+        config[KEY_CONFIG_CHUNK_SIZE] = int(self.chunk_size)
+        config[KEY_CONFIG_MAX_CHUNK_BYTES] = int(self.max_chunk_bytes)
+        config[KEY_CONFIG_THREADS] = int(self.threads)
+        if config[KEY_CONFIG_CHUNK_SIZE] < 1 or config[KEY_CONFIG_MAX_CHUNK_BYTES] < 1 or config[KEY_CONFIG_THREADS] < 1:
+            raise Exception("chunk_size, max_chunk_bytes and threads must be at least 1")
+        config[KEY_CONFIG_SKIP_UNCHANGED] = True if self.skip_unchanged in [True, "true", "True", 1, "y"] else False
+
         return config
 
     def _parse_hit(self, config, hit):
@@ -155,20 +216,25 @@ class ElasticSplunkUpdate(StreamingCommand):
 
         return event
 
-    def _update(self, esclient, config, record):
+    def _action(self, config, record):
+        """Bulk update action with the fields of a record"""
         remove_fields = [KEY_SPLUNK_TIMESTAMP, KEY_SPLUNK_RAW]
         for key in KEYS_ELASTIC:
             remove_fields.append("es{0}".format(key))
 
         if config[KEY_CONFIG_INDEX_FIELD] in record:
-            config[KEY_CONFIG_INDEX] = record[config[KEY_CONFIG_INDEX_FIELD]]
+            index = record[config[KEY_CONFIG_INDEX_FIELD]]
             remove_fields.append(config[KEY_CONFIG_INDEX_FIELD])
-        elif not config[KEY_CONFIG_INDEX]:
+        elif config[KEY_CONFIG_INDEX]:
+            index = config[KEY_CONFIG_INDEX]
+        else:
             raise Exception("Index to update not specified via either index or index_field parameter")
         if config[KEY_CONFIG_SOURCE_TYPE_FIELD] in record:
-            config[KEY_CONFIG_SOURCE_TYPE] = record[config[KEY_CONFIG_SOURCE_TYPE_FIELD]]
+            doc_type = record[config[KEY_CONFIG_SOURCE_TYPE_FIELD]]
             remove_fields.append(config[KEY_CONFIG_SOURCE_TYPE_FIELD])
-        elif not config[KEY_CONFIG_SOURCE_TYPE]:
+        elif config[KEY_CONFIG_SOURCE_TYPE]:
+            doc_type = config[KEY_CONFIG_SOURCE_TYPE][0]
+        else:
             raise Exception("Source/doc_type not specified via either stype or stype_field parameter")
         if not config[KEY_CONFIG_ID_FIELD] in record:
             raise Exception("Correct field containing id to update not specified via correct id_field parameter")
@@ -176,24 +242,131 @@ class ElasticSplunkUpdate(StreamingCommand):
             remove_fields.append(config[KEY_CONFIG_ID_FIELD])
 
         remove_fields=set(remove_fields)
-        
-        body = { "doc" : {}} 
+
+        body = { "doc" : {}, "detect_noop": True}
         for field in record:
             if field not in remove_fields:
                 body["doc"][field] = record[field]
 
-        res = esclient.update(index=config[KEY_CONFIG_INDEX],
-                                  _source_include=config[KEY_CONFIG_FIELDS],
-                                  _source_exclude=config[KEY_CONFIG_EXCLUDE_FIELDS],
-                                  doc_type=config[KEY_CONFIG_SOURCE_TYPE],
-                                  id=record[config[KEY_CONFIG_ID_FIELD]],
-                                  body=body,
-                                  refresh=config[KEY_CONFIG_FORCE_REFRESH],
-                                  _source=True)
+        # Return the updated document, like the update API with _source
+        source = {}
+        if config[KEY_CONFIG_FIELDS]:
+            source["includes"] = config[KEY_CONFIG_FIELDS]
+        if config[KEY_CONFIG_EXCLUDE_FIELDS]:
+            source["excludes"] = config[KEY_CONFIG_EXCLUDE_FIELDS]
+        body["_source"] = source or True
+
+        return {
+            "_op_type": "update",
+            "_index": index,
+            "_type": doc_type,
+            "_id": record[config[KEY_CONFIG_ID_FIELD]],
+            "_source": body,
+        }
+
+    def _result(self, config, record, ok, item):
+        """Event for the bulk update result of a record, the updated document or the record if it failed"""
+        _, item = item.popitem()
+        event = self._parse_hit(config, item) if ok and "get" in item else dict(record)
+        event[KEY_RESULT_STATUS] = item.get("status")
+        event[KEY_RESULT_VERSION] = item.get("_version")
+        event[KEY_RESULT_RESULT] = item.get("result")
+        error = item.get("error")
+        event[KEY_RESULT_ERROR] = json.dumps(error) if isinstance(error, dict) else error
+        return event
 
-        print json.dumps(res, indent=2)
+    def _current(self, esclient, actions):
+        """Current values of the fields updated by actions, fetched with a single mget"""
+        docs = [{
+            "_index": action["_index"],
+            "_type": action["_type"],
+            "_id": action["_id"],
+            "_source": sorted(action["_source"]["doc"]),
+        } for action in actions]
+        return esclient.mget(body={"docs": docs})["docs"]
+
+    def _skipped(self, record, current):
+        """Event for a record whose update wouldn't change its document"""
+        event = dict(record)
+        event[KEY_RESULT_STATUS] = 200
+        event[KEY_RESULT_VERSION] = current.get("_version")
+        event[KEY_RESULT_RESULT] = RESULT_NOOP
+        event[KEY_RESULT_ERROR] = None
+        return event
 
-        return self._parse_hit(config, res)
+    def _update(self, esclient, config, records):
+        """Update the documents of records with bulk requests, generating a result per record in input order"""
+
+        # records whose results are pending, the bulk helpers read ahead by a
+        # few chunks, with the event of the ones skipped as unchanged
+        pending = deque()
+        indices = set()
+        # with threads the actions are generated by the pool's task handler
+        # thread, its errors are raised here once the results are drained
+        errors = []
+
+        def actions():
+            try:
+                for batch in _batches(records, config[KEY_CONFIG_CHUNK_SIZE]):
+                    batch_actions = [self._action(config, record) for record in batch]
+                    if config[KEY_CONFIG_SKIP_UNCHANGED]:
+                        currents = self._current(esclient, batch_actions)
+                    else:
+                        currents = [None] * len(batch)
+                    for record, action, current in zip(batch, batch_actions, currents):
+                        if current is not None and current.get("found"):
+                            changes = _changes(action["_source"]["doc"], current.get(KEY_ELASTIC_SOURCE) or {})
+                            if not changes:
+                                pending.append((record, self._skipped(record, current)))
+                                continue
+                            action["_source"]["doc"] = changes
+                        indices.add(action["_index"])
+                        pending.append((record, None))
+                        yield action
+            except Exception as e:
+                errors.append(e)
+
+        # documents rejected with a 429 are sent again, backing off like the transport
+        transport = esclient.transport
+        if config[KEY_CONFIG_THREADS] > 1:
+            results = helpers.parallel_bulk(esclient, actions(),
+                                            thread_count=config[KEY_CONFIG_THREADS],
+                                            chunk_size=config[KEY_CONFIG_CHUNK_SIZE],
+                                            max_chunk_bytes=config[KEY_CONFIG_MAX_CHUNK_BYTES],
+                                            max_retries=transport.max_retries,
+                                            initial_backoff=transport.rejection_backoff,
+                                            max_backoff=transport.max_rejection_backoff,
+                                            raise_on_error=False,
+                                            raise_on_exception=False)
+        else:
+            results = helpers.streaming_bulk(esclient, actions(),
+                                             chunk_size=config[KEY_CONFIG_CHUNK_SIZE],
+                                             max_chunk_bytes=config[KEY_CONFIG_MAX_CHUNK_BYTES],
+                                             max_retries=transport.max_retries,
+                                             initial_backoff=transport.rejection_backoff,
+                                             max_backoff=transport.max_rejection_backoff,
+                                             raise_on_error=False,
+                                             raise_on_exception=False)
+
+        # results come in the order of the actions, skipped records are
+        # generated in between
+        counts = {}
+        for ok, item in results:
+            while pending[0][1] is not None:
+                yield _count(counts, pending.popleft()[1], True)
+            yield _count(counts, self._result(config, pending.popleft()[0], ok, item), False)
+        if errors:
+            raise errors[0]
+        while pending:
+            yield _count(counts, pending.popleft()[1], True)
+
+        # A single refresh once all documents are updated
+        if config[KEY_CONFIG_FORCE_REFRESH] and indices:
+            esclient.indices.refresh(index=",".join(sorted(indices)))
+
+        if config[KEY_CONFIG_SKIP_UNCHANGED]:
+            self.write_info("Updated {0} documents, skipped {1} unchanged, {2} left unchanged by Elasticsearch, {3} failed",
+                            counts.get("updated", 0), counts.get("skipped", 0), counts.get(RESULT_NOOP, 0), counts.get("failed", 0))
 
     def stream(self, records):
         
@@ -204,10 +377,68 @@ class ElasticSplunkUpdate(StreamingCommand):
         esclient = Elasticsearch(
             config[KEY_CONFIG_EADDR],
             verify_certs=config[KEY_CONFIG_VERIFY_CERTS],
-            use_ssl=config[KEY_CONFIG_USE_SSL])
-
-        for record in records:
-            yield self._update(esclient, config, record)
+            use_ssl=config[KEY_CONFIG_USE_SSL],
+            selector_class=SELECTORS[config[KEY_CONFIG_SELECTOR]],
+            transport_class=AsyncTransport if config[KEY_CONFIG_ASYNC_TRANSPORT] else Transport,
+            serializer=JSONSerializer(codec=config[KEY_CONFIG_JSON_CODEC]),
+            maxsize=max(MIN_CONNECTIONS, config[KEY_CONFIG_THREADS]),
+            **dict((key, config[key]) for key in KEYS_CONFIG_TRANSPORT if key in config))
+
+        for event in self._update(esclient, config, records):
+            yield event
+
+def _batches(records, size):
+    """Group records in lists of size records"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _count(counts, event, skipped):
+    """Count an update result by outcome"""
+    if skipped:
+        outcome = "skipped"
+    elif event[KEY_RESULT_ERROR] is not None:
+        outcome = "failed"
+    else:
+        outcome = event[KEY_RESULT_RESULT]
+    counts[outcome] = counts.get(outcome, 0) + 1
+    return event
+
+def _changes(doc, source):
+    """Fields of doc with another value in the document source"""
+    changes = {}
+    for field, value in doc.iteritems():
+        if field in source:
+            current = source[field]
+        else:
+            # flattened names of object fields
+            current = source
+            for part in field.split("."):
+                if not isinstance(current, dict) or part not in current:
+                    current = _missing
+                    break
+                current = current[part]
+        if current is _missing or _text(value) != _text(current):
+            changes[field] = value
+    return changes
+
+# Marks a field missing from a document source, None is a valid value
+_missing = object()
+
+def _text(value):
+    """Values from Splunk are always text, compare the ones from Elasticsearch as text"""
+    if isinstance(value, list):
+        return [_text(v) for v in value]
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return unicode(json.dumps(value))
 
 def _flattern(key, data):
     result = {}
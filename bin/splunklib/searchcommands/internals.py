@@ -21,8 +21,7 @@ try:
     from collections import OrderedDict  # must be python 2.7
 except ImportError:
     from ..ordereddict import OrderedDict
-from cStringIO import StringIO
-from itertools import chain, imap
+from itertools import chain, imap, izip
 from json import JSONDecoder, JSONEncoder
 from json.encoder import encode_basestring_ascii as json_encode_string
 from urllib import unquote
@@ -463,14 +462,162 @@ class Recorder(object):
         self._recording.flush()
 
 
+# Value of the slots of a SchemaRecord that are not set
+_unset = object()
+
+
+class RecordSchema(object):
+    """ Field names shared by a stream of :class:`SchemaRecord` objects
+
+    Each field name is assigned the slot its value is stored in by every record using this schema. Fields are only
+    ever appended, so the slot of a field never changes.
+
+    """
+    __slots__ = ('fieldnames', 'slots')
+
+    def __init__(self, fieldnames=()):
+        self.fieldnames = []
+        self.slots = {}
+        for fieldname in fieldnames:
+            self.slot(fieldname)
+
+    def __len__(self):
+        return len(self.fieldnames)
+
+    def slot(self, fieldname):
+        """ Returns the slot of fieldname, adding it to the schema if needed
+
+        """
+        slot = self.slots.get(fieldname)
+        if slot is None:
+            slot = self.slots[fieldname] = len(self.fieldnames)
+            self.fieldnames.append(fieldname)
+        return slot
+
+
+class SchemaRecord(object):
+    """ Record storing its values in a list indexed by a shared :class:`RecordSchema`
+
+    Behaves like the :class:`dict` records are usually represented with, at the cost of a single list per record
+    rather than a hash table. :class:`RecordWriter` encodes these records straight from their slots.
+
+    """
+    __slots__ = ('schema', 'values')
+
+    def __init__(self, schema, fill=_unset):
+        """ :param fill: value of the fields already in schema; by default the record has no fields
+
+        """
+        self.schema = schema
+        self.values = [fill] * len(schema.fieldnames)
+
+    def __contains__(self, fieldname):
+        slot = self.schema.slots.get(fieldname)
+        return slot is not None and slot < len(self.values) and self.values[slot] is not _unset
+
+    def __getitem__(self, fieldname):
+        slot = self.schema.slots.get(fieldname)
+        if slot is None or slot >= len(self.values) or self.values[slot] is _unset:
+            raise KeyError(fieldname)
+        return self.values[slot]
+
+    def __setitem__(self, fieldname, value):
+        slot = self.schema.slot(fieldname)
+        values = self.values
+        if slot >= len(values):
+            values.extend([_unset] * (slot + 1 - len(values)))
+        values[slot] = value
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return 'SchemaRecord({0!r})'.format(dict(self.iteritems()))
+
+    def get(self, fieldname, default=None):
+        slot = self.schema.slots.get(fieldname)
+        if slot is None or slot >= len(self.values):
+            return default
+        value = self.values[slot]
+        return default if value is _unset else value
+
+    def iteritems(self):
+        return ((fn, value) for fn, value in izip(self.schema.fieldnames, self.values) if value is not _unset)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [fn for fn, value in izip(self.schema.fieldnames, self.values) if value is not _unset]
+
+    def update(self, other):
+        for fieldname, value in other.iteritems():
+            self[fieldname] = value
+
+
+class OutputBuffer(object):
+    """ Growable byte buffer records are encoded into before they are written out as a chunk
+
+    Unlike :class:`cStringIO.StringIO` the content is never copied to produce a string: it is written straight from the
+    underlying :class:`bytearray`, and clearing the buffer keeps nothing but an empty array.
+
+    """
+    __slots__ = ('_data',)
+
+    def __init__(self):
+        self._data = bytearray()
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        del self._data[:]
+
+    def getvalue(self):
+        return bytes(self._data)
+
+    def write(self, value):
+        self._data += value
+
+    def write_to(self, ofile):
+        """ Writes the content of this buffer to ofile and returns the number of bytes written
+
+        A regular file is written through its file descriptor from memoryview slices of the buffer, so the content is
+        not copied. Other file-like objects, like a :class:`Recorder`, are handed the buffer itself.
+
+        """
+        data = self._data
+        size = len(data)
+
+        if isinstance(ofile, file):
+            ofile.flush()  # headers written to ofile must come out first
+            fd = ofile.fileno()
+            view = memoryview(data)
+            offset = 0
+            while offset < size:
+                offset += os.write(fd, view[offset:])
+            del view  # the array cannot be resized while a view on it exists
+        else:
+            ofile.write(data)
+
+        return size
+
+
 class RecordWriter(object):
 
-    def __init__(self, ofile, maxresultrows=None):
+    def __init__(self, ofile, maxresultrows=None, maxchunkbytes=None):
         self._maxresultrows = 50000 if maxresultrows is None else maxresultrows
+        self._maxchunkbytes = 64 * 1024 * 1024 if maxchunkbytes is None else maxchunkbytes
 
         self._ofile = ofile
         self._fieldnames = None
-        self._buffer = StringIO()
+        self._encoders = None
+        self._schema = None
+        self._slot_encoders = None
+        self._buffer = OutputBuffer()
 
         self._writer = csv.writer(self._buffer, dialect=CsvDialect)
         self._writerow = self._writer.writerow
@@ -481,6 +628,8 @@ class RecordWriter(object):
         self._chunk_count = 0
         self._record_count = 0
         self._total_record_count = 0L
+        self._chunk_byte_count = 0
+        self._total_byte_count = 0L
 
     @property
     def is_flushed(self):
@@ -520,8 +669,7 @@ class RecordWriter(object):
             write_record(record)
 
     def _clear(self):
-        self._buffer.reset()
-        self._buffer.truncate()
+        self._buffer.clear()
         self._inspector.clear()
         self._record_count = 0
         self._flushed = False
@@ -537,91 +685,146 @@ class RecordWriter(object):
 
         if fieldnames is None:
             self._fieldnames = fieldnames = record.keys()
+            self._encoders = None
             value_list = imap(lambda fn: unicode(fn).encode('utf-8'), fieldnames)
             value_list = imap(lambda fn: (fn, b'__mv_' + fn), value_list)
             self._writerow(list(chain.from_iterable(value_list)))
 
         get_value = record.get
+        encoders = self._encoders
+
+        if encoders is None:
+            # The schema is known from here on: pick an encoder per field from the type of its first value
+            make_encoder = RecordWriter._make_encoder
+            self._encoders = encoders = [(fn, make_encoder(type(get_value(fn, None)))) for fn in fieldnames]
+            if type(record) is SchemaRecord:
+                self._schema = schema = record.schema
+                self._slot_encoders = [(schema.slots[fn], encode) for fn, encode in encoders]
+            else:
+                self._schema = self._slot_encoders = None
+
         values = []
+        extend = values.extend
+
+        if type(record) is SchemaRecord and record.schema is self._schema:
+            # Fields are read from their slots, those added to the schema after the first record are ignored as
+            # they would be for any other record
+            record_values = record.values
+            count = len(record_values)
+            for slot, encode in self._slot_encoders:
+                extend(encode(record_values[slot] if slot < count else None))
+        else:
+            for fieldname, encode in encoders:
+                extend(encode(get_value(fieldname, None)))
 
-        for fieldname in fieldnames:
-            value = get_value(fieldname, None)
+        self._writerow(values)
+        self._record_count += 1
+
+        if self._record_count >= self._maxresultrows or len(self._buffer) >= self._maxchunkbytes:
+            self.flush(partial=True)
 
-            if value is None:
-                values += (None, None)
-                continue
+    def _write_body(self):
+        # Writes the buffered records and accounts for the bytes written
+        self._chunk_byte_count = byte_count = self._buffer.write_to(self._ofile)
+        self._total_byte_count += byte_count
+        environment.splunklib_logger.debug('Wrote chunk of %d records, %d bytes', self._record_count, byte_count)
 
-            value_t = type(value)
+    @staticmethod
+    def _make_encoder(value_t):
+        """ Returns a function encoding a field value as an (sv, mv) pair, specialized for values of type value_t
 
-            if issubclass(value_t, (list, tuple)):
+        Values of any other type are passed on to :meth:`_encode_value`, so the output is the same whichever encoder
+        is picked.
 
-                if len(value) == 0:
-                    values += (None, None)
-                    continue
+        """
+        encode_value = RecordWriter._encode_value
+
+        if value_t is bytes:
+            def encode(value):
+                if type(value) is bytes:
+                    return value, None
+                return encode_value(value)
+        elif value_t is unicode:
+            def encode(value):
+                if type(value) is unicode:
+                    return value.encode('utf-8', errors='backslashreplace'), None
+                return encode_value(value)
+        elif value_t is int or value_t is long or value_t is float:
+            def encode(value):
+                if type(value) is value_t:
+                    return str(value), None
+                return encode_value(value)
+        else:
+            encode = encode_value
 
-                if len(value) > 1:
-                    value_list = value
-                    sv = b''
-                    mv = b'$'
+        return encode
 
-                    for value in value_list:
+    @staticmethod
+    def _encode_value(value):
+        """ Encodes a field value of any type as an (sv, mv) pair, mv is :const:`None` unless value is multi-valued
 
-                        if value is None:
-                            sv += b'\n'
-                            mv += b'$;$'
-                            continue
+        """
+        if value is None or value is _unset:
+            return None, None
 
-                        value_t = type(value)
+        value_t = type(value)
 
-                        if value_t is not bytes:
+        if issubclass(value_t, (list, tuple)):
 
-                            if value_t is bool:
-                                value = str(value.real)
-                            elif value_t is unicode:
-                                value = value.encode('utf-8', errors='backslashreplace')
-                            elif value_t is int or value_t is long or value_t is float or value_t is complex:
-                                value = str(value)
-                            elif issubclass(value_t, (dict, list, tuple)):
-                                value = str(''.join(RecordWriter._iterencode_json(value, 0)))
-                            else:
-                                value = repr(value).encode('utf-8', errors='backslashreplace')
+            if len(value) == 0:
+                return None, None
 
-                        sv += value + b'\n'
-                        mv += value.replace(b'$', b'$$') + b'$;$'
+            if len(value) > 1:
+                value_list = value
+                sv = b''
+                mv = b'$'
 
-                    values += (sv[:-1], mv[:-2])
-                    continue
+                for value in value_list:
 
-                value = value[0]
-                value_t = type(value)
+                    if value is None:
+                        sv += b'\n'
+                        mv += b'$;$'
+                        continue
 
-            if value_t is bool:
-                values += (str(value.real), None)
-                continue
+                    value_t = type(value)
 
-            if value_t is bytes:
-                values += (value, None)
-                continue
+                    if value_t is not bytes:
 
-            if value_t is unicode:
-                values += (value.encode('utf-8', errors='backslashreplace'), None)
-                continue
+                        if value_t is bool:
+                            value = str(value.real)
+                        elif value_t is unicode:
+                            value = value.encode('utf-8', errors='backslashreplace')
+                        elif value_t is int or value_t is long or value_t is float or value_t is complex:
+                            value = str(value)
+                        elif issubclass(value_t, (dict, list, tuple)):
+                            value = str(''.join(RecordWriter._iterencode_json(value, 0)))
+                        else:
+                            value = repr(value).encode('utf-8', errors='backslashreplace')
 
-            if value_t is int or value_t is long or value_t is float or value_t is complex:
-                values += (str(value), None)
-                continue
+                    sv += value + b'\n'
+                    mv += value.replace(b'$', b'$$') + b'$;$'
 
-            if issubclass(value_t, dict):
-                values += (str(''.join(RecordWriter._iterencode_json(value, 0))), None)
-                continue
+                return sv[:-1], mv[:-2]
 
-            values += (repr(value).encode('utf-8', errors='backslashreplace'), None)
+            value = value[0]
+            value_t = type(value)
 
-        self._writerow(values)
-        self._record_count += 1
+        if value_t is bool:
+            return str(value.real), None
 
-        if self._record_count >= self._maxresultrows:
-            self.flush(partial=True)
+        if value_t is bytes:
+            return value, None
+
+        if value_t is unicode:
+            return value.encode('utf-8', errors='backslashreplace'), None
+
+        if value_t is int or value_t is long or value_t is float or value_t is complex:
+            return str(value), None
+
+        if issubclass(value_t, dict):
+            return str(''.join(RecordWriter._iterencode_json(value, 0))), None
+
+        return repr(value).encode('utf-8', errors='backslashreplace'), None
 
     try:
         # noinspection PyUnresolvedReferences
@@ -695,7 +898,7 @@ class RecordWriterV1(RecordWriter):
                 for level, text in messages:
                     print(level, text, file=stderr)
 
-            write(self._buffer.getvalue())
+            self._write_body()
             self._clear()
             self._chunk_count += 1
             self._total_record_count += self._record_count
@@ -740,7 +943,7 @@ class RecordWriterV2(RecordWriter):
                 finished = False
 
             metadata = [item for item in ('inspector', inspector), ('finished', finished)]
-            self._write_chunk(metadata, self._buffer.getvalue())
+            self._write_chunk(metadata, self._buffer)
             self._clear()
 
         elif finished is True:
@@ -763,6 +966,7 @@ class RecordWriterV2(RecordWriter):
     def _clear(self):
         RecordWriter._clear(self)
         self._fieldnames = None
+        self._encoders = None
 
     def _write_chunk(self, metadata, body):
 
@@ -777,10 +981,14 @@ class RecordWriterV2(RecordWriter):
         if not (metadata_length > 0 or body_length > 0):
             return
 
-        start_line = b'chunked 1.0,' + bytes(metadata_length) + b',' + bytes(body_length) + b'\n'
         write = self._ofile.write
-        write(start_line)
+        write(b'chunked 1.0,%d,%d\n' % (metadata_length, body_length))
         write(metadata)
-        write(body)
+
+        if body is self._buffer:
+            self._write_body()
+        else:
+            write(body)
+
         self._ofile.flush()
         self._flushed = False
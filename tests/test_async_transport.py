@@ -0,0 +1,134 @@
+import json
+import os
+import sys
+import threading
+import time
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from elasticsearch import AsyncTransport, TransportError
+from elasticsearch.async_transport import TaskRunner, TASK_DONE, Request
+
+
+class Handler(BaseHTTPRequestHandler):
+    """/delay/<seconds>/<value> answers value after seconds, /reject/<key>/<n>
+    rejects the first n requests for key with a 429"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        status, body = 200, {}
+        if parts[0] == "delay":
+            time.sleep(float(parts[1]))
+            body = {"value": parts[2]}
+        elif parts[0] == "reject":
+            with self.server.lock:
+                attempts = self.server.attempts[parts[1]] = self.server.attempts.get(parts[1], 0) + 1
+            if attempts <= int(parts[2]):
+                status, body = 429, {"error": "rejected"}
+            else:
+                body = {"attempts": attempts}
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def get(transport, url):
+    return Request(transport, "GET", url)
+
+
+class TestTaskRunner(unittest.TestCase):
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.lock = threading.Lock()
+        self.server.attempts = {}
+        thread = threading.Thread(target=self.server.serve_forever, args=(0.05, ))
+        thread.daemon = True
+        thread.start()
+        self.transport = AsyncTransport([{"host": "127.0.0.1", "port": self.server.server_port}],
+                                        adaptive_concurrency=True, rejection_backoff=0.01, max_retries=3)
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_responses_in_completion_order(self):
+        requests = [("GET", "/delay/0.4/a", None, None), ("GET", "/delay/0/b", None, None),
+                    ("GET", "/delay/0.2/c", None, None)]
+        results = list(self.transport.perform_requests(requests))
+        self.assertEqual([(1, {"value": "b"}), (2, {"value": "c"}), (0, {"value": "a"})], results)
+
+    def test_outputs_by_task_position(self):
+        def task(value):
+            yield "before " + value
+            response = yield get(self.transport, "/delay/0/" + value)
+            yield response["value"]
+
+        outputs = {}
+        for position, value in TaskRunner([task("a"), task("b")]):
+            outputs.setdefault(position, []).append(value)
+        self.assertEqual({0: ["before a", "a", TASK_DONE], 1: ["before b", "b", TASK_DONE]}, outputs)
+
+    def test_nested_tasks_return_their_outputs(self):
+        def inner():
+            response = yield get(self.transport, "/delay/0/x")
+            yield response["value"]
+            yield "y"
+
+        def outer():
+            values = yield inner()
+            yield values
+
+        self.assertEqual([(0, ["x", "y"]), (0, TASK_DONE)], list(TaskRunner([outer()])))
+
+    def test_max_tasks_runs_tasks_one_at_a_time(self):
+        def task(delay):
+            yield (yield get(self.transport, "/delay/{0}/v".format(delay)))
+
+        done = [position for position, value in TaskRunner([task(0.2), task(0)], max_tasks=1) if value is TASK_DONE]
+        self.assertEqual([0, 1], done)
+
+    def test_rejected_requests_are_retried(self):
+        def task():
+            yield (yield get(self.transport, "/reject/a/2"))
+
+        self.assertEqual([(0, {"attempts": 3}), (0, TASK_DONE)], list(TaskRunner([task()])))
+        self.assertEqual(0, self.transport.concurrency_limiter.in_flight)
+
+    def test_rejection_after_the_last_retry_is_thrown_into_the_task(self):
+        def task():
+            try:
+                yield get(self.transport, "/reject/b/10")
+            except TransportError as e:
+                yield e.status_code
+
+        self.assertEqual([(0, 429), (0, TASK_DONE)], list(TaskRunner([task()])))
+        self.assertEqual(4, self.server.attempts["b"])
+        self.assertEqual(0, self.transport.concurrency_limiter.in_flight)
+
+    def test_task_errors_are_raised(self):
+        def task():
+            yield get(self.transport, "/delay/0/v")
+            raise ValueError("task failed")
+
+        with self.assertRaises(ValueError):
+            list(TaskRunner([task()]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from elasticsplunk_cache import ResultCache, events_size
+
+
+class TestResultCache(unittest.TestCase):
+    def test_get_counts_hits_and_misses(self):
+        cache = ResultCache()
+        cache.put("a", [{"x": "1"}])
+        self.assertEqual([{"x": "1"}], cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        self.assertEqual(0.5, cache.hit_ratio())
+
+    def test_misses_are_cached_only_when_asked(self):
+        cache = ResultCache()
+        cache.put("a", [])
+        self.assertEqual(0, len(cache))
+        cache = ResultCache(cache_misses=True)
+        cache.put("a", [])
+        self.assertEqual([], cache.get("a"))
+
+    def test_evicts_the_least_recently_used_key(self):
+        cache = ResultCache(max_entries=2)
+        cache.put("a", [{"x": "1"}])
+        cache.put("b", [{"x": "2"}])
+        cache.get("a")
+        cache.put("c", [{"x": "3"}])
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(1, cache.evictions)
+
+    def test_size_is_bounded_in_bytes(self):
+        events = [{"x": "y" * 100}]
+        cache = ResultCache(max_bytes=2 * events_size(events))
+        for key in "abc":
+            cache.put(key, events)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(2 * events_size(events), cache.size)
+
+    def test_replacing_a_key_updates_the_size(self):
+        cache = ResultCache()
+        cache.put("a", [{"x": "y" * 100}])
+        cache.put("a", [{"x": "y"}])
+        self.assertEqual(events_size([{"x": "y"}]), cache.size)
+
+    def test_larger_than_the_cache_is_not_cached(self):
+        cache = ResultCache(max_bytes=10)
+        cache.put("a", [{"x": "y" * 100}])
+        self.assertEqual(0, len(cache))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import calendar
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from elasticsplunk_catalog import IndexCatalog, name_range, NAME_SLACK
+
+DAY = 86400
+
+
+def epoch(*parts):
+    return calendar.timegm(parts + (0,) * (6 - len(parts)))
+
+
+class Cat(object):
+    def __init__(self, names):
+        self.names = names
+
+    def indices(self, index, h, format):
+        return [{"index": name} for name in self.names]
+
+
+class Client(object):
+    """Indices with the (min, max) epoch range of their events, or None when empty"""
+
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.cat = Cat(sorted(ranges))
+        self.searched = []
+
+    def search(self, index, size, ignore_unavailable, body):
+        self.searched.extend(index)
+        buckets = [{"key": name, "min": {"value": self.ranges[name][0] * 1000.0},
+                    "max": {"value": self.ranges[name][1] * 1000.0}}
+                   for name in index if self.ranges[name] is not None]
+        return {"aggregations": {"indices": {"buckets": buckets}}}
+
+
+class TestNameRange(unittest.TestCase):
+    def test_hourly(self):
+        self.assertEqual((epoch(2017, 11, 18, 13), epoch(2017, 11, 18, 14)), name_range("logs-2017.11.18.13"))
+        self.assertEqual((epoch(2017, 11, 18, 23), epoch(2017, 11, 19)), name_range("logs-2017-11-18-23"))
+
+    def test_daily(self):
+        self.assertEqual((epoch(2017, 11, 18), epoch(2017, 11, 19)), name_range("logs-2017.11.18"))
+        self.assertEqual((epoch(2017, 11, 18), epoch(2017, 11, 19)), name_range("logs-2017_11_18"))
+        self.assertEqual((epoch(2017, 11, 18), epoch(2017, 11, 19)), name_range("logs-20171118"))
+        self.assertEqual((epoch(2016, 2, 29), epoch(2016, 3, 1)), name_range("logs-2016.02.29"))
+
+    def test_monthly(self):
+        self.assertEqual((epoch(2017, 11, 1), epoch(2017, 12, 1)), name_range("logs-2017.11"))
+        self.assertEqual((epoch(2017, 12, 1), epoch(2018, 1, 1)), name_range("logs-2017-12"))
+
+    def test_invalid_dates(self):
+        for name in ("logs-2017.13", "logs-2017.00", "logs-2017.13.01", "logs-2017.11.31",
+                     "logs-2017.02.29", "logs-2017.11.18.24", "logs-0000.01.01"):
+            self.assertIsNone(name_range(name), name)
+
+    def test_names_without_a_date(self):
+        for name in ("logs", "logs-v2", "logs-2017", "logs-2017.11.18-a", "logs-17.11.18"):
+            self.assertIsNone(name_range(name), name)
+
+
+class TestPrune(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "catalog", "cluster.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def prune(self, ranges, earliest, latest):
+        self.client = Client(ranges)
+        return IndexCatalog(self.client, "@timestamp", self.path).prune("logs-*", earliest, latest)
+
+    def test_names_within_the_slack_are_candidates(self):
+        start, end = epoch(2017, 11, 18), epoch(2017, 11, 19)
+        ranges = {"logs-2017.11.18": (start, end - 1)}
+        # events may fall outside the date by NAME_SLACK, the name alone doesn't rule them out
+        self.prune(ranges, end + NAME_SLACK, end + NAME_SLACK + 60)
+        self.assertEqual(["logs-2017.11.18"], self.client.searched)
+        os.remove(self.path)
+        self.prune(ranges, start - NAME_SLACK - 60, start - NAME_SLACK)
+        self.assertEqual(["logs-2017.11.18"], self.client.searched)
+
+    def test_names_beyond_the_slack_are_not_searched(self):
+        start, end = epoch(2017, 11, 18), epoch(2017, 11, 19)
+        ranges = {"logs-2017.11.18": (start, end - 1)}
+        self.assertEqual([], self.prune(ranges, end + NAME_SLACK + 1, end + NAME_SLACK + 60))
+        self.assertEqual([], self.prune(ranges, start - NAME_SLACK - 60, start - NAME_SLACK - 1))
+        self.assertEqual([], self.client.searched)
+
+    def test_sealed_indices_need_their_range_to_overlap(self):
+        day = epoch(2017, 11, 18)
+        ranges = {"logs-2017.11.18": (day + 3600, day + 7200)}
+        self.assertEqual(["logs-2017.11.18"], self.prune(ranges, day, day + 3600))
+        self.assertEqual(["logs-2017.11.18"], self.prune(ranges, day + 7200, day + DAY))
+        self.assertEqual([], self.prune(ranges, day + 7201, day + DAY))
+        self.assertEqual([], self.prune(ranges, day, day + 3599))
+
+    def test_sealed_indices_are_not_refreshed(self):
+        day = epoch(2017, 11, 18)
+        ranges = {"logs-2017.11.18": (day, day + 60)}
+        self.prune(ranges, day, day + DAY)
+        self.prune(ranges, day, day + DAY)
+        self.assertEqual([], self.client.searched)
+
+    def test_open_indices_are_open_ended(self):
+        now = time.time()
+        ranges = {"logs-current": (now - DAY, now - 3600)}
+        # newer events may have arrived since the range was computed
+        self.assertEqual(["logs-current"], self.prune(ranges, now - 60, now))
+        self.assertEqual([], self.prune(ranges, now - 2 * DAY, now - DAY - 1))
+
+    def test_empty_indices_are_skipped_once_sealed(self):
+        day = epoch(2017, 11, 18)
+        ranges = {"logs-2017.11.18": None, "logs-current": None}
+        self.assertEqual(["logs-current"], self.prune(ranges, day, day + DAY))
+
+    def test_empty_indices_still_written_to_are_kept(self):
+        today = int(time.time()) // DAY * DAY
+        name = "logs-" + time.strftime("%Y.%m.%d", time.gmtime(today))
+        self.assertEqual([name], self.prune({name: None}, today, today + DAY))
+
+    def test_indices_with_invalid_dates_are_never_pruned_by_name(self):
+        self.assertEqual(["logs-2017.02.30"], self.prune({"logs-2017.02.30": None}, 0, 60))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from elasticsearch.connection_pool import EWMASelector
+
+
+class Node(object):
+    def __init__(self, host):
+        self.host = host
+
+
+class TestEWMASelector(unittest.TestCase):
+    def setUp(self):
+        self.fast, self.slow = Node("fast"), Node("slow")
+        self.selector = EWMASelector({}, decay=0.5)
+
+    def test_prefers_connections_without_latency(self):
+        self.selector.request_finished(self.fast, 0.01)
+        self.assertIs(self.slow, self.selector.select([self.fast, self.slow]))
+
+    def test_prefers_lower_latency(self):
+        self.selector.request_finished(self.fast, 0.01)
+        self.selector.request_finished(self.slow, 0.5)
+        self.assertIs(self.fast, self.selector.select([self.slow, self.fast]))
+
+    def test_requests_in_flight_raise_the_score(self):
+        self.selector.request_finished(self.fast, 0.1)
+        self.selector.request_finished(self.slow, 0.3)
+        for _ in range(3):
+            self.selector.request_started(self.fast)
+        self.assertIs(self.slow, self.selector.select([self.fast, self.slow]))
+        self.assertEqual(3, self.selector.scores()["fast"]["in_flight"])
+
+    def test_latency_is_a_moving_average(self):
+        self.selector.request_finished(self.fast, 1.0)
+        self.selector.request_finished(self.fast, 0.0)
+        self.assertAlmostEqual(0.5, self.selector.scores()["fast"]["latency"])
+
+    def test_failure_forgets_the_latency(self):
+        self.selector.request_finished(self.fast, 0.01)
+        self.selector.request_finished(self.slow, 0.5)
+        self.selector.request_finished(self.slow, 0.5, failed=True)
+        self.assertIsNone(self.selector.scores()["slow"]["latency"])
+        self.assertIs(self.slow, self.selector.select([self.fast, self.slow]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from ConfigParser import RawConfigParser
+from StringIO import StringIO
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(APP_DIR, "bin"))
+
+from elasticsplunk_correlate import ElasticSplunkCorrelate, _merge_ranges, _select, _preload_range, \
+    KEY_CONFIG_WINDOW, KEY_CONFIG_LIMIT, KEY_CONFIG_EARLIEST, KEY_CONFIG_LATEST, KEY_SPLUNK_TIMESTAMP
+
+
+class TestMergeRanges(unittest.TestCase):
+    def test_overlapping_ranges_are_merged(self):
+        merged = _merge_ranges([((10, 20), "b"), ((0, 10), "a"), ((15, 30), "c")])
+        self.assertEqual([(0, 30, ["a", "b", "c"])], merged)
+
+    def test_disjoint_ranges_are_kept_apart(self):
+        merged = _merge_ranges([((20, 30), "b"), ((0, 10), "a")])
+        self.assertEqual([(0, 10, ["a"]), (20, 30, ["b"])], merged)
+
+    def test_contained_range_keeps_the_latest(self):
+        self.assertEqual([(0, 30, ["a", "b"])], _merge_ranges([((0, 30), "a"), ((5, 10), "b")]))
+
+    def test_no_ranges(self):
+        self.assertEqual([], _merge_ranges([]))
+
+
+class TestSelect(unittest.TestCase):
+    events = [{KEY_SPLUNK_TIMESTAMP: "%d" % t} for t in (5, 10, 15, 20, 25)]
+
+    def test_limit_without_window(self):
+        config = {KEY_CONFIG_WINDOW: None, KEY_CONFIG_LIMIT: 2}
+        self.assertEqual(self.events[:2], _select(config, self.events, (100, 200)))
+
+    def test_window_filters_by_time_range(self):
+        config = {KEY_CONFIG_WINDOW: 5, KEY_CONFIG_LIMIT: 10}
+        self.assertEqual(self.events[1:4], _select(config, self.events, (10, 20)))
+
+    def test_limit_applies_after_the_window(self):
+        config = {KEY_CONFIG_WINDOW: 5, KEY_CONFIG_LIMIT: 1}
+        self.assertEqual(self.events[2:3], _select(config, self.events, (12, 30)))
+
+
+class TestPreloadRange(unittest.TestCase):
+    def test_widened_by_the_window(self):
+        config = {KEY_CONFIG_WINDOW: 60, KEY_CONFIG_EARLIEST: 1000, KEY_CONFIG_LATEST: 2000}
+        self.assertEqual((940, 2060), _preload_range(config))
+        config[KEY_CONFIG_WINDOW] = None
+        self.assertEqual((1000, 2000), _preload_range(config))
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    """Elasticsearch answering every search with the same document"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("content-length", 0)))
+        body = json.dumps({"hits": {"total": 1, "hits": [{
+            "_index": "i", "_type": "doc", "_id": "1", "_score": 1.0,
+            "_source": {"@timestamp": "2020-01-01T00:00:00.000Z", "host": "a", "user": "u"}}]}})
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+def chunk(metadata, body=""):
+    metadata = json.dumps(metadata)
+    return "chunked 1.0,{0},{1}\n{2}{3}".format(len(metadata), len(body), metadata, body)
+
+
+def read_chunks(output):
+    """Metadata and body of the chunks written under protocol v2"""
+    chunks = []
+    while output:
+        header, output = output.split("\n", 1)
+        metadata_length, body_length = map(int, re.match(r"chunked 1.0,(\d+),(\d+)", header).groups())
+        chunks.append((json.loads(output[:metadata_length]), output[metadata_length:metadata_length + body_length]))
+        # the configuration chunk is followed by an empty line
+        output = output[metadata_length + body_length:].lstrip("\n")
+    return chunks
+
+
+class TestCacheMetric(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), SearchHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        # the command makes the dispatch directory the temporary directory
+        self.tempdir = tempfile.tempdir
+        self.dispatch_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.dispatch_dir, "info.csv"), "w") as info:
+            info.write("_sid\r\n1\r\n")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dispatch_dir)
+        tempfile.tempdir = self.tempdir
+
+    def test_registered_with_protocol_v2(self):
+        commands = RawConfigParser()
+        commands.read(os.path.join(APP_DIR, "default", "commands.conf"))
+        self.assertEqual("true", commands.get("esscorrelate", "chunked"))
+
+    def test_hit_ratio_reaches_the_search_inspector(self):
+        args = ["correlate_fields=host", "batch_size=1", "earliest=now-1d",
+                "eaddr=http://127.0.0.1:{0}".format(self.server.server_port)]
+        searchinfo = {"args": args, "raw_args": args, "dispatch_dir": self.dispatch_dir, "sid": "1",
+                      "earliest_time": "0", "latest_time": "0", "search": "", "splunk_version": "7.0.0"}
+        ifile = StringIO(chunk({"action": "getinfo", "preview": False, "searchinfo": searchinfo}) +
+                         chunk({"action": "execute", "finished": True}, "host,_time\r\na,1\r\na,2\r\na,3\r\n"))
+        ofile = StringIO()
+        ElasticSplunkCorrelate().process(["esscorrelate"], ifile, ofile)
+
+        metadata, body = read_chunks(ofile.getvalue())[-1]
+        self.assertEqual(4, len(body.splitlines()))
+        # lookups as invocations, hits as the output
+        self.assertEqual([None, 3, None, 2], metadata["inspector"]["metric.correlation_cache"])
+
+
+if __name__ == "__main__":
+    unittest.main()
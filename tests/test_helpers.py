@@ -0,0 +1,70 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from elasticsearch import helpers
+from elasticsearch.serializer import JSONSerializer
+
+
+class Transport(object):
+    serializer = JSONSerializer()
+    concurrency_limiter = None
+
+
+class RejectingClient(object):
+    """Bulk indexes documents, rejecting each of the given ones once with a 429"""
+
+    def __init__(self, rejected):
+        self.transport = Transport()
+        self.rejected = set(rejected)
+        self.requests = []
+
+    def bulk(self, body, **kwargs):
+        lines = body.splitlines()
+        # update actions nest the document under doc
+        docs = [json.loads(line) for line in lines[1::2]]
+        docs = [doc.get("doc", doc) for doc in docs]
+        self.requests.append([doc["n"] for doc in docs])
+        items = []
+        for doc in docs:
+            if doc["n"] in self.rejected:
+                self.rejected.discard(doc["n"])
+                items.append({"index": {"status": 429, "error": "rejected"}})
+            else:
+                items.append({"index": {"status": 201, "_id": str(doc["n"])}})
+        return {"errors": True, "items": items}
+
+
+def actions(count):
+    return [{"_index": "i", "_type": "doc", "_source": {"n": n}} for n in range(count)]
+
+
+class TestBulkRetries(unittest.TestCase):
+    def test_streaming_bulk_retries_rejected_documents_in_order(self):
+        client = RejectingClient([1, 3])
+        results = list(helpers.streaming_bulk(client, actions(5), chunk_size=5, max_retries=2,
+                                              initial_backoff=0, raise_on_error=False))
+        self.assertEqual([True] * 5, [ok for ok, _ in results])
+        self.assertEqual(["0", "1", "2", "3", "4"], [item["index"]["_id"] for _, item in results])
+        self.assertEqual([[0, 1, 2, 3, 4], [1, 3]], client.requests)
+
+    def test_parallel_bulk_retries_rejected_documents_in_order(self):
+        client = RejectingClient([0, 4, 7])
+        results = list(helpers.parallel_bulk(client, actions(8), thread_count=2, chunk_size=3,
+                                             max_retries=1, initial_backoff=0,
+                                             raise_on_error=False, raise_on_exception=False))
+        self.assertEqual([True] * 8, [ok for ok, _ in results])
+        self.assertEqual([str(n) for n in range(8)], [item["index"]["_id"] for _, item in results])
+
+    def test_rejected_documents_fail_once_retries_are_exhausted(self):
+        client = RejectingClient([2])
+        results = list(helpers.streaming_bulk(client, actions(3), raise_on_error=False))
+        self.assertEqual([True, True, False], [ok for ok, _ in results])
+        self.assertEqual(429, results[2][1]["index"]["status"])
+
+
+if __name__ == "__main__":
+    unittest.main()
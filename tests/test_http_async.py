@@ -0,0 +1,183 @@
+import errno
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from elasticsearch.connection.http_async import HttpExchange
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout
+
+
+class Socket(object):
+    """Non-blocking socket receiving one of reads per recv, None for a recv
+    that would block, and the end of the connection after the last one"""
+
+    def __init__(self, reads=()):
+        self.reads = list(reads)
+        self.sent = b""
+        self.closed = False
+
+    def getsockopt(self, level, option):
+        return 0
+
+    def send(self, data):
+        self.sent += data
+        return len(data)
+
+    def recv(self, size):
+        if not self.reads:
+            return b""
+        read = self.reads.pop(0)
+        if read is None:
+            raise socket.error(errno.EAGAIN, "would block")
+        return read
+
+    def close(self):
+        self.closed = True
+
+
+class Connection(object):
+    hostname = "localhost"
+    port = 9200
+    ssl_context = None
+
+    def __init__(self, *sockets):
+        self.sockets = list(sockets)
+        self.idle = []
+        self.released = []
+        self.discarded = []
+
+    def get_socket(self, reuse=True):
+        if reuse and self.idle:
+            return self.idle.pop(), True
+        return self.sockets.pop(0), False
+
+    def release_socket(self, sock):
+        self.released.append(sock)
+
+    def discard_socket(self, sock):
+        self.discarded.append(sock)
+
+
+def blocking(*reads):
+    """Reads each returned by its own recv, with one that would block in between"""
+    split = []
+    for read in reads:
+        split.extend((read, None))
+    return split
+
+
+def complete(connection, method="GET", body=None):
+    """Exchange driven until it's done, as a selector would"""
+    exchange = HttpExchange(connection, method, "/_search", body, {"content-type": "application/json"}, 10)
+    for _ in range(100):
+        if exchange.on_ready():
+            break
+    return exchange
+
+
+class TestHttpExchange(unittest.TestCase):
+    def test_sends_the_request(self):
+        sock = Socket(blocking(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"))
+        complete(Connection(sock), "POST", b'{"size":1}')
+        head, body = sock.sent.split(b"\r\n\r\n")
+        self.assertEqual(b"POST /_search HTTP/1.1", head.split(b"\r\n")[0])
+        self.assertIn(b"Host: localhost:9200", head)
+        self.assertIn(b"Content-Length: 10", head)
+        self.assertEqual(b'{"size":1}', body)
+
+    def test_headers_split_across_reads(self):
+        sock = Socket(blocking(b"HTTP/1.1 200 OK\r\nContent-Le", b"ngth: 5\r\nX-Node: a\r", b"\n\r", b"\nhel", b"lo"))
+        connection = Connection(sock)
+        result = complete(connection)
+        self.assertTrue(result.done)
+        self.assertIsNone(result.error)
+        self.assertEqual(200, result.status)
+        self.assertEqual("a", result.headers["x-node"])
+        self.assertEqual(b"hello", result.data)
+        self.assertEqual([sock], connection.released)
+
+    def test_chunks_split_at_their_boundaries(self):
+        sock = Socket(blocking(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n", b"4\r", b"\nWi",
+                               b"ki\r\n5;name=value\r\npedia\r", b"\n", b"0\r\n", b"\r\n"))
+        connection = Connection(sock)
+        result = complete(connection)
+        self.assertEqual(b"Wikipedia", result.data)
+        self.assertEqual([sock], connection.released)
+
+    def test_chunked_body_in_a_single_read(self):
+        sock = Socket(blocking(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n\r\n"))
+        self.assertEqual(b"abc", complete(Connection(sock)).data)
+
+    def test_chunked_body_waits_for_the_final_line(self):
+        sock = Socket([b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n", None])
+        result = HttpExchange(Connection(sock), "GET", "/", None, {}, 10)
+        result.on_ready()
+        result.on_ready()
+        self.assertFalse(result.done)
+
+    def test_body_without_length_ends_with_the_connection(self):
+        sock = Socket(blocking(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{\"a\"", b":1}"))
+        connection = Connection(sock)
+        result = complete(connection)
+        self.assertIsNone(result.error)
+        self.assertEqual(b'{"a":1}', result.data)
+        self.assertEqual([], connection.released)
+        self.assertEqual([sock], connection.discarded)
+
+    def test_connection_close_discards_the_socket(self):
+        sock = Socket(blocking(b"HTTP/1.1 200 OK\r\nConnection: close\r\nContent-Length: 2\r\n\r\nok"))
+        connection = Connection(sock)
+        self.assertEqual(b"ok", complete(connection).data)
+        self.assertEqual([], connection.released)
+        self.assertEqual([sock], connection.discarded)
+
+    def test_http_1_0_discards_the_socket(self):
+        sock = Socket(blocking(b"HTTP/1.0 200 OK\r\nContent-Length: 2\r\n\r\nok"))
+        connection = Connection(sock)
+        self.assertEqual(b"ok", complete(connection).data)
+        self.assertEqual([sock], connection.discarded)
+
+    def test_responses_without_a_body(self):
+        sock = Socket(blocking(b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n"))
+        result = complete(Connection(sock), "HEAD")
+        self.assertEqual((200, b""), (result.status, result.data))
+        sock = Socket(blocking(b"HTTP/1.1 204 No Content\r\n\r\n"))
+        result = complete(Connection(sock))
+        self.assertEqual((204, b""), (result.status, result.data))
+
+    def test_error_status(self):
+        sock = Socket(blocking(b"HTTP/1.1 429 Too Many Requests\r\nContent-Length: 2\r\n\r\n{}"))
+        result = complete(Connection(sock))
+        self.assertIsNone(result.error)
+        self.assertEqual((429, b"{}"), (result.status, result.data))
+
+    def test_connection_closed_before_the_response(self):
+        sock = Socket(blocking(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabc"))
+        connection = Connection(sock)
+        result = complete(connection)
+        self.assertIsInstance(result.error, ConnectionError)
+        self.assertEqual([sock], connection.discarded)
+
+    def test_closed_keep_alive_socket_is_replaced(self):
+        stale = Socket()
+        fresh = Socket(blocking(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"))
+        connection = Connection(fresh)
+        connection.idle.append(stale)
+        result = complete(connection)
+        self.assertEqual(b"ok", result.data)
+        self.assertEqual([stale], connection.discarded)
+        self.assertEqual([fresh], connection.released)
+        self.assertTrue(fresh.sent.startswith(b"GET /_search"))
+
+    def test_timeout(self):
+        result = HttpExchange(Connection(Socket([None])), "GET", "/", None, {}, 10)
+        self.assertFalse(result.check_timeout(result.start + 1))
+        self.assertTrue(result.check_timeout(result.start + 10))
+        self.assertIsInstance(result.error, ConnectionTimeout)
+
+
+if __name__ == "__main__":
+    unittest.main()
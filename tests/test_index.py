@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from splunklib.searchcommands import Option
+from elasticsplunk_index import ElasticSplunkIndex, ChunkTuner, TARGET_CHUNK_SECONDS, \
+    KEY_RESULT_STATUS, KEY_RESULT_ID
+from test_helpers import RejectingClient
+
+
+class TestChunkTuner(unittest.TestCase):
+    def setUp(self):
+        self.tuner = ChunkTuner(1000, 100, 2000)
+
+    def test_fast_requests_grow_the_size(self):
+        self.tuner.update(TARGET_CHUNK_SECONDS / 2, False)
+        self.assertEqual(1250, self.tuner())
+
+    def test_size_never_exceeds_the_maximum(self):
+        for _ in range(10):
+            self.tuner.update(TARGET_CHUNK_SECONDS / 2, False)
+        self.assertEqual(2000, self.tuner())
+
+    def test_slow_requests_shrink_the_size(self):
+        self.tuner.update(TARGET_CHUNK_SECONDS * 3, False)
+        self.assertEqual(800, self.tuner())
+
+    def test_requests_near_the_target_keep_the_size(self):
+        self.tuner.update(TARGET_CHUNK_SECONDS * 1.5, False)
+        self.assertEqual(1000, self.tuner())
+
+    def test_rejections_halve_the_size_down_to_the_minimum(self):
+        self.tuner.update(TARGET_CHUNK_SECONDS / 2, True)
+        self.assertEqual(500, self.tuner())
+        for _ in range(10):
+            self.tuner.update(TARGET_CHUNK_SECONDS / 2, True)
+        self.assertEqual(100, self.tuner())
+
+
+class Command(ElasticSplunkIndex):
+    def __init__(self, **options):
+        super(Command, self).__init__()
+        for name in dir(ElasticSplunkIndex):
+            option = getattr(ElasticSplunkIndex, name)
+            if isinstance(option, Option):
+                setattr(self, name, options.get(name, option.default))
+        self.messages = []
+
+    def write_info(self, message, *args):
+        self.messages.append(message.format(*args))
+
+
+class TestIndexRecords(unittest.TestCase):
+    def test_rejected_documents_are_sent_again(self):
+        client = RejectingClient(["1", "5", "6"])
+        client.transport.max_retries = 3
+        client.transport.rejection_backoff = 0
+        client.transport.max_rejection_backoff = 0
+        command = Command(index="i", chunk_size="3", threads="2")
+        records = [{"n": str(n)} for n in range(8)]
+        results = list(command._index_records(client, command._get_search_config(), iter(records)))
+        self.assertEqual([201] * 8, [result[KEY_RESULT_STATUS] for result in results])
+        self.assertEqual([str(n) for n in range(8)], [result[KEY_RESULT_ID] for result in results])
+        self.assertEqual(3, sum(len(request) for request in client.requests) - 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from elasticsearch.limiter import AdaptiveConcurrencyLimiter
+
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+    def test_try_acquire_respects_the_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2)
+        self.assertTrue(limiter.try_acquire())
+        self.assertTrue(limiter.try_acquire())
+        self.assertFalse(limiter.try_acquire())
+        limiter.release(0.1)
+        self.assertTrue(limiter.try_acquire())
+
+    def test_completions_grow_the_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=4, max_limit=5)
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertEqual(5.0, limiter.limit)
+        self.assertEqual(0, limiter.in_flight)
+
+    def test_rejection_halves_the_limit_once_per_window(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8)
+        for _ in range(3):
+            limiter.acquire()
+        for _ in range(3):
+            limiter.release(rejected=True)
+        self.assertEqual(4.0, limiter.limit)
+
+    def test_limit_never_drops_below_the_minimum(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, min_limit=2)
+        limiter.backoff()
+        self.assertEqual(2.0, limiter.limit)
+
+    def test_rising_latency_shrinks_the_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=10, smoothing=1.0)
+        limiter.acquire()
+        limiter.release(0.1)
+        limit = limiter.limit
+        limiter.acquire()
+        limiter.release(1.0)
+        self.assertLess(limiter.limit, limit)
+
+
+if __name__ == "__main__":
+    unittest.main()
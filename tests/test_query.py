@@ -0,0 +1,44 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from elasticsplunk_query import compile_query, round_range, ORDER_DESC, ORDER_NONE
+
+
+class TestCompileQuery(unittest.TestCase):
+    def test_match_all_without_timestamp(self):
+        self.assertEqual({"query": {"bool": {"must": [{"match_all": {}}]}}}, compile_query())
+
+    def test_query_string_scores_without_timestamp(self):
+        body = compile_query("host:web*", filters=[{"term": {"a": 1}}])
+        self.assertEqual([{"query_string": {"query": "host:web*"}}], body["query"]["bool"]["must"])
+        self.assertEqual([{"term": {"a": 1}}], body["query"]["bool"]["filter"])
+        self.assertNotIn("sort", body)
+
+    def test_time_range_and_query_in_filter_context(self):
+        body = compile_query("host:web*", tsfield="@timestamp", earliest=100, latest=200)
+        self.assertEqual({"query": {"bool": {"filter": [
+            {"range": {"@timestamp": {"gte": 100, "lte": 200, "format": "epoch_second"}}},
+            {"query_string": {"query": "host:web*"}},
+        ]}}, "sort": [{"@timestamp": {"order": "asc"}}]}, body)
+
+    def test_sort_orders(self):
+        desc = compile_query(tsfield="ts", earliest=0, latest=1, order=ORDER_DESC)
+        self.assertEqual([{"ts": {"order": "desc"}}], desc["sort"])
+        none = compile_query(tsfield="ts", earliest=0, latest=1, order=ORDER_NONE)
+        self.assertEqual(["_doc"], none["sort"])
+
+    def test_rounding_widens_the_range(self):
+        body = compile_query(tsfield="ts", earliest=125, latest=185, rounding=60)
+        self.assertEqual({"gte": 120, "lte": 240, "format": "epoch_second"},
+                         body["query"]["bool"]["filter"][0]["range"]["ts"])
+
+    def test_round_range(self):
+        self.assertEqual((120, 180), round_range(120, 180, 60))
+        self.assertEqual((125, 185), round_range(125, 185, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
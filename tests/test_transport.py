@@ -0,0 +1,44 @@
+import logging
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from elasticsearch.transport import HedgeTimer
+
+
+class TestHedgeTimer(unittest.TestCase):
+    def setUp(self):
+        self.timer = HedgeTimer()
+        self.logger = logging.getLogger("elasticsearch")
+        self.logger.disabled = True
+
+    def tearDown(self):
+        self.logger.disabled = False
+
+    def test_calls_functions_in_delay_order(self):
+        calls, done = [], threading.Event()
+        self.timer.schedule(0.02, lambda: (calls.append(2), done.set()))
+        self.timer.schedule(0.01, lambda: calls.append(1))
+        self.assertTrue(done.wait(1))
+        self.assertEqual([1, 2], calls)
+
+    def test_cancelled_functions_are_not_called(self):
+        calls, done = [], threading.Event()
+        self.timer.cancel(self.timer.schedule(0.01, lambda: calls.append(1)))
+        self.timer.schedule(0.02, done.set)
+        self.assertTrue(done.wait(1))
+        self.assertEqual([], calls)
+
+    def test_keeps_running_after_a_function_fails(self):
+        done = threading.Event()
+        self.timer.schedule(0, lambda: 1 / 0)
+        self.timer.schedule(0.01, done.set)
+        self.assertTrue(done.wait(1))
+        self.assertTrue(self.timer.thread.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main()
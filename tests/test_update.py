@@ -0,0 +1,67 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from splunklib.searchcommands import Option
+from elasticsplunk_update import ElasticSplunkUpdate, _changes, KEY_RESULT_STATUS, KEY_RESULT_ERROR
+from test_helpers import RejectingClient
+
+
+class TestChanges(unittest.TestCase):
+    def test_unchanged_text_values(self):
+        source = {"host": u"web1", "port": 80, "up": True}
+        self.assertEqual({}, _changes({"host": "web1", "port": "80", "up": "true"}, source))
+
+    def test_changed_and_missing_fields(self):
+        source = {"host": u"web1"}
+        self.assertEqual({"host": "web2", "port": "80"}, _changes({"host": "web2", "port": "80"}, source))
+
+    def test_flattened_object_fields(self):
+        source = {"geo": {"city": u"Paris", "country": u"FR"}}
+        self.assertEqual({}, _changes({"geo.city": "Paris"}, source))
+        self.assertEqual({"geo.city": "Lyon"}, _changes({"geo.city": "Lyon"}, source))
+        self.assertEqual({"geo.zip": "75001"}, _changes({"geo.zip": "75001"}, source))
+
+    def test_null_is_a_value(self):
+        self.assertEqual({}, _changes({"owner": "null"}, {"owner": None}))
+        self.assertEqual({"owner": "null"}, _changes({"owner": "null"}, {}))
+
+    def test_multivalue_fields(self):
+        source = {"tags": [u"a", u"b"]}
+        self.assertEqual({}, _changes({"tags": ["a", "b"]}, source))
+        self.assertEqual({"tags": ["a"]}, _changes({"tags": ["a"]}, source))
+
+
+class Command(ElasticSplunkUpdate):
+    def __init__(self, **options):
+        super(Command, self).__init__()
+        for name in dir(ElasticSplunkUpdate):
+            option = getattr(ElasticSplunkUpdate, name)
+            if isinstance(option, Option):
+                setattr(self, name, options.get(name, option.default))
+
+
+class TestUpdate(unittest.TestCase):
+    def update(self, threads):
+        client = RejectingClient(["1", "4"])
+        client.transport.max_retries = 3
+        client.transport.rejection_backoff = 0
+        client.transport.max_rejection_backoff = 0
+        command = Command(index="i", stype="doc", chunk_size="2", threads=threads)
+        records = [{"es_id": str(n), "n": str(n)} for n in range(6)]
+        results = list(command._update(client, command._get_search_config(), iter(records)))
+        self.assertEqual([str(n) for n in range(6)], [result["n"] for result in results])
+        self.assertEqual([201] * 6, [result[KEY_RESULT_STATUS] for result in results])
+        self.assertEqual([None] * 6, [result[KEY_RESULT_ERROR] for result in results])
+
+    def test_rejected_updates_are_sent_again(self):
+        self.update("1")
+
+    def test_rejected_updates_are_sent_again_with_threads(self):
+        self.update("2")
+
+
+if __name__ == "__main__":
+    unittest.main()